@@ -1,12 +1,31 @@
 # -*- coding: utf-8 -*-
+import importlib
 
+from . import adaptive
+from . import engine
+from . import ewald
 from . import fields
 from . import integrators
+from . import pairwise
 from . import points
+from . import profiling
 from . import system
+from . import trajectory
+from . import treecode
 from . import utils
-from . import visualizer
 
 
 from .system import NBodySystem
-from .visualizer import Visualizer, run
\ No newline at end of file
+
+
+#The GUI (Qt and its matplotlib backend) is only imported when asked for, so that
+#headless tools (batch, benchmark, precision) and their workers run without it
+def run():
+    importlib.import_module(".visualizer", __name__).run()
+
+
+def __getattr__(name):
+    if name in ["visualizer", "Visualizer"]:
+        visualizer = importlib.import_module(".visualizer", __name__)
+        return visualizer if name == "visualizer" else visualizer.Visualizer
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+import math
+
+import torch
+
+from . import integrators
+from . import pairwise
+from . import utils
+
+
+class AdaptiveStepper(object):
+    def __init__(self, method: str = "error", rtol: float = 1e-6, atol: float = 1e-8,
+                 dt: float = 1e-3, dt_min: float = 1e-9, dt_max: float = 1e-1,
+                 safety: float = 0.9, max_growth: float = 2.0,
+                 eta: float = 0.05, symmetric: bool = True):
+        """
+        Adaptive step size control on top of a system integrator. 
+        With method "error", each step is compared against two half steps
+        (step doubling), and accepted if the scaled difference is at most one,
+        keeping the more accurate half steps result. With method "separation", 
+        dt is eta times the smallest pair timescale, the minimum over pairs
+        of separation over relative velocity and free fall time, made
+        time-symmetric by averaging it at both ends of the step.
+        For batched systems, a single dt is taken for all replicas.
+
+        Parameters
+        ----------
+        method : str, optional
+            Either "error" or "separation". The default is "error".
+        rtol : float, optional
+            Relative tolerance for method "error". The default is 1e-6.
+        atol : float, optional
+            Absolute tolerance for method "error". The default is 1e-8.
+        dt : float, optional
+            Initial step size for method "error". The default is 1e-3.
+        dt_min : float, optional
+            Minimum step size. Steps of this size are always accepted. The default is 1e-9.
+        dt_max : float, optional
+            Maximum step size. The default is 1e-1.
+        safety : float, optional
+            Safety factor for step size updates. The default is 0.9.
+        max_growth : float, optional
+            Maximum step size growth factor between steps. The default is 2.0.
+        eta : float, optional
+            Fraction of the smallest pair timescale for method "separation".
+            The default is 0.05.
+        symmetric : bool, optional
+            Whether to symmetrize the step size of method "separation". The default is True.
+        """
+        if method not in ["error", "separation"]:
+            raise ValueError("Adaptive method not available")
+        self.method = method
+        self.rtol = rtol
+        self.atol = atol
+        self.dt = dt
+        self.dt_min = dt_min
+        self.dt_max = dt_max
+        self.safety = safety
+        self.max_growth = max_growth
+        self.eta = eta
+        self.symmetric = symmetric
+        self.time = 0.0
+        self.history = [] #(time, dt, error, accepted) for each attempted step
+
+    def step(self, system, dt_limit: float = None):
+        """
+        Takes one accepted step, retrying rejected ones.
+
+        Parameters
+        ----------
+        system : NBodySystem
+            System to step.
+        dt_limit : float, optional
+            Upper bound for this step size, as to end on a given time. The default is None.
+
+        Returns
+        -------
+        float
+            Accepted step size.
+
+        """
+        if self.method == "separation":
+            dt = self._separation_step(system, dt_limit)
+        else:
+            dt = self._error_step(system, dt_limit)
+        system.record()
+        return dt
+
+    def advance(self, system, duration: float):
+        """Takes accepted steps until time advances by duration"""
+        end = self.time + duration
+        while end - self.time > 1e-12*max(1.0, abs(end)):
+            self.step(system, end - self.time)
+
+    @property
+    def accepted(self):
+        return sum(1 for record in self.history if record[3])
+
+    @property
+    def rejected(self):
+        return sum(1 for record in self.history if not record[3])
+
+    def _error_step(self, system, dt_limit):
+        order = getattr(system.integrator, "order", 1)
+        while True:
+            dt = self.dt if dt_limit is None else min(self.dt, dt_limit)
+            state = save_state(system)
+            system.step(dt, record=False)
+            full = save_state(system)
+            restore_state(system, state)
+            system.step(dt/2, record=False)
+            system.step(dt/2, record=False)
+            error = self._error_norm(system, full)
+            if error > 0:
+                factor = self.safety*error**(-1/(order + 1))
+            else:
+                factor = self.max_growth
+            factor = min(self.max_growth, max(0.2, factor))
+            accepted = error <= 1.0 or dt <= self.dt_min
+            self.history.append((self.time, dt, error, accepted))
+            if accepted:
+                self.time += dt
+                if dt == self.dt or factor < 1: #Steps cut by dt_limit do not grow dt
+                    self.dt = self._clip(dt*factor)
+                return dt
+            restore_state(system, state)
+            self.dt = self._clip(dt*factor)
+
+    def _error_norm(self, system, full):
+        points = system.points
+        xy, pxy = points.xy.detach(), points.pxy.detach()
+        #Positions difference is taken modulo the periodic box
+        (full_xy, full_pxy, *_), _ = full
+        dxy = utils.wrap_from_center(xy - full_xy, [points.lx, points.ly], [0.0, 0.0])
+        dpxy = pxy - full_pxy
+        error = max(torch.max(torch.abs(dxy)/(self.atol + self.rtol*torch.abs(xy))).item(),
+                    torch.max(torch.abs(dpxy)/(self.atol + self.rtol*torch.abs(pxy))).item())
+        return error if math.isfinite(error) else float("inf")
+
+    def _separation_step(self, system, dt_limit):
+        dt = self._separation_dt(system)
+        if self.symmetric:
+            state = save_state(system)
+            system.step(dt, record=False)
+            dt = 0.5*(dt + self._separation_dt(system))
+            restore_state(system, state)
+        if dt_limit is not None:
+            dt = min(dt, dt_limit)
+        system.step(dt, record=False)
+        self.history.append((self.time, dt, None, True))
+        self.time += dt
+        return dt
+
+    def _separation_dt(self, system):
+        points = system.points
+        vxy = points.pxy.detach()/points.mass
+        kernel = pair_timescale_kernel(system)
+        timescale, = pairwise.pair_min(lambda *args: (kernel(*args),), points.xy.detach(),
+                                       (vxy[..., 0], vxy[..., 1]), points.tile_size)
+        return self._clip(self.eta*torch.min(timescale).item())
+
+    def _clip(self, dt):
+        return min(self.dt_max, max(self.dt_min, dt))
+
+
+class BlockStepper(object):
+    def __init__(self, eta: float = 0.02, max_level: int = 10):
+        """
+        Individual block time steps, with hierarchical kick-drift-kick leapfrog.
+        Each particle steps by dt/2**level, with level chosen from eta times its
+        smallest pair timescale (as in AdaptiveStepper "separation" method), and
+        particles may only move to a coarser level when synchronized with it.
+        All particles drift together, but only the particles ending their step
+        have their forces recomputed, against all particles. Particles are
+        synchronized at the end of each step call. For batched systems, levels
+        are the finest over replicas.
+
+        Parameters
+        ----------
+        eta : float, optional
+            Fraction of the smallest pair timescale. The default is 0.02.
+        max_level : int, optional
+            Finest level, so that the smallest step is dt/2**max_level. The default is 10.
+        """
+        self.eta = eta
+        self.max_level = max_level
+        self.forces = None
+        self.stamp = None
+        self.levels = None
+        self.force_evaluations = 0 #Number of particle forces evaluated
+        self.history = [] #(dt, number of substeps, number of forces) for each step call
+
+    def step(self, system, dt: float):
+        """
+        Advances system by dt.
+
+        Parameters
+        ----------
+        system : NBodySystem
+            System to step.
+        dt : float
+            Step size, at which all particles are synchronized.
+
+        Raises
+        ------
+        NonValidIntegratorError
+            Is raised if hamiltonian contains darwin hamiltonian.
+
+        """
+        if system.darwin_coupling is not None:
+            raise integrators.NonValidIntegratorError("Method only valid without magnetostatics")
+        points = system.points
+        n = points.xy.shape[-2]
+        nticks = 2**self.max_level
+        tick_dt = dt/nticks
+        evaluations = self.force_evaluations
+        nsubsteps = 0
+        with torch.no_grad():
+            everyone = torch.arange(n)
+            if self.stamp is None or \
+                    self.stamp != integrators.force_stamp(points, system.objects, system.coupling):
+                self.forces = self._forces(system, everyone)
+            levels = self._levels(system, everyone, dt, 0)
+            #Opening kicks
+            points.pxy += 0.5*self._level_steps(dt, levels, points)[:, None]*self.forces
+            tick = 0
+            while tick < nticks:
+                ticks = 2**(self.max_level - levels)
+                next_tick = tick + int(torch.min(ticks - tick%ticks).item())
+                points.xy += (next_tick - tick)*tick_dt*points.pxy/points.mass
+                tick = next_tick
+                nsubsteps += 1
+                active = torch.nonzero(tick%ticks == 0).flatten()
+                forces = self._forces(system, active)
+                self.forces[..., active, :] = forces
+                points.pxy[..., active, :] += \
+                    0.5*self._level_steps(dt, levels[active], points)[:, None]*forces
+                if tick < nticks:
+                    levels[active] = self._levels(system, active, dt, tick)
+                    points.pxy[..., active, :] += \
+                        0.5*self._level_steps(dt, levels[active], points)[:, None]*forces
+            self.stamp = integrators.force_stamp(points, system.objects, system.coupling)
+        self.levels = levels
+        self.history.append((dt, nsubsteps, self.force_evaluations - evaluations))
+
+    def _level_steps(self, dt, levels, points):
+        #In the dtype of the positions, rather than the default one of dt/2**levels
+        return dt*torch.pow(2.0, -levels.to(points.xy.dtype))
+
+    def _forces(self, system, index):
+        self.force_evaluations += index.shape[0]
+        return system.points.potential_force_on(system.points.xy.detach(), index,
+                                                system.objects, system.coupling)
+
+    def _levels(self, system, index, dt, tick):
+        points = system.points
+        vxy = points.pxy.detach()/points.mass
+        timescales = pairwise.target_min(pair_timescale_kernel(system), points.xy.detach(),
+                                         index, (vxy[..., 0], vxy[..., 1]), points.tile_size)
+        timescales = timescales.reshape(-1, index.shape[0]).amin(dim=0) #Finest over replicas
+        levels = torch.ceil(torch.log2(dt/(self.eta*timescales)))
+        levels = torch.nan_to_num(levels, nan=0.0, posinf=self.max_level, neginf=0.0)
+        #Coarser levels must have a step boundary at the current tick
+        trailing_zeros = (tick & -tick).bit_length() - 1 if tick > 0 else self.max_level
+        coarsest = self.max_level - min(trailing_zeros, self.max_level)
+        return torch.clamp(levels.long(), coarsest, self.max_level)
+
+
+def pair_timescale_kernel(system):
+    """
+    Pair kernel of the smallest between separation over relative speed and
+    free fall time, with velocities as features.
+    """
+    points = system.points
+    #Pair acceleration is 2*coupling*charge**2/(mass*d**2) in this convention
+    acceleration = abs(2*system.coupling*points.charge**2/points.mass)
+    lx, ly = points.lx, points.ly
+
+    def kernel(dx, dy, features_i, features_j):
+        if lx is not None: #Minimum image
+            dx = dx - lx*torch.round(dx/lx)
+        if ly is not None:
+            dy = dy - ly*torch.round(dy/ly)
+        dists = torch.sqrt(dx**2 + dy**2)
+        speeds = torch.sqrt((features_i[0] - features_j[0])**2 +
+                            (features_i[1] - features_j[1])**2)
+        timescales = dists/speeds
+        if acceleration > 0:
+            timescales = torch.minimum(timescales, torch.sqrt(dists**3/acceleration))
+        return timescales
+    return kernel
+
+
+def save_state(system):
+    """Copies of the system parameters (positions, momenta, and Tao dummies), and time"""
+    return [parameter.detach().clone() for parameter in system.points.parameters()], system.time
+
+
+def restore_state(system, state):
+    parameters, time = state
+    with torch.no_grad():
+        for parameter, value in zip(system.points.parameters(), parameters):
+            parameter.copy_(value)
+    system.time = time
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+from typing import Optional, List
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import multiprocessing
+import concurrent.futures
+
+import numpy as np
+import torch
+
+from . import system
+from . import trajectory
+from . import visutils
+
+
+#Swept parameters, as (spec key, run key)
+SWEEP_KEYS = [("designs", "design"), ("frames", "frame"),
+              ("charge_densities", "charge_density"), ("integrators", "integrator"),
+              ("dts", "dt"), ("seeds", "seed")]
+#Fixed parameters and their defaults, as in the GUI form
+DEFAULTS = {"designs": ["N-Random-Circle"], "frames": ["Circle"], "charge_densities": [10.0],
+            "integrators": ["SympleticVerlet"], "dts": [0.001], "seeds": [0],
+            "n_steps": 1000, "record_every": 10, "radius": 1.0, "npoints": 4, "noise": 0.0,
+            "mass": 1.0, "charge": 1.0, "darwin_coupling": None,
+            "fixed_points": "None", "fixed_points_number": 3, "fixed_points_charge": 1.0}
+RESULTS_FILE = "results.jsonl"
+
+
+def expand_sweep(spec: dict) -> List[dict]:
+    """
+    Runs of a sweep spec, one for each combination of designs, frames, charge
+    densities, integrators, dts and seeds, with the other (fixed) parameters.
+
+    Parameters
+    ----------
+    spec : dict
+        Sweep spec, with keys of DEFAULTS. Missing keys take their defaults.
+
+    Raises
+    ------
+    ValueError
+        If spec has unknown keys.
+
+    Returns
+    -------
+    List[dict]
+        Runs parameters, each with a "run_id" made from their hash.
+
+    """
+    unknown = set(spec) - set(DEFAULTS)
+    if unknown:
+        raise ValueError("Unknown sweep keys: %s" % ", ".join(sorted(unknown)))
+    spec = dict(DEFAULTS, **spec)
+    fixed = {key: value for key, value in spec.items()
+             if key not in [spec_key for spec_key, _ in SWEEP_KEYS]}
+    runs = []
+    for values in itertools.product(*[spec[spec_key] for spec_key, _ in SWEEP_KEYS]):
+        run = dict(fixed, **{run_key: value for (_, run_key), value in zip(SWEEP_KEYS, values)})
+        encoded = json.dumps(run, sort_keys=True).encode("utf-8")
+        run["run_id"] = hashlib.sha1(encoded).hexdigest()[:12]
+        runs.append(run)
+    return runs
+
+
+def build_system(run: dict):
+    """Creates the system of a run, as the GUI does"""
+    torch.manual_seed(run["seed"])
+    syst = visutils.create_system_from_design(run["design"], run["noise"], run["mass"],
+                                              run["charge"], run["radius"], run["npoints"],
+                                              run["darwin_coupling"])
+    visutils.set_system_frame(syst, run["frame"], run["charge_density"])
+    visutils.set_fixed_points(syst, run["fixed_points"], run["fixed_points_number"],
+                              run["fixed_points_charge"])
+    visutils.set_integrator(syst, run["integrator"])
+    return syst
+
+
+def run_one(run: dict, output: str, checkpoint_every: int = 1000) -> dict:
+    """
+    Runs a sweep run, streaming its trajectory to output/runs/<run_id>.fbt.
+    Every checkpoint_every steps, the trajectory is flushed and the system is
+    checkpointed to output/runs/<run_id>.ckpt, from which an interrupted run
+    continues, dropping the frames recorded after the checkpoint.
+
+    Parameters
+    ----------
+    run : dict
+        Run parameters, as from expand_sweep.
+    output : str
+        Output directory.
+    checkpoint_every : int, optional
+        Number of steps between checkpoints. The default is 1000.
+
+    Returns
+    -------
+    dict
+        Run parameters with status ("done" or "failed") and results.
+
+    """
+    base = os.path.join(output, "runs", run["run_id"])
+    trajectory_path, checkpoint_path = base + ".fbt", base + ".ckpt"
+    start = time.perf_counter()
+    try:
+        if os.path.exists(checkpoint_path):
+            syst = system.NBodySystem.load_checkpoint(checkpoint_path)
+            truncate_trajectory(trajectory_path, syst.time)
+            writer = trajectory.TrajectoryWriter(trajectory_path, run["record_every"],
+                                                 append=True)
+        else:
+            syst = build_system(run)
+            writer = trajectory.TrajectoryWriter(trajectory_path, run["record_every"])
+            writer.write_system(syst) #Initial frame
+        dt = run["dt"]
+        done = round(syst.time/dt)
+        writer.calls = done
+        syst.add_sink(writer)
+        stepper = syst.make_engine(dt)
+        for i in range(done, run["n_steps"]):
+            stepper.step()
+            if (i + 1)%checkpoint_every == 0 and i + 1 < run["n_steps"]:
+                writer.flush()
+                syst.save_checkpoint(checkpoint_path)
+        writer.close()
+    except Exception as error: #Runs fail independently of each other
+        return dict(run, status="failed", error="%s: %s" % (type(error).__name__, error),
+                    wall_time=time.perf_counter() - start)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    energy = trajectory.TrajectoryReader(trajectory_path).energy
+    drift = np.abs(energy - energy[0])/np.abs(energy[0])
+    return dict(run, status="done", steps=run["n_steps"], time=syst.time,
+                wall_time=time.perf_counter() - start,
+                initial_energy=energy[0].tolist(), final_energy=energy[-1].tolist(),
+                max_energy_drift=np.max(drift, axis=0).tolist(), trajectory=trajectory_path)
+
+
+def truncate_trajectory(path: str, end_time: float):
+    """Drops the frames of a trajectory file recorded after end_time"""
+    if not os.path.exists(path):
+        return
+    reader = trajectory.TrajectoryReader(path)
+    nframes = int(np.searchsorted(reader.time, end_time*(1 + 1e-12), side="right"))
+    _, offset = trajectory.read_header(path)
+    size = offset + nframes*reader.dtype.itemsize
+    del reader
+    with open(path, "r+b") as f:
+        f.truncate(size)
+
+
+def completed_runs(output: str) -> set:
+    """Run ids already done in output results"""
+    path = os.path.join(output, RESULTS_FILE)
+    if not os.path.exists(path):
+        return set()
+    done = set()
+    with open(path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError: #Partially written last line
+                continue
+            if result.get("status") == "done":
+                done.add(result["run_id"])
+    with open(path, "rb+") as f: #Ends a partially written last line, before appending
+        f.seek(0, os.SEEK_END)
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+    return done
+
+
+def run_sweep(spec: dict, output: str, workers: Optional[int] = None, threads: int = 1,
+              checkpoint_every: int = 1000):
+    """
+    Runs a sweep over a process pool, appending each run result to
+    output/results.jsonl as it completes, and skipping runs already done there.
+
+    Parameters
+    ----------
+    spec : dict
+        Sweep spec, as for expand_sweep.
+    output : str
+        Output directory.
+    workers : Optional[int], optional
+        Number of worker processes. If None, the number of cores over threads.
+        The default is None.
+    threads : int, optional
+        Number of torch threads per worker. The default is 1.
+    checkpoint_every : int, optional
+        Number of steps between run checkpoints. The default is 1000.
+
+    Returns
+    -------
+    List[dict]
+        Results of the runs done by this call.
+
+    """
+    os.makedirs(os.path.join(output, "runs"), exist_ok=True)
+    done = completed_runs(output)
+    runs = [run for run in expand_sweep(spec) if run["run_id"] not in done]
+    workers = workers if workers is not None else max(1, (os.cpu_count() or 1)//threads)
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context,
+                                                initializer=_init_worker,
+                                                initargs=(threads,)) as pool, \
+            open(os.path.join(output, RESULTS_FILE), "a") as results_file:
+        futures = [pool.submit(run_one, run, output, checkpoint_every) for run in runs]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results_file.write(json.dumps(result) + "\n")
+            results_file.flush()
+            results.append(result)
+            print("%s %s (%d/%d)" % (result["run_id"], result["status"], len(results), len(runs)))
+    return results
+
+
+def _init_worker(threads):
+    torch.set_num_threads(threads)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="fieldbillard-batch",
+                                     description="Runs a parameter sweep without the GUI.")
+    parser.add_argument("spec", help="JSON sweep spec, with keys: %s" % ", ".join(DEFAULTS))
+    parser.add_argument("-o", "--output", default="fieldbillard-sweep",
+                        help="Output directory. Runs already done there are skipped.")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Number of worker processes. Defaults to cores over threads.")
+    parser.add_argument("-t", "--threads", type=int, default=1,
+                        help="Number of torch threads per worker.")
+    parser.add_argument("--checkpoint-every", type=int, default=1000,
+                        help="Number of steps between run checkpoints.")
+    args = parser.parse_args(argv)
+    with open(args.spec) as f:
+        spec = json.load(f)
+    results = run_sweep(spec, args.output, args.workers, args.threads, args.checkpoint_every)
+    return 0 if all(result["status"] == "done" for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
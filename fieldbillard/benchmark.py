@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+from typing import Optional, List
+import sys
+import json
+import time
+import platform
+import argparse
+import itertools
+
+import torch
+
+from . import batch
+from . import integrators
+from . import visutils
+
+
+SIZES = [16, 64, 256]
+DARWIN_COUPLING = 0.01 #As the GUI default
+RESULTS_VERSION = 1
+#Peak memory increases below this are within page and allocator noise
+MEMORY_SLACK = 1 << 20
+
+
+def expand_cases(designs: Optional[List[str]] = None, frames: Optional[List[str]] = None,
+                 integrator_names: Optional[List[str]] = None,
+                 sizes: Optional[List[int]] = None, darwin: str = "both") -> List[dict]:
+    """
+    Benchmark cases, one for each combination of points design, frame design,
+    integrator, darwin mode and size. Designs of a fixed number of points
+    (as "3-Equilateral") take that size only.
+
+    Parameters
+    ----------
+    designs : Optional[List[str]], optional
+        Points designs. If None, all of visutils.POINTS_DESIGNS. The default is None.
+    frames : Optional[List[str]], optional
+        Frame designs. If None, all of visutils.FRAMES_DESIGNS. The default is None.
+    integrator_names : Optional[List[str]], optional
+        Integrator names, as for integrators.get_integrator. If None, all
+        registered ones. The default is None.
+    sizes : Optional[List[int]], optional
+        Numbers of points, for "N-" designs. If None, SIZES. The default is None.
+    darwin : str, optional
+        Darwin modes, either "off", "on" (with DARWIN_COUPLING) or "both".
+        The default is "both".
+
+    Returns
+    -------
+    List[dict]
+        Cases, with keys "design", "frame", "integrator", "darwin_coupling" and "npoints".
+
+    """
+    designs = designs if designs is not None else visutils.POINTS_DESIGNS
+    frames = frames if frames is not None else visutils.FRAMES_DESIGNS
+    integrator_names = integrator_names if integrator_names is not None \
+        else sorted(integrators.INTEGRATORS)
+    sizes = sizes if sizes is not None else SIZES
+    darwin_couplings = {"off": [None], "on": [DARWIN_COUPLING],
+                        "both": [None, DARWIN_COUPLING]}[darwin]
+    cases = []
+    for design in designs:
+        design_sizes = [int(design.split("-")[0])] if design[0].isdigit() else sizes
+        for frame, name, darwin_coupling, npoints in \
+                itertools.product(frames, integrator_names, darwin_couplings, design_sizes):
+            cases.append({"design": design, "frame": frame, "integrator": name,
+                          "darwin_coupling": darwin_coupling, "npoints": npoints})
+    return cases
+
+
+def case_key(case: dict) -> str:
+    return "%s|%s|%s|%s|%d" % (case["design"], case["frame"], case["integrator"],
+                               case["darwin_coupling"], case["npoints"])
+
+
+def run_case(case: dict, steps: int = 50, warmup: int = 5, repeats: int = 3,
+             dt: float = 1e-3, seed: int = 0) -> dict:
+    """
+    Times steps of a case with the step engine, as batch runs do.
+
+    Parameters
+    ----------
+    case : dict
+        Case, as from expand_cases.
+    steps : int, optional
+        Number of timed steps per repeat. The default is 50.
+    warmup : int, optional
+        Number of untimed steps before the first repeat. The default is 5.
+    repeats : int, optional
+        Number of repeats, the fastest of which is kept. The default is 3.
+    dt : float, optional
+        Step size. The default is 1e-3.
+    seed : int, optional
+        Seed for random designs. The default is 0.
+
+    Returns
+    -------
+    dict
+        Case with "status" ("ok", "skipped" for integrators not valid for the
+        case, or "failed"), and, if ok, "steps_per_second", "seconds_per_step" and
+        "peak_memory_bytes" (peak memory above the one before building the system,
+        or None where not measurable).
+
+    """
+    run, = batch.expand_sweep({"designs": [case["design"]], "frames": [case["frame"]],
+                               "integrators": [case["integrator"]], "dts": [dt],
+                               "seeds": [seed], "npoints": case["npoints"],
+                               "darwin_coupling": case["darwin_coupling"]})
+    baseline = reset_peak_memory()
+    try:
+        syst = batch.build_system(run)
+        stepper = syst.make_engine(dt)
+        for _ in range(warmup):
+            stepper.step()
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for _ in range(steps):
+                stepper.step()
+            best = min(best, time.perf_counter() - start)
+    except (integrators.NonValidIntegratorError, NotImplementedError) as error:
+        return dict(case, status="skipped", error="%s: %s" % (type(error).__name__, error))
+    except Exception as error: #Cases fail independently of each other
+        return dict(case, status="failed", error="%s: %s" % (type(error).__name__, error))
+    peak = peak_memory() if baseline is not None else None
+    return dict(case, status="ok", steps_per_second=steps/best, seconds_per_step=best/steps,
+                peak_memory_bytes=peak - baseline if peak is not None else None)
+
+
+def reset_peak_memory() -> Optional[int]:
+    """Resets the peak resident memory of the process (Linux only), returning the current one"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return None
+    return _status_bytes("VmRSS")
+
+
+def peak_memory() -> Optional[int]:
+    """Peak resident memory of the process since reset_peak_memory (Linux only)"""
+    return _status_bytes("VmHWM")
+
+
+def _status_bytes(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])*1024 #In kB
+    except OSError:
+        pass
+    return None
+
+
+def compare(results: List[dict], baseline: List[dict], threshold: float = 0.1) -> List[dict]:
+    """
+    Regressions of results against baseline results, matched by case.
+
+    Parameters
+    ----------
+    results : List[dict]
+        Results, as from run_case.
+    baseline : List[dict]
+        Baseline results.
+    threshold : float, optional
+        Relative change counted as a regression, either a drop of steps per second
+        or an increase of peak memory (of at least MEMORY_SLACK). The default is 0.1.
+
+    Returns
+    -------
+    List[dict]
+        Regressions, with keys "key", "metric", "baseline", "value" and "ratio".
+
+    """
+    baseline = {case_key(result): result for result in baseline if result["status"] == "ok"}
+    regressions = []
+    for result in results:
+        key = case_key(result)
+        if result["status"] != "ok" or key not in baseline:
+            continue
+        old, new = baseline[key]["steps_per_second"], result["steps_per_second"]
+        if new < (1 - threshold)*old:
+            regressions.append({"key": key, "metric": "steps_per_second",
+                                "baseline": old, "value": new, "ratio": new/old})
+        old, new = baseline[key]["peak_memory_bytes"], result["peak_memory_bytes"]
+        if old is not None and new is not None and \
+                new > (1 + threshold)*old and new - old > MEMORY_SLACK:
+            regressions.append({"key": key, "metric": "peak_memory_bytes",
+                                "baseline": old, "value": new,
+                                "ratio": new/old if old > 0 else float("inf")})
+    return regressions
+
+
+def environment() -> dict:
+    return {"python": platform.python_version(), "torch": torch.__version__,
+            "platform": platform.platform(), "processor": platform.processor(),
+            "threads": torch.get_num_threads()}
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m fieldbillard.benchmark",
+                                     description="Measures steps per second and peak memory "
+                                                 "against the number of points.")
+    parser.add_argument("-o", "--output", default=None,
+                        help="JSON results file. Defaults to printing to stdout.")
+    parser.add_argument("-b", "--baseline", default=None,
+                        help="JSON results file to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Relative slowdown (or memory increase) counted as a regression.")
+    parser.add_argument("--designs", nargs="+", default=None, choices=visutils.POINTS_DESIGNS)
+    parser.add_argument("--frames", nargs="+", default=None, choices=visutils.FRAMES_DESIGNS)
+    parser.add_argument("--integrators", nargs="+", default=None,
+                        help="Integrator names. Defaults to all registered ones.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES,
+                        help="Numbers of points, for N- designs.")
+    parser.add_argument("--darwin", default="both", choices=["off", "on", "both"])
+    parser.add_argument("--steps", type=int, default=50, help="Timed steps per repeat.")
+    parser.add_argument("--warmup", type=int, default=5, help="Untimed steps.")
+    parser.add_argument("--repeats", type=int, default=3, help="Repeats, keeping the fastest.")
+    parser.add_argument("--dt", type=float, default=1e-3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-t", "--threads", type=int, default=None,
+                        help="Number of torch threads. Defaults to torch's.")
+    args = parser.parse_args(argv)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    cases = expand_cases(args.designs, args.frames, args.integrators, args.sizes, args.darwin)
+    settings = {"steps": args.steps, "warmup": args.warmup, "repeats": args.repeats,
+                "dt": args.dt, "seed": args.seed}
+    results = []
+    for i, case in enumerate(cases):
+        result = run_case(case, **settings)
+        results.append(result)
+        rate = "%.1f steps/s" % result["steps_per_second"] if result["status"] == "ok" \
+            else result["status"]
+        print("%s %s (%d/%d)" % (case_key(case), rate, i + 1, len(cases)), file=sys.stderr)
+    document = {"version": RESULTS_VERSION, "environment": environment(),
+                "settings": settings, "results": results}
+    encoded = json.dumps(document, indent=1)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(encoded + "\n")
+    else:
+        print(encoded)
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("settings") != settings:
+        print("Warning: baseline settings %s differ from %s" % (baseline.get("settings"), settings),
+              file=sys.stderr)
+    regressions = compare(results, baseline["results"], args.threshold)
+    for regression in regressions:
+        print("Regression %s %s: %.4g -> %.4g (x%.3f)" %
+              (regression["key"], regression["metric"], regression["baseline"],
+               regression["value"], regression["ratio"]), file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import math
+import functools
+
+import torch
+
+from . import integrators
+from . import utils
+from . import profiling
+
+
+class StepEngine(object):
+    def __init__(self, system, dt: float):
+        """
+        Steps a NBodySystem at a fixed dt with in-place operations. The engine
+        owns a workspace, whose buffers are sized to the system on the first step
+        and reused afterwards, and precomputes the per-dt constants of the
+        integrator. Splitting methods (symplectic Euler, Verlet and registered
+        splitting integrators) and Tao integrators are supported, other integrators
+        (and block time steps) fall back to system.step. Steps allocate no tensors,
+        except for the temporaries of field objects closed forms and, with Darwin
+        coupling, of the Darwin gradients.
+
+        Parameters
+        ----------
+        system : NBodySystem
+            System to step.
+        dt : float
+            Step size.
+        """
+        self.system = system
+        self.dt = dt
+        xy = system.points.xy
+        self.workspace = utils.Workspace(xy.dtype, xy.device)
+        self.force = torch.empty_like(xy.detach())
+        self.plan()
+
+    def plan(self):
+        """Sets the substeps and their coefficients from the system integrator"""
+        integrator = self.system.integrator
+        mass, dt = self.system.points.mass, self.dt
+        self.integrator = integrator
+        self.stamp = None
+        self.substeps = None
+        self.rotation = None
+        if integrator is integrators.sympletic_euler_step:
+            sequence = [("kick", 1.0), ("drift", 1.0)]
+        elif integrator is integrators.sympletic_verlet_step:
+            sequence = [("kick", 0.5), ("drift", 1.0), ("kick", 0.5)]
+        elif isinstance(integrator, integrators.SplittingIntegrator):
+            sequence = integrator.sequence
+        elif isinstance(integrator, functools.partial) and \
+                integrator.func is integrators.tao_step:
+            omega = integrator.keywords.get("omega", 20.0)
+            self.rotation = (math.cos(2*omega*dt), math.sin(2*omega*dt))
+            return
+        else:
+            return
+        #Kicks scale the force, drifts the momenta
+        self.substeps = [(kind, fraction*dt if kind == "kick" else fraction*dt/mass)
+                         for kind, fraction in sequence]
+
+    @property
+    def supported(self):
+        return (self.substeps is not None or self.rotation is not None) and \
+               self.system.block_stepper is None
+
+    def step(self):
+        """Takes one step of size dt"""
+        system = self.system
+        if system.integrator is not self.integrator:
+            self.plan()
+        if not self.supported:
+            system.step(self.dt)
+            return
+        with profiling.phase(system.profiler, "step"):
+            if self.rotation is not None:
+                self.tao_step()
+            else:
+                self.splitting_step()
+            if system.points.periodic:
+                system.points.wrap_around(self.workspace)
+        system.time += self.dt
+        system.record()
+
+    def splitting_step(self):
+        system = self.system
+        if system.darwin_coupling is not None:
+            raise integrators.NonValidIntegratorError("Method only valid without magnetostatics")
+        points, profiler = system.points, system.profiler
+        with torch.no_grad():
+            for kind, coefficient in self.substeps:
+                if kind == "kick":
+                    force = self.cached_force()
+                    with profiling.phase(profiler, "kick"):
+                        points.pxy.add_(force, alpha=coefficient)
+                else:
+                    with profiling.phase(profiler, "drift"):
+                        points.xy.add_(points.pxy, alpha=coefficient)
+
+    def cached_force(self):
+        #Force of the last kick is kept in its buffer, and reused while positions
+        #and interaction setup are unchanged (first-same-as-last)
+        system = self.system
+        stamp = integrators.force_stamp(system.points, system.objects, system.coupling)
+        if self.stamp != stamp:
+            system.points.potential_force(system.points.xy.detach(), system.objects,
+                                          system.coupling, self.force, self.workspace)
+            self.stamp = stamp
+        return self.force
+
+    def tao_step(self):
+        system = self.system
+        points, delta = system.points, self.dt/2
+        args = (points, system.objects, system.coupling, system.darwin_coupling)
+        self.operator_ha(*args, delta)
+        self.operator_hb(*args, delta)
+        integrators.rotate_extended(points, *self.rotation, self.workspace)
+        self.operator_hb(*args, delta)
+        self.operator_ha(*args, delta)
+
+    def operator_ha(self, points, objects, coupling, darwin_coupling, delta):
+        if darwin_coupling is None: #Separable, with dH/dq = -force(q) and dH/dy = y/mass
+            force = self.force_at(points.xy)
+            with profiling.phase(points.profiler, "kick"), torch.no_grad():
+                points.pxy.add_(force, alpha=delta)
+                points.xy_dummy.add_(points.pxy_dummy, alpha=delta/points.mass)
+            return
+        dhdq, dhdy = integrators.hamiltonian_gradients(points, objects, coupling,
+                                                       darwin_coupling, False, True)
+        with profiling.phase(points.profiler, "kick"), torch.no_grad():
+            points.pxy.sub_(dhdq, alpha=delta)
+            points.xy_dummy.add_(dhdy, alpha=delta)
+
+    def operator_hb(self, points, objects, coupling, darwin_coupling, delta):
+        if darwin_coupling is None: #Separable, with dH/dx = -force(x) and dH/dp = p/mass
+            force = self.force_at(points.xy_dummy)
+            with profiling.phase(points.profiler, "drift"), torch.no_grad():
+                points.xy.add_(points.pxy, alpha=delta/points.mass)
+                points.pxy_dummy.add_(force, alpha=delta)
+            return
+        dhdx, dhdp = integrators.hamiltonian_gradients(points, objects, coupling,
+                                                       darwin_coupling, True, False)
+        with profiling.phase(points.profiler, "drift"), torch.no_grad():
+            points.xy.add_(dhdp, alpha=delta)
+            points.pxy_dummy.sub_(dhdx, alpha=delta)
+
+    def force_at(self, xy):
+        """Potential force at xy (positions or their Tao dummies), in the workspace"""
+        system = self.system
+        force = self.workspace.block("tao_force", xy.shape)
+        return system.points.potential_force(xy.detach(), system.objects, system.coupling,
+                                             force, self.workspace)
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+import math
+
+import numpy as np
+import torch
+
+
+EULER_GAMMA = 0.5772156649015329
+
+
+def periodic_potential(targets, sources, source_charges, lx=None, ly=None,
+                       method="ewald", exclude_self=False, **options):
+    """
+    Potential and field generated on targets by the periodic images of sources,
+    with unit coupling and a neutralizing background.
+
+    Parameters
+    ----------
+    targets : torch.Tensor
+        Target positions, of shape (n, 2), or (b, n, 2) for a batch of b replicas.
+    sources : torch.Tensor
+        Source positions, of shape (m, 2), or (b, m, 2) for a batch of b replicas.
+    source_charges : torch.Tensor
+        Source charges, of shape (m,), or (b, m) for a batch of b replicas.
+    lx : Optional[float], optional
+        Period in x-coordinate. If None, the system is not periodic in x. The default is None.
+    ly : Optional[float], optional
+        Period in y-coordinate. If None, the system is not periodic in y. The default is None.
+    method : str, optional
+        Either "ewald" or "mesh". The default is "ewald".
+    exclude_self : bool, optional
+        Whether targets are the sources themselves, and so the
+        direct self-interaction should be excluded. The default is False.
+    **options :
+        Summation parameters. For "ewald", alpha (splitting parameter), kmax
+        (number of reciprocal modes per direction) and nquad (quadrature nodes,
+        singly periodic only). For "mesh", alpha, cutoff (real-space cutoff)
+        and mesh (number of mesh points per direction).
+
+    Raises
+    ------
+    ValueError
+        If method name is not available.
+
+    Returns
+    -------
+    potential : torch.Tensor
+        Potential on targets, of shape (n,) or (b, n).
+    field : torch.Tensor
+        Field (minus potential gradient) on targets, of shape (n, 2) or (b, n, 2).
+
+    """
+    shape = torch.broadcast_shapes(targets.shape[:-2], sources.shape[:-2],
+                                   source_charges.shape[:-1])
+    nreplicas = int(np.prod(shape))
+    n, m = targets.shape[-2], sources.shape[-2]
+    targets = targets.expand(*shape, n, 2).reshape(nreplicas, n, 2)
+    sources = sources.expand(*shape, m, 2).reshape(nreplicas, m, 2)
+    source_charges = source_charges.expand(*shape, m).reshape(nreplicas, m)
+    if method == "ewald":
+        potential, field = _ewald_sum(targets, sources, source_charges, lx, ly,
+                                           exclude_self=exclude_self, **options)
+    elif method == "mesh":
+        potential, field = _mesh_sum(targets, sources, source_charges, lx, ly,
+                                          exclude_self=exclude_self, **options)
+    else:
+        raise ValueError("Periodic summation method not available")
+    return potential.reshape(*shape, n), field.reshape(*shape, n, 2)
+
+
+def _ewald_sum(targets, sources, source_charges, lx=None, ly=None,
+                    alpha=None, kmax=None, nquad=48, exclude_self=False):
+    """
+    Ewald summation of the 1/r kernel, for doubly or singly periodic systems.
+    The real-space sum runs over nearest images only, so alpha*min(period)/2
+    should be large enough for erfc(alpha*min(period)/2) to be negligible.
+    It runs over every pair, with O(b*n*m) index memory, for which "mesh"
+    (with a bounded number of neighbors) is meant for large systems.
+    For singly periodic systems, the long-range part is summed in Fourier
+    modes along the periodic direction, with the splitting integral done by
+    Gauss-Legendre quadrature with nquad nodes.
+    Positions are batched, of shape (b, n, 2).
+    """
+    if lx is not None and ly is not None:
+        alpha = 7.0/min(lx, ly) if alpha is None else alpha
+        kmax = _default_kmax(alpha, max(lx, ly)) if kmax is None else kmax
+        potential, field = _real_space(targets, sources, source_charges,
+                                       lx, ly, alpha, exclude_self)
+        recip_potential, recip_field = _ewald2d_reciprocal(targets, sources, source_charges,
+                                                           lx, ly, alpha, kmax)
+        return potential + recip_potential, field + recip_field
+    elif lx is not None:
+        return _ewald1d(targets, sources, source_charges, lx,
+                        alpha, kmax, nquad, exclude_self)
+    elif ly is not None:
+        potential, field = _ewald1d(targets.flip(-1), sources.flip(-1), source_charges, ly,
+                                    alpha, kmax, nquad, exclude_self)
+        return potential, field.flip(-1)
+    else:
+        raise ValueError("Periodic summation requires a periodic system")
+
+
+def _mesh_sum(targets, sources, source_charges, lx=None, ly=None,
+                   alpha=None, cutoff=None, mesh=None, exclude_self=False):
+    """
+    Particle-mesh Ewald summation of the 1/r kernel, for doubly periodic systems.
+    The reciprocal sum is done by FFT, with charges spread on a mesh by cubic
+    B-splines, and the real-space sum runs over neighbor cells within cutoff.
+    By default, cutoff is chosen to keep a bounded number of neighbors per particle,
+    and the field is within 1e-2 of the Ewald sum one (relative to its norm)
+    for a few particles, and within 1e-3 from a few tens of particles on.
+    Positions are batched, of shape (b, n, 2).
+    """
+    if lx is None or ly is None:
+        raise NotImplementedError("Mesh summation only available for doubly periodic systems")
+    if cutoff is None:
+        cutoff = min(min(lx, ly)/2, math.sqrt(24*lx*ly/(math.pi*max(sources.shape[-2], 1))))
+    alpha = 3.5/cutoff if alpha is None else alpha
+    if mesh is None:
+        mesh = 2**int(math.ceil(math.log2(2*alpha*max(lx, ly))))
+    potential, field = _real_space(targets, sources, source_charges,
+                                   lx, ly, alpha, exclude_self, cutoff)
+    recip_potential, recip_field = _mesh_reciprocal(targets, sources, source_charges,
+                                                    lx, ly, alpha, mesh)
+    return potential + recip_potential, field + recip_field
+
+
+def _default_kmax(alpha, length):
+    #Reciprocal terms decay as erfc(k/(2*alpha)), negligible for k > 7*alpha
+    return int(math.ceil(7*alpha*length/(2*math.pi)))
+
+
+def _minimum_image(diffs, lx, ly):
+    dx, dy = diffs[..., 0], diffs[..., 1]
+    if lx is not None:
+        dx = dx - lx*torch.round(dx/lx)
+    if ly is not None:
+        dy = dy - ly*torch.round(dy/ly)
+    return torch.stack([dx, dy], dim=-1)
+
+
+def neighbor_pairs(targets, sources, lx, ly, cutoff):
+    """
+    Candidate (target, source) pairs within cutoff, from a periodic cell list
+    with cells of width at least cutoff. Falls back to every pair if there
+    are less than three cells per axis, or without cutoff, in which case
+    the index lists take O(b*n*m) memory.
+
+    Parameters
+    ----------
+    targets : torch.Tensor
+        Target positions, of shape (b, n, 2).
+    sources : torch.Tensor
+        Source positions, of shape (b, m, 2).
+    lx : Optional[float]
+        Period in x.
+    ly : Optional[float]
+        Period in y.
+    cutoff : Optional[float]
+        Cutoff distance.
+
+    Returns
+    -------
+    target_index : torch.Tensor
+        Indexes of targets in the flattened batch, of shape (p,).
+    source_index : torch.Tensor
+        Indexes of sources in the flattened batch, same replica only, of shape (p,).
+
+    """
+    nreplicas, n, m = targets.shape[0], targets.shape[1], sources.shape[1]
+    nx = int(lx//cutoff) if (lx is not None and cutoff is not None) else 0
+    ny = int(ly//cutoff) if (ly is not None and cutoff is not None) else 0
+    if nx < 3 or ny < 3: #Every pair is a neighbor
+        target_index = torch.arange(nreplicas*n).repeat_interleave(m)
+        source_index = (target_index//n)*m + torch.arange(m).repeat(nreplicas*n)
+        return target_index, source_index
+    with torch.no_grad():
+        def cell_indexes(xy):
+            ix = (torch.remainder(xy[..., 0]/lx, 1.0)*nx).long().clamp(0, nx - 1)
+            iy = (torch.remainder(xy[..., 1]/ly, 1.0)*ny).long().clamp(0, ny - 1)
+            return ix, iy
+        replica_offsets = torch.arange(nreplicas)[:, None]*(nx*ny)
+        six, siy = cell_indexes(sources)
+        source_cells = (replica_offsets + six*ny + siy).flatten()
+        order = torch.argsort(source_cells, stable=True)
+        counts = torch.bincount(source_cells, minlength=nreplicas*nx*ny)
+        offsets = torch.cumsum(counts, dim=0) - counts
+        tix, tiy = cell_indexes(targets)
+        shifts = torch.tensor([-1, 0, 1])
+        neighbor_x = torch.remainder(tix[..., None, None] + shifts[:, None], nx)
+        neighbor_y = torch.remainder(tiy[..., None, None] + shifts[None, :], ny)
+        neighbor_cells = (replica_offsets[..., None, None] + neighbor_x*ny + neighbor_y)
+        neighbor_cells = neighbor_cells.reshape(nreplicas*n, 9) #(b*n, 9)
+        ncounts = counts[neighbor_cells].flatten()
+        total = int(ncounts.sum().item())
+        starts = torch.cumsum(ncounts, dim=0) - ncounts
+        local = torch.arange(total) - torch.repeat_interleave(starts, ncounts)
+        positions = torch.repeat_interleave(offsets[neighbor_cells].flatten(), ncounts) + local
+        target_index = torch.repeat_interleave(torch.arange(nreplicas*n).repeat_interleave(9),
+                                               ncounts)
+        source_index = order[positions]
+    return target_index, source_index
+
+
+def _real_space(targets, sources, source_charges, lx, ly, alpha,
+                exclude_self=False, cutoff=None):
+    shape = targets.shape[:-1]
+    target_index, source_index = neighbor_pairs(targets, sources, lx, ly, cutoff)
+    if exclude_self:
+        keep = target_index != source_index
+        target_index, source_index = target_index[keep], source_index[keep]
+    targets, sources = targets.reshape(-1, 2), sources.reshape(-1, 2)
+    diffs = _minimum_image(targets[target_index] - sources[source_index], lx, ly) #(p, 2)
+    dists = torch.sqrt(torch.sum(diffs**2, dim=-1)) #(p,)
+    charges = source_charges.flatten()[source_index]
+    erfc_term = torch.erfc(alpha*dists)/dists
+    gaussian_term = 2*alpha/math.sqrt(math.pi)*torch.exp(-alpha**2*dists**2)
+    n = targets.shape[0]
+    potential = torch.zeros(n, dtype=targets.dtype).index_add(0, target_index, charges*erfc_term)
+    field_terms = (charges*(erfc_term + gaussian_term)/dists**2)[:, None]*diffs
+    field = torch.zeros(n, 2, dtype=targets.dtype).index_add(0, target_index, field_terms)
+    potential, field = potential.reshape(shape), field.reshape(*shape, 2)
+    if exclude_self:
+        potential = potential - 2*alpha/math.sqrt(math.pi)*source_charges
+    return potential, field
+
+
+def _ewald2d_reciprocal(targets, sources, source_charges, lx, ly, alpha, kmax):
+    area = lx*ly
+    modes = torch.arange(-kmax, kmax + 1, dtype=targets.dtype)
+    gx, gy = torch.meshgrid(2*math.pi*modes/lx, 2*math.pi*modes/ly, indexing="ij")
+    wavevectors = torch.stack([gx.flatten(), gy.flatten()], dim=-1)
+    wavevectors = wavevectors[torch.any(wavevectors != 0, dim=-1)] #(k, 2)
+    wavenumbers = torch.sqrt(torch.sum(wavevectors**2, dim=-1))
+    weights = 2*math.pi/area*torch.erfc(wavenumbers/(2*alpha))/wavenumbers #(k,)
+    source_phases = sources @ wavevectors.T #(b, m, k)
+    structure_cos = torch.einsum("bm,bmk->bk", source_charges, torch.cos(source_phases))
+    structure_sin = torch.einsum("bm,bmk->bk", source_charges, torch.sin(source_phases))
+    structure_cos, structure_sin = structure_cos[:, None, :], structure_sin[:, None, :]
+    target_phases = targets @ wavevectors.T #(b, n, k)
+    target_cos, target_sin = torch.cos(target_phases), torch.sin(target_phases)
+    potential = (target_cos*structure_cos + target_sin*structure_sin) @ weights #(b, n)
+    field = ((target_sin*structure_cos - target_cos*structure_sin)*weights) @ wavevectors
+    background = 2*math.sqrt(math.pi)/(area*alpha)*torch.sum(source_charges, dim=-1, keepdim=True)
+    return potential - background, field
+
+
+def _ewald1d(targets, sources, source_charges, length, alpha, kmax, nquad,
+             exclude_self, chunk_size=4000000):
+    alpha = 7.0/length if alpha is None else alpha
+    kmax = _default_kmax(alpha, length) if kmax is None else kmax
+    potential, field = _real_space(targets, sources, source_charges,
+                                   length, None, alpha, exclude_self)
+    nodes, weights = np.polynomial.legendre.leggauss(nquad)
+    t = torch.tensor(alpha*(nodes + 1)/2, dtype=targets.dtype) #(q,)
+    w = torch.tensor(alpha*weights/2, dtype=targets.dtype) #(q,)
+    k = 2*math.pi*torch.arange(1, kmax + 1, dtype=targets.dtype)/length #(k,)
+    decay = w*torch.exp(-k[:, None]**2/(4*t**2)) #(k, q)
+    kernel = decay/t #(k, q)
+    dkernel = decay*t #(k, q)
+    nreplicas, n, m = targets.shape[0], targets.shape[1], sources.shape[1]
+    tile = max(1, chunk_size//(nreplicas*m*(nquad + kmax)))
+    potentials, fields = [], []
+    for start in range(0, n, tile):
+        dx = targets[:, start:start+tile, None, 0] - sources[:, None, :, 0] #(b, t, m)
+        dy = targets[:, start:start+tile, None, 1] - sources[:, None, :, 1] #(b, t, m)
+        rho2 = dy**2
+        gaussians = torch.exp(-rho2[..., None]*t**2) #(b, t, m, q)
+        integrals = gaussians @ kernel.T #(b, t, m, k)
+        dintegrals = gaussians @ dkernel.T #(b, t, m, k)
+        cos, sin = torch.cos(dx[..., None]*k), torch.sin(dx[..., None]*k) #(b, t, m, k)
+        z = alpha**2*rho2
+        pair_potential = 2/length*(math.log(alpha) - 0.5*_ein(z)) + \
+                         4/length*torch.sum(cos*integrals, dim=-1) #(b, t, m)
+        #Derivative of -Ein(alpha**2*dy**2)/2 on dy is -(1 - exp(-z))/dy
+        rho2_safe = torch.where(rho2 > 0, rho2, torch.ones_like(rho2))
+        dein = torch.where(rho2 > 0, -torch.expm1(-z)/rho2_safe, alpha**2*torch.ones_like(rho2))
+        ddx = -4/length*torch.sum(k*sin*integrals, dim=-1)
+        ddy = -2/length*dein*dy - 8/length*dy*torch.sum(cos*dintegrals, dim=-1)
+        potentials.append(torch.einsum("btm,bm->bt", pair_potential, source_charges))
+        fields.append(-torch.stack([torch.einsum("btm,bm->bt", ddx, source_charges),
+                                    torch.einsum("btm,bm->bt", ddy, source_charges)], dim=-1))
+    return potential + torch.cat(potentials, dim=1), field + torch.cat(fields, dim=1)
+
+
+def _ein(z, nterms=40):
+    """Entire exponential integral, Ein(z) = E1(z) + log(z) + euler_gamma"""
+    small = z < 4.0
+    zs = torch.where(small, z, torch.zeros_like(z))
+    term = torch.ones_like(z)
+    series = torch.zeros_like(z)
+    for i in range(1, nterms + 1):
+        term = -term*zs/i
+        series = series - term/i
+    zl = torch.where(small, 4.0*torch.ones_like(z), z)
+    fraction = zl + 2*nterms + 1
+    for i in range(nterms, 0, -1):
+        fraction = zl + 2*i - 1 - i**2/fraction
+    large = torch.exp(-zl)/fraction + torch.log(zl) + EULER_GAMMA
+    return torch.where(small, series, large)
+
+
+def _bspline_weights(u):
+    #Cubic B-spline weights of the grid points floor(u) - 1, ..., floor(u) + 2
+    w = u - torch.floor(u)
+    weights = torch.stack([(1 - w)**3/6,
+                           (3*w**3 - 6*w**2 + 4)/6,
+                           (-3*w**3 + 3*w**2 + 3*w + 1)/6,
+                           w**3/6], dim=-1)
+    dweights = torch.stack([-(1 - w)**2/2,
+                            (3*w**2 - 4*w)/2,
+                            (-3*w**2 + 2*w + 1)/2,
+                            w**2/2], dim=-1)
+    return weights, dweights
+
+
+def _mesh_indexes(u, mesh):
+    base = torch.floor(u).long()
+    return torch.remainder(base[..., None] + torch.arange(-1, 3), mesh) #(b, n, 4)
+
+
+def _spline_grid_indexes(u, v, mesh):
+    nreplicas = u.shape[0]
+    replica_offsets = (torch.arange(nreplicas)*mesh*mesh)[:, None, None, None]
+    return replica_offsets + _mesh_indexes(u, mesh)[..., :, None]*mesh + \
+           _mesh_indexes(v, mesh)[..., None, :] #(b, n, 4, 4)
+
+
+def _mesh_reciprocal(targets, sources, source_charges, lx, ly, alpha, mesh):
+    area = lx*ly
+    nreplicas = targets.shape[0]
+    su = torch.remainder(sources[..., 0]/lx, 1.0)*mesh
+    sv = torch.remainder(sources[..., 1]/ly, 1.0)*mesh
+    swx, _ = _bspline_weights(su)
+    swy, _ = _bspline_weights(sv)
+    sindex = _spline_grid_indexes(su, sv, mesh)
+    spread = source_charges[..., None, None]*swx[..., :, None]*swy[..., None, :] #(b, m, 4, 4)
+    grid = torch.zeros(nreplicas*mesh*mesh, dtype=targets.dtype).index_add(0, sindex.flatten(),
+                                                                             spread.flatten())
+    transform = torch.fft.fft2(grid.view(nreplicas, mesh, mesh))
+    modes = torch.fft.fftfreq(mesh, dtype=targets.dtype)*mesh
+    gx, gy = torch.meshgrid(2*math.pi*modes/lx, 2*math.pi*modes/ly, indexing="ij")
+    wavenumbers = torch.sqrt(gx**2 + gy**2)
+    wavenumbers_safe = torch.where(wavenumbers > 0, wavenumbers, torch.ones_like(wavenumbers))
+    weights = torch.where(wavenumbers > 0,
+                          2*math.pi/area*torch.erfc(wavenumbers/(2*alpha))/wavenumbers_safe,
+                          torch.zeros_like(wavenumbers))
+    bspline = torch.sinc(modes/mesh)[:, None]**4*torch.sinc(modes/mesh)[None, :]**4
+    mesh_potential = torch.fft.ifft2(weights/bspline**2*transform).real*mesh*mesh
+    mesh_potential = mesh_potential.flatten()
+    tu = torch.remainder(targets[..., 0]/lx, 1.0)*mesh
+    tv = torch.remainder(targets[..., 1]/ly, 1.0)*mesh
+    twx, dtwx = _bspline_weights(tu)
+    twy, dtwy = _bspline_weights(tv)
+    values = mesh_potential[_spline_grid_indexes(tu, tv, mesh)] #(b, n, 4, 4)
+    potential = torch.sum(twx[..., :, None]*twy[..., None, :]*values, dim=(-2, -1))
+    fx = -mesh/lx*torch.sum(dtwx[..., :, None]*twy[..., None, :]*values, dim=(-2, -1))
+    fy = -mesh/ly*torch.sum(twx[..., :, None]*dtwy[..., None, :]*values, dim=(-2, -1))
+    background = 2*math.sqrt(math.pi)/(area*alpha)*torch.sum(source_charges, dim=-1, keepdim=True)
+    return potential - background, torch.stack([fx, fy], dim=-1)
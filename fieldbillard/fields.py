@@ -4,21 +4,71 @@ import itertools
 import torch
 
 from . import utils
+from . import ewald
 
 
 class FieldObject(object):
+    def __setattr__(self, name, value):
+        #Assigning any attribute invalidates the forces cached against the object
+        object.__setattr__(self, name, value)
+        self.invalidate()
+
+    def invalidate(self):
+        """Marks the object as changed, for changes its stamp cannot see"""
+        object.__setattr__(self, "_version", getattr(self, "_version", 0) + 1)
+
+    def stamp(self):
+        """
+        Stamp of the object state, for checking whether forces cached against it
+        are valid. It changes with attribute assignments, in-place changes of
+        tensor attributes (and of field object attributes) and invalidate calls.
+        """
+        parts = [id(self), getattr(self, "_version", 0)]
+        for value in vars(self).values():
+            if torch.is_tensor(value):
+                parts.append(value._version)
+            elif isinstance(value, FieldObject):
+                parts.append(value.stamp())
+        return tuple(parts)
+
     def potential(x, y, charge, coupling):
         pass
 
+    def force(self, x, y, charge, coupling):
+        """
+        Closed-form force generated by the object on (x, y).
+        Returns None if not available, in which case the
+        force is calculated by automatic differentiation of the potential.
+        """
+        return None
+
 
 class Ring(FieldObject):
     def __init__(self, radius: float, charge_density: float = 1.0,
-                 x0: float = 0.0, y0: float = 0.0):
+                 x0: float = 0.0, y0: float = 0.0, tabulated: bool = False):
+        """
+        Uniformly charged ring, with potential given by complete elliptic integrals.
+
+        Parameters
+        ----------
+        radius : float
+            Ring radius.
+        charge_density : float, optional
+            Linear charge density. The default is 1.0.
+        x0 : float, optional
+            Center x-coordinate. The default is 0.0.
+        y0 : float, optional
+            Center y-coordinate. The default is 0.0.
+        tabulated : bool, optional
+            Whether to interpolate the potential from a precomputed table in r/radius,
+            instead of evaluating it exactly. The default is False.
+        """
         super().__init__()
         self.radius = radius
         self.charge_density = charge_density
         self.x0 = x0
         self.y0 = y0
+        self.table = utils.CircleTable() if tabulated else None
         
     def potential(self, x: torch.Tensor, y: torch.Tensor, charge: float, coupling: float = 1.0):
         """
@@ -42,9 +92,40 @@ class Ring(FieldObject):
 
         """
         r, _ = utils.to_polar(x - self.x0, y - self.y0)
-        value = coupling*self.charge_density*charge*utils.circle_phi(r/self.radius)
+        circle_phi = self.table.phi if self.table is not None else utils.circle_phi
+        value = coupling*self.charge_density*charge*circle_phi(r/self.radius)
         return value
 
+    def force(self, x: torch.Tensor, y: torch.Tensor, charge: float, coupling: float = 1.0):
+        """
+        Force generated by the object on (x, y)
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Position x-coordinate.
+        y : torch.Tensor
+            Position y-coordinate.
+        charge : float
+            Charge of particles.
+        coupling : float, optional
+            Coupling constant. The default is 1.0.
+
+        Returns
+        -------
+        fx : torch.Tensor
+            Force x-coordinate.
+        fy : torch.Tensor
+            Force y-coordinate.
+
+        """
+        dx, dy = x - self.x0, y - self.y0
+        r, _ = utils.to_polar(dx, dy)
+        circle_dphi = self.table.dphi if self.table is not None else utils.circle_dphi
+        dvalue = coupling*self.charge_density*charge*circle_dphi(r/self.radius)/self.radius
+        scale = torch.where(r > 0, -dvalue/r, torch.zeros_like(r))
+        return scale*dx, scale*dy
+
 
 class HorizontalLine(FieldObject):
     def __init__(self, y0: float, charge_density: float = 1.0):
@@ -75,6 +156,32 @@ class HorizontalLine(FieldObject):
         value = -coupling*self.charge_density*charge*utils.torch.log(torch.abs(y - self.y0))
         return value
 
+    def force(self, x: torch.Tensor, y: torch.Tensor, charge: float, coupling: float = 1.0):
+        """
+        Force generated by the object on (x, y)
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Position x-coordinate.
+        y : torch.Tensor
+            Position y-coordinate.
+        charge : float
+            Charge of particles.
+        coupling : float, optional
+            Coupling constant. The default is 1.0.
+
+        Returns
+        -------
+        fx : torch.Tensor
+            Force x-coordinate.
+        fy : torch.Tensor
+            Force y-coordinate.
+
+        """
+        fy = coupling*self.charge_density*charge/(y - self.y0)
+        return torch.zeros_like(fy), fy
+
 
 class VerticalLine(FieldObject):
     def __init__(self, x0, charge_density=1.0):
@@ -104,6 +211,32 @@ class VerticalLine(FieldObject):
         """
         value = -coupling*self.charge_density*charge*torch.log(torch.abs(x - self.x0))
         return value
+
+    def force(self, x: torch.Tensor, y: torch.Tensor, charge: float, coupling: float = 1.0):
+        """
+        Force generated by the object on (x, y)
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Position x-coordinate.
+        y : torch.Tensor
+            Position y-coordinate.
+        charge : float
+            Charge of particles.
+        coupling : float, optional
+            Coupling constant. The default is 1.0.
+
+        Returns
+        -------
+        fx : torch.Tensor
+            Force x-coordinate.
+        fy : torch.Tensor
+            Force y-coordinate.
+
+        """
+        fx = coupling*self.charge_density*charge/(x - self.x0)
+        return fx, torch.zeros_like(fx)
     
 
 class Hash(FieldObject):
@@ -140,6 +273,35 @@ class Hash(FieldObject):
                 self._left.potential(x, y, charge, coupling) + \
                 self._right.potential(x, y, charge, coupling)
         return value
+
+    def force(self, x: torch.Tensor, y: torch.Tensor, charge: float, coupling: float = 1.0):
+        """
+        Force generated by the object on (x, y)
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Position x-coordinate.
+        y : torch.Tensor
+            Position y-coordinate.
+        charge : float
+            Charge of particles.
+        coupling : float, optional
+            Coupling constant. The default is 1.0.
+
+        Returns
+        -------
+        fx : torch.Tensor
+            Force x-coordinate.
+        fy : torch.Tensor
+            Force y-coordinate.
+
+        """
+        forces = [line.force(x, y, charge, coupling)
+                  for line in [self._upper, self._lower, self._left, self._right]]
+        fx = sum(f[0] for f in forces)
+        fy = sum(f[1] for f in forces)
+        return fx, fy
     
     def _set_lines(self):
         self._upper = HorizontalLine(self.y0 + self.l/2, self.charge_density)
@@ -182,6 +344,39 @@ class HorizontalFiniteLine(FieldObject):
         value = coupling*self.charge_density*charge*integral
         return value
 
+    def force(self, x: torch.Tensor, y: torch.Tensor, charge: float, coupling: float = 1.0):
+        """
+        Force generated by the object on (x, y)
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Position x-coordinate.
+        y : torch.Tensor
+            Position y-coordinate.
+        charge : float
+            Charge of particles.
+        coupling : float, optional
+            Coupling constant. The default is 1.0.
+
+        Returns
+        -------
+        fx : torch.Tensor
+            Force x-coordinate.
+        fy : torch.Tensor
+            Force y-coordinate.
+
+        """
+        dx, dy = x - self.x0, y - self.y0
+        h = torch.abs(dy)
+        a, b = dx + self.l/2, dx - self.l/2
+        ra, rb = torch.sqrt(a**2 + h**2), torch.sqrt(b**2 + h**2)
+        k = coupling*self.charge_density*charge
+        fx = -k*(1/ra - 1/rb)
+        #On the line extension (h = 0) the transverse force vanishes, rather than 0/0
+        fy = torch.where(h > 0, k*(a/ra - b/rb)*torch.sign(dy)/h, torch.zeros_like(h))
+        return fx, fy
+
 
 class VerticalFiniteLine(FieldObject):
     def __init__(self, x0, l, y0=0, charge_density=1.0):
@@ -217,6 +412,39 @@ class VerticalFiniteLine(FieldObject):
         value = coupling*self.charge_density*charge*integral
         return value
 
+    def force(self, x: torch.Tensor, y: torch.Tensor, charge: float, coupling: float = 1.0):
+        """
+        Force generated by the object on (x, y)
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Position x-coordinate.
+        y : torch.Tensor
+            Position y-coordinate.
+        charge : float
+            Charge of particles.
+        coupling : float, optional
+            Coupling constant. The default is 1.0.
+
+        Returns
+        -------
+        fx : torch.Tensor
+            Force x-coordinate.
+        fy : torch.Tensor
+            Force y-coordinate.
+
+        """
+        dx, dy = x - self.x0, y - self.y0
+        h = torch.abs(dx)
+        a, b = dy + self.l/2, dy - self.l/2
+        ra, rb = torch.sqrt(a**2 + h**2), torch.sqrt(b**2 + h**2)
+        k = coupling*self.charge_density*charge
+        #On the line extension (h = 0) the transverse force vanishes, rather than 0/0
+        fx = torch.where(h > 0, k*(a/ra - b/rb)*torch.sign(dx)/h, torch.zeros_like(h))
+        fy = -k*(1/ra - 1/rb)
+        return fx, fy
+
 
 class Square(FieldObject):
     def __init__(self, l, charge_density=1.0, x0=0.0, y0=0.0):
@@ -252,6 +480,35 @@ class Square(FieldObject):
                 self._left.potential(x, y, charge, coupling) + \
                 self._right.potential(x, y, charge, coupling)
         return value
+
+    def force(self, x: torch.Tensor, y: torch.Tensor, charge: float, coupling: float = 1.0):
+        """
+        Force generated by the object on (x, y)
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Position x-coordinate.
+        y : torch.Tensor
+            Position y-coordinate.
+        charge : float
+            Charge of particles.
+        coupling : float, optional
+            Coupling constant. The default is 1.0.
+
+        Returns
+        -------
+        fx : torch.Tensor
+            Force x-coordinate.
+        fy : torch.Tensor
+            Force y-coordinate.
+
+        """
+        forces = [line.force(x, y, charge, coupling)
+                  for line in [self._upper, self._lower, self._left, self._right]]
+        fx = sum(f[0] for f in forces)
+        fy = sum(f[1] for f in forces)
+        return fx, fy
     
     def _set_lines(self):
         self._upper = HorizontalFiniteLine(self.y0 + self.l/2, self.l, self.x0,
@@ -305,10 +562,42 @@ class FixedPoints(FieldObject):
         return values
         #values = coupling*self.charge*charge/d
         #return values
+
+    def force(self, x: torch.Tensor, y: torch.Tensor, charge: float, coupling: float = 1.0):
+        """
+        Force generated by the object on (x, y)
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Position x-coordinate.
+        y : torch.Tensor
+            Position y-coordinate.
+        charge : float
+            Charge of particles.
+        coupling : float, optional
+            Coupling constant. The default is 1.0.
+
+        Returns
+        -------
+        fx : torch.Tensor
+            Force x-coordinate.
+        fy : torch.Tensor
+            Force y-coordinate.
+
+        """
+        dx = x[..., None] - self.x0 #(m, n)
+        dy = y[..., None] - self.y0 #(m, n)
+        d3 = ((dx**2 + dy**2)**1.5)
+        k = coupling*self.charge*charge
+        fx = k*torch.sum(dx/d3, axis=-1) #(m,)
+        fy = k*torch.sum(dy/d3, axis=-1) #(m,)
+        return fx, fy
     
     
 class PeriodicFixedPoints(FieldObject):
-    def __init__(self, x0, y0, charge=1.0, lx=None, ly=None, cx=0.0, cy=0.0):
+    def __init__(self, x0, y0, charge=1.0, lx=None, ly=None, cx=0.0, cy=0.0,
+                 method="images", options=None):
         super().__init__()
         self.x0 = x0 #(n, )
         self.y0 = y0 #(n, )
@@ -318,6 +607,8 @@ class PeriodicFixedPoints(FieldObject):
         self.cy = cy
         self.charge = charge #(n, )
         self.nper = 1
+        self.method = method #"images", "ewald" or "mesh"
+        self.options = {} if options is None else options
 
     def potential(self, x: torch.Tensor, y: torch.Tensor, charge: float, coupling: float = 1.0):
         """
@@ -339,6 +630,9 @@ class PeriodicFixedPoints(FieldObject):
         value : torch.Tensor
             Value of potential.
         """
+        if self.method != "images":
+            potential, _ = self.periodic_sum(x, y)
+            return coupling*self.charge*charge*potential
         x = x[..., None]
         y = y[..., None]
         x0 = self.x0 #(1, n)
@@ -353,10 +647,63 @@ class PeriodicFixedPoints(FieldObject):
         values = sum(single_values)
         return values
 
+    def force(self, x: torch.Tensor, y: torch.Tensor, charge: float, coupling: float = 1.0):
+        """
+        Force generated by the object on (x, y)
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Position x-coordinate.
+        y : torch.Tensor
+            Position y-coordinate.
+        charge : float
+            Charge of particles.
+        coupling : float, optional
+            Coupling constant. The default is 1.0.
+
+        Returns
+        -------
+        fx : torch.Tensor
+            Force x-coordinate.
+        fy : torch.Tensor
+            Force y-coordinate.
+
+        """
+        if self.method != "images":
+            _, field = self.periodic_sum(x, y)
+            k = coupling*self.charge*charge
+            return k*field[..., 0], k*field[..., 1]
+        xiterator = list(range(-self.nper, self.nper + 1)) if self.lx is not None else [0]
+        yiterator = list(range(-self.nper, self.nper + 1)) if self.ly is not None else [0]
+        iterator = itertools.product(xiterator, yiterator)
+        single_forces = [self.single_force(x, y, n, m, charge, coupling)
+                         for n, m in iterator]
+        fx = sum(f[0] for f in single_forces)
+        fy = sum(f[1] for f in single_forces)
+        return fx, fy
+
+    def periodic_sum(self, x, y):
+        targets = torch.stack([x, y], dim=-1)
+        sources = torch.stack([self.x0, self.y0], dim=-1).to(targets.dtype)
+        charges = torch.ones(sources.shape[:-1], dtype=targets.dtype)
+        return ewald.periodic_potential(targets, sources, charges, self.lx, self.ly,
+                                        self.method, **self.options)
+
     def single_potential(self, x, y, n, m, charge, coupling):
         lx = self.lx if self.lx is not None else 0.0
         ly = self.ly if self.ly is not None else 0.0
         d = torch.sqrt((x - self.x0 + n*lx)**2 + (y - self.y0 + m*ly)**2) #(m, n)
         values = coupling*self.charge*charge*torch.sum(1/d, axis=-1) #(m,)
         return values
-        
\ No newline at end of file
+
+    def single_force(self, x, y, n, m, charge, coupling):
+        lx = self.lx if self.lx is not None else 0.0
+        ly = self.ly if self.ly is not None else 0.0
+        dx = x[..., None] - self.x0 + n*lx #(m, n)
+        dy = y[..., None] - self.y0 + m*ly #(m, n)
+        d3 = ((dx**2 + dy**2)**1.5)
+        k = coupling*self.charge*charge
+        fx = k*torch.sum(dx/d3, axis=-1) #(m,)
+        fy = k*torch.sum(dy/d3, axis=-1) #(m,)
+        return fx, fy
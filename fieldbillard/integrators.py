@@ -2,11 +2,14 @@
 from typing import Optional, List, Callable
 import math
 import functools
+import warnings
 
 import torch
 
 from . import points
 from . import fields
+from . import utils
+from . import profiling
 
 
 class NonValidIntegratorError(Exception):
@@ -47,8 +50,10 @@ def sympletic_euler_step(dt: float, system: points.MovingPoints,
         raise NonValidIntegratorError("Method only valid without magnetostatics")
     _, dpxy = force_rhs(system, objects, coupling)
     with torch.no_grad():
-        system.pxy += dpxy*dt
-        system.xy += system.pxy*dt/system.mass
+        with profiling.phase(system.profiler, "kick"):
+            system.pxy += dpxy*dt
+        with profiling.phase(system.profiler, "drift"):
+            system.xy += system.pxy*dt/system.mass
 
 
 def sympletic_verlet_step(dt: float, system: points.MovingPoints,
@@ -86,13 +91,373 @@ def sympletic_verlet_step(dt: float, system: points.MovingPoints,
         raise NonValidIntegratorError("Method only valid without magnetostatics")
     _, dpxy = force_rhs(system, objects, coupling)
     with torch.no_grad():
-        system.pxy += 0.5*dpxy*dt
-        system.xy += system.pxy*dt/system.mass
+        with profiling.phase(system.profiler, "kick"):
+            system.pxy += 0.5*dpxy*dt
+        with profiling.phase(system.profiler, "drift"):
+            system.xy += system.pxy*dt/system.mass
     _, dpxy = force_rhs(system, objects, coupling)
-    with torch.no_grad():
+    with profiling.phase(system.profiler, "kick"), torch.no_grad():
         system.pxy += 0.5*dpxy*dt
 
 
+class SplittingIntegrator(object):
+    def __init__(self, sequence: List[tuple], order: int = 2):
+        """
+        Symplectic splitting method for separable hamiltonians, given as a
+        sequence of kick (momenta update by the force) and drift (positions update
+        by the velocity) substeps. The last evaluated force is cached, together
+        with a stamp of the positions version and of the interaction setup, and
+        reused by the next kick if the stamp still matches (first-same-as-last).
+
+        Parameters
+        ----------
+        sequence : List[tuple]
+            Substeps as ("kick" or "drift", fraction of dt) pairs.
+        order : int, optional
+            Order of the method, used by adaptive step size control. The default is 2.
+        """
+        self.sequence = merge_substeps(sequence)
+        self.order = order
+        self.reset()
+
+    def reset(self):
+        """Invalidates the cached force"""
+        self.stamp = None
+        self.force = None
+
+    def __call__(self, dt: float, system: points.MovingPoints,
+                 objects: Optional[List[fields.FieldObject]] = None,
+                 coupling: float = 1.0,
+                 darwin_coupling: Optional[float] = None):
+        """
+        
+        Parameters
+        ----------
+        dt : float
+            Step size.
+        system : points.MovingPoints
+            Moving points system to integrate.
+        objects : Optional[List[fields.FieldObject]], optional
+            List of external objects generating fields. The default is None.
+        coupling : float, optional
+            Coupling constant for system. The default is 1.0.
+        darwin_coupling : Optional[float], optional
+            Darwin lagrangian coupling constant for system. If None, Darwin term is not considered.
+            The default is None.
+
+        Raises
+        ------
+        NonValidIntegratorError
+            Is raised if hamiltonian contains darwin hamiltonian.
+
+        Returns
+        -------
+        None.
+
+        """
+        if darwin_coupling is not None:
+            raise NonValidIntegratorError("Method only valid without magnetostatics")
+        for kind, fraction in self.sequence:
+            if kind == "kick":
+                dpxy = self.cached_force(system, objects, coupling)
+                with profiling.phase(system.profiler, "kick"), torch.no_grad():
+                    system.pxy += fraction*dt*dpxy
+            else:
+                with profiling.phase(system.profiler, "drift"), torch.no_grad():
+                    system.xy += fraction*dt*system.pxy/system.mass
+
+    def cached_force(self, system, objects, coupling):
+        stamp = self.make_stamp(system, objects, coupling)
+        if self.stamp is None or self.stamp != stamp:
+            _, self.force = force_rhs(system, objects, coupling)
+            self.stamp = stamp
+        return self.force
+
+    def make_stamp(self, system, objects, coupling):
+        return force_stamp(system, objects, coupling)
+
+
+class SympleticVerletIntegrator(SplittingIntegrator):
+    def __init__(self):
+        """Velocity Verlet integrator, taking a single force evaluation per step"""
+        super().__init__([("kick", 0.5), ("drift", 1.0), ("kick", 0.5)])
+
+
+class RespaIntegrator(object):
+    def __init__(self, fast: str = "external", nsub: int = 4,
+                 inner: float = 0.1, outer: float = 0.2):
+        """
+        Reversible RESPA multiple time step integrator. The force is split into a
+        fast group, integrated with nsub velocity Verlet substeps, and a slow group,
+        whose half kicks wrap the substeps. Each group force is cached across
+        steps, as in SplittingIntegrator.
+
+        Parameters
+        ----------
+        fast : str, optional
+            Fast group, either "external" (field objects), "internal" (particle 
+            interactions) or "near" (smoothly switched near pairs, direct
+            images sums only). The slow group is the rest of the force.
+            The default is "external".
+        nsub : int, optional
+            Number of fast substeps per step. The default is 4.
+        inner : float, optional
+            Distance below which pairs are fully near, for fast group "near". 
+            The default is 0.1.
+        outer : float, optional
+            Distance above which pairs are fully far, for fast group "near".
+            The default is 0.2.
+        """
+        if fast not in ["external", "internal", "near"]:
+            raise ValueError("Force group not available")
+        self.fast = fast
+        self.nsub = nsub
+        self.inner = inner
+        self.outer = outer
+        self.order = 2
+        self.caches = {}
+
+    def reset(self):
+        """Invalidates the cached forces"""
+        self.caches = {}
+
+    def __call__(self, dt: float, system: points.MovingPoints,
+                 objects: Optional[List[fields.FieldObject]] = None,
+                 coupling: float = 1.0,
+                 darwin_coupling: Optional[float] = None):
+        """
+        
+        Parameters
+        ----------
+        dt : float
+            Step size.
+        system : points.MovingPoints
+            Moving points system to integrate.
+        objects : Optional[List[fields.FieldObject]], optional
+            List of external objects generating fields. The default is None.
+        coupling : float, optional
+            Coupling constant for system. The default is 1.0.
+        darwin_coupling : Optional[float], optional
+            Darwin lagrangian coupling constant for system. If None, Darwin term is not considered.
+            The default is None.
+
+        Raises
+        ------
+        NonValidIntegratorError
+            Is raised if hamiltonian contains darwin hamiltonian.
+
+        Returns
+        -------
+        None.
+
+        """
+        if darwin_coupling is not None:
+            raise NonValidIntegratorError("Method only valid without magnetostatics")
+        h = dt/self.nsub
+        with torch.no_grad():
+            system.pxy += 0.5*dt*self.group_force("slow", system, objects, coupling)
+            for _ in range(self.nsub):
+                system.pxy += 0.5*h*self.group_force("fast", system, objects, coupling)
+                system.xy += h*system.pxy/system.mass
+                system.pxy += 0.5*h*self.group_force("fast", system, objects, coupling)
+            system.pxy += 0.5*dt*self.group_force("slow", system, objects, coupling)
+
+    def group_force(self, group, system, objects, coupling):
+        stamp = force_stamp(system, objects, coupling)
+        if group in self.caches and self.caches[group][0] == stamp:
+            return self.caches[group][1]
+        xy = system.xy.detach()
+        if self.fast == "near":
+            force = system.switched_internal_force(xy, self.inner, self.outer,
+                                                   group == "fast", coupling)
+            if group == "slow":
+                force = force + system.external_force(xy, objects, coupling)
+        elif (group == "fast") == (self.fast == "external"):
+            force = system.external_force(xy, objects, coupling)
+        else:
+            force = system.internal_force(xy, coupling)
+        profiling.count(system.profiler, group + "_force_evaluations")
+        self.caches[group] = (stamp, force)
+        return force
+
+
+class GaussLegendreIntegrator(object):
+    def __init__(self, stages: int = 2, tol: Optional[float] = None,
+                 max_iterations: int = 50):
+        """
+        Implicit Gauss-Legendre collocation method, symplectic for any hamiltonian,
+        so also valid with the (non-separable) Darwin hamiltonian. The one stage
+        method is the implicit midpoint rule. Stage equations are solved by fixed
+        point iteration on the stage derivatives, warm started by extrapolating
+        the collocation polynomial of the previous step.
+
+        Parameters
+        ----------
+        stages : int, optional
+            Number of stages, either 1 (implicit midpoint, order 2) or 2 (order 4).
+            The default is 2.
+        tol : Optional[float], optional
+            Tolerance on the change of stage increments between iterations, relative
+            to the state magnitude. If None, is set from the state dtype.
+            The default is None.
+        max_iterations : int, optional
+            Maximum number of iterations per step, at least one. The default is 50.
+        """
+        if stages not in _GAUSS_LEGENDRE_TABLEAUS:
+            raise ValueError("Number of stages not available")
+        if max_iterations < 1:
+            raise ValueError("At least one iteration is needed")
+        self.a, self.b, self.c = _GAUSS_LEGENDRE_TABLEAUS[stages]
+        self.stages = stages
+        self.order = 2*stages
+        self.tol = tol
+        self.max_iterations = max_iterations
+        self.iterations = 0
+        self.reset()
+
+    def reset(self):
+        """Drops the warm start"""
+        self.stamp = None
+        self.slopes = None
+        self.last_dt = None
+
+    def __call__(self, dt: float, system: points.MovingPoints,
+                 objects: Optional[List[fields.FieldObject]] = None,
+                 coupling: float = 1.0,
+                 darwin_coupling: Optional[float] = None):
+        """
+        
+        Parameters
+        ----------
+        dt : float
+            Step size.
+        system : points.MovingPoints
+            Moving points system to integrate.
+        objects : Optional[List[fields.FieldObject]], optional
+            List of external objects generating fields. The default is None.
+        coupling : float, optional
+            Coupling constant for system. The default is 1.0.
+        darwin_coupling : Optional[float], optional
+            Darwin lagrangian coupling constant for system. If None, Darwin term is not considered.
+            The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        xy, pxy = system.xy.detach(), system.pxy.detach()
+        tol = self.tol if self.tol is not None else 100*torch.finfo(xy.dtype).eps
+        scale = tol*max(1.0, float(torch.max(torch.abs(xy))), float(torch.max(torch.abs(pxy))))
+
+        def slope(xy_stage, pxy_stage):
+            dhdxy, dhdpxy = closed_form_gradients(system, objects, coupling, darwin_coupling,
+                                                  xy_stage, pxy_stage)
+            return torch.stack([dhdpxy, -dhdxy]) #(2, ..., n, 2)
+
+        with torch.no_grad():
+            state = torch.stack([xy, pxy])
+            slopes = self.initial_slopes(system, dt, state, slope)
+            for iteration in range(self.max_iterations):
+                new_slopes = [slope(*(state + dt*sum(a*k for a, k in zip(row, slopes))))
+                              for row in self.a]
+                change = max(float(torch.max(torch.abs(new - old))) 
+                             for new, old in zip(new_slopes, slopes))
+                slopes = new_slopes
+                if dt*change <= scale:
+                    break
+            else:
+                warnings.warn("Implicit stage equations did not converge in %d iterations"
+                              % self.max_iterations)
+            self.iterations = iteration + 1
+            system.xy += dt*sum(b*k[0] for b, k in zip(self.b, slopes))
+            system.pxy += dt*sum(b*k[1] for b, k in zip(self.b, slopes))
+        self.slopes, self.last_dt = slopes, dt
+        self.stamp = state_stamp(system)
+
+    def initial_slopes(self, system, dt, state, slope):
+        stamp = state_stamp(system)
+        if self.stamp != stamp or self.slopes[0].shape != state.shape:
+            return [slope(*state)]*self.stages
+        #Lagrange extrapolation of the previous slopes, at the new stage times
+        #measured in units of the previous step, from its start
+        times = [1 + c*dt/self.last_dt for c in self.c]
+        slopes = []
+        for t in times:
+            weights = [math.prod((t - cm)/(cj - cm) for m, cm in enumerate(self.c) if m != j)
+                       for j, cj in enumerate(self.c)]
+            slopes.append(sum(w*k for w, k in zip(weights, self.slopes)))
+        return slopes
+
+
+_SQRT3 = math.sqrt(3)
+_GAUSS_LEGENDRE_TABLEAUS = {
+    1: ([[0.5]], [1.0], [0.5]),
+    2: ([[0.25, 0.25 - _SQRT3/6], [0.25 + _SQRT3/6, 0.25]], [0.5, 0.5],
+        [0.5 - _SQRT3/6, 0.5 + _SQRT3/6])
+}
+
+
+def verlet_composition(weights: List[float]):
+    """
+    Substeps of the composition of velocity Verlet steps with sizes weights*dt.
+
+    Parameters
+    ----------
+    weights : List[float]
+        Fractions of dt for each Verlet step.
+
+    Returns
+    -------
+    List[tuple]
+        Substeps as ("kick" or "drift", fraction of dt) pairs.
+
+    """
+    sequence = []
+    for weight in weights:
+        sequence += [("kick", weight/2), ("drift", weight), ("kick", weight/2)]
+    return merge_substeps(sequence)
+
+
+def alternating_substeps(first: str, fractions: List[float]):
+    """Substeps alternating between kick and drift, starting with first"""
+    other = "drift" if first == "kick" else "kick"
+    return [(first if i%2 == 0 else other, fraction)
+            for i, fraction in enumerate(fractions)]
+
+
+def merge_substeps(sequence):
+    merged = []
+    for kind, fraction in sequence:
+        if merged and merged[-1][0] == kind:
+            merged[-1] = (kind, merged[-1][1] + fraction)
+        else:
+            merged.append((kind, fraction))
+    return merged
+
+
+#Yoshida (1990) triple jump, order 4
+_YOSHIDA4_WEIGHTS = [1/(2 - 2**(1/3)), -2**(1/3)/(2 - 2**(1/3)), 1/(2 - 2**(1/3))]
+#Yoshida (1990) solution A, order 6
+_YOSHIDA6_WEIGHTS = [0.784513610477560, 0.235573213359357, -1.17767998417887,
+                     1 - 2*(0.784513610477560 + 0.235573213359357 - 1.17767998417887),
+                     -1.17767998417887, 0.235573213359357, 0.784513610477560]
+#Forest and Ruth (1990), order 4, drifts first
+_FOREST_RUTH_THETA = 1/(2 - 2**(1/3))
+_FOREST_RUTH_FRACTIONS = [_FOREST_RUTH_THETA/2, _FOREST_RUTH_THETA,
+                          (1 - _FOREST_RUTH_THETA)/2, 1 - 2*_FOREST_RUTH_THETA,
+                          (1 - _FOREST_RUTH_THETA)/2, _FOREST_RUTH_THETA,
+                          _FOREST_RUTH_THETA/2]
+#Blanes and Moan (2002) S6, order 4, with 6 stages
+_BM_A = [0.0792036964311957, 0.353172906049774, -0.0420650803577195]
+_BM_B = [0.209515106613362, -0.143851773179818]
+_BM_A.append(1 - 2*sum(_BM_A))
+_BM_B.append(0.5 - sum(_BM_B))
+_BLANES_MOAN_FRACTIONS = [_BM_A[0], _BM_B[0], _BM_A[1], _BM_B[1], _BM_A[2], _BM_B[2],
+                          _BM_A[3],
+                          _BM_B[2], _BM_A[2], _BM_B[1], _BM_A[1], _BM_B[0], _BM_A[0]]
+
+
 def tao_step(dt: float, system: points.MovingPoints,
              objects: Optional[List[fields.FieldObject]] = None,
              coupling: float = 1.0,
@@ -129,13 +494,33 @@ def tao_step(dt: float, system: points.MovingPoints,
     operator_ha(system, objects, coupling, darwin_coupling, dt/2)
 
 
-def get_integrator(name):
+INTEGRATORS = {}
+
+
+def register_integrator(name: str, factory: Callable):
     """
 
     Parameters
     ----------
     name : str
-        Name of integrator.
+        Name of integrator, in lower case.
+    factory : Callable
+        Function of keyword options returning an integrator step function, 
+        called on each get_integrator, so that stateful integrators are not shared.
+
+    """
+    INTEGRATORS[name] = factory
+
+
+def get_integrator(name, **options):
+    """
+
+    Parameters
+    ----------
+    name : str
+        Name of integrator. Tao integrators may also be named "tao<omega>", as in "tao20".
+    **options :
+        Integrator options (omega for "tao").
 
     Raises
     ------
@@ -148,35 +533,204 @@ def get_integrator(name):
         Integrator step function.
 
     """
-    if name == "sympleticverlet":
-        return sympletic_verlet_step
-    elif name == "sympleticeuler":
-        return sympletic_euler_step
-    elif name == "tao20":
-        return functools.partial(tao_step, omega=20.0)
-    elif name == "tao80":
-        return functools.partial(tao_step, omega=80.0)
-    elif name == "tao320":
-        return functools.partial(tao_step, omega=320.0)
-    else:
+    if name not in INTEGRATORS and name[:3] == "tao":
+        try:
+            options["omega"] = float(name[3:])
+        except ValueError:
+            raise ValueError("Integrator not available")
+        name = "tao"
+    if name not in INTEGRATORS:
         raise ValueError("Integrator not available")
-        
+    return INTEGRATORS[name](**options)
+
+
+register_integrator("sympleticeuler", lambda: sympletic_euler_step)
+register_integrator("sympleticverlet", SympleticVerletIntegrator)
+register_integrator("yoshida4",
+                    lambda: SplittingIntegrator(verlet_composition(_YOSHIDA4_WEIGHTS), 4))
+register_integrator("yoshida6",
+                    lambda: SplittingIntegrator(verlet_composition(_YOSHIDA6_WEIGHTS), 6))
+register_integrator("forestruth",
+                    lambda: SplittingIntegrator(alternating_substeps("drift",
+                                                                     _FOREST_RUTH_FRACTIONS), 4))
+register_integrator("blanesmoan",
+                    lambda: SplittingIntegrator(alternating_substeps("drift",
+                                                                     _BLANES_MOAN_FRACTIONS), 4))
+register_integrator("respa", RespaIntegrator)
+register_integrator("implicitmidpoint", lambda **options: GaussLegendreIntegrator(1, **options))
+register_integrator("gausslegendre", GaussLegendreIntegrator)
+register_integrator("tao", lambda omega=20.0: functools.partial(tao_step, omega=omega))
+
+
+def functional_step(integrator: Callable, system: points.MovingPoints,
+                    objects: Optional[List[fields.FieldObject]] = None,
+                    coupling: float = 1.0,
+                    darwin_coupling: Optional[float] = None):
+    """
+    Pure function version of an integrator step, acting on (xy, pxy) tensors
+    instead of updating the system in place, so that it can be compiled.
+
+    Parameters
+    ----------
+    integrator : Callable
+        Integrator step function, as returned by get_integrator.
+    system : points.MovingPoints
+        Moving points system to integrate.
+    objects : Optional[List[fields.FieldObject]], optional
+        List of external objects generating fields. The default is None.
+    coupling : float, optional
+        Coupling constant for system. The default is 1.0.
+    darwin_coupling : Optional[float], optional
+        Darwin lagrangian coupling constant for system. If None, Darwin term is not considered.
+        The default is None.
+
+    Returns
+    -------
+    Optional[Callable]
+        Function of (xy, pxy, force, dt) returning the stepped (xy, pxy, force, stale),
+        with periodic wrap around included, where force is the force at xy
+        (as from system.potential_force). Carrying it over reuses the last force
+        of a step as the first one of the next (first-same-as-last). As the
+        force may have been evaluated before the wrap, stale is a boolean tensor,
+        true when some position was wrapped after it, in which case the force
+        must be evaluated again (or None if it cannot happen). Testing it is left
+        to the caller, so that a compiled step holds no data-dependent branch.
+        None if the integrator has no such form (non-separable hamiltonian or
+        autograd based integrators).
+
+    """
+    if darwin_coupling is not None:
+        return None
+    mass = system.mass
+
+    def force_at(xy):
+        return system.potential_force(xy, objects, coupling)
+
+    def wrap(xy):
+        #As system.wrap_around, only positions out of the box are moved
+        outside = torch.zeros_like(xy, dtype=torch.bool)
+        for i, (length, center) in enumerate(zip([system.lx, system.ly], [system.cx, system.cy])):
+            if length is not None:
+                centered = xy[..., i] - center
+                outside[..., i] = (centered < -length/2) | (centered >= length/2)
+        wrapped = utils.wrap_from_center(xy, [system.lx, system.ly], [system.cx, system.cy])
+        return torch.where(outside, wrapped, xy), torch.any(outside)
+
+    if integrator is sympletic_euler_step:
+        sequence = [("kick", 1.0), ("drift", 1.0)]
+    elif integrator is sympletic_verlet_step:
+        sequence = [("kick", 0.5), ("drift", 1.0), ("kick", 0.5)]
+    elif isinstance(integrator, SplittingIntegrator):
+        sequence = integrator.sequence
+    else:
+        return None
+
+    def step(xy, pxy, force, dt):
+        for kind, fraction in sequence:
+            if kind == "kick":
+                if force is None:
+                    force = force_at(xy)
+                pxy = pxy + fraction*dt*force
+            else:
+                xy = xy + fraction*dt*pxy/mass
+                force = None
+        stale = None
+        if system.periodic:
+            xy, stale = wrap(xy)
+        if force is None: #Evaluated after the wrap, so never stale
+            return xy, pxy, force_at(xy), None
+        return xy, pxy, force, stale
+    return step
+
+
+def force_stamp(system, objects, coupling):
+    """Stamp of positions and interaction setup, for checking whether cached forces are valid"""
+    #Any in-place change of positions (or of tensor charges) bumps their tensor version,
+    #and field objects stamp their own attributes
+    objects = tuple(obj.stamp() for obj in objects) if objects is not None else ()
+    return (id(system), system.xy._version, _value_stamp(system.charge), objects, coupling,
+            system.lx, system.ly, system.nper, system.tile_size, system.backend, system.theta,
+            system.periodic_method, system.periodic_options)
+
+
+def _value_stamp(value):
+    #Tensors are compared by identity and version, as their equality is elementwise
+    return (id(value), value._version) if torch.is_tensor(value) else value
+
+
+def state_stamp(system):
+    """Stamp of positions and momenta, for checking whether cached states are valid"""
+    return (id(system), system.xy._version, system.pxy._version)
+
+
+def cache_stamps(system, objects, coupling):
+    """Current stamps of each kind, for carrying cached states over with restamp"""
+    return {"force": force_stamp(system, objects, coupling), "state": state_stamp(system)}
+
+
+def restamp(component, old, new):
+    """
+    Rebinds the cached states of an integrator or stepper, stamped as of
+    cache_stamps old, to the stamps new of another system in the same state
+    (as one loaded from a checkpoint). States not valid for old are dropped.
+    """
+    def rebound(stamp):
+        for kind, old_stamp in old.items():
+            if stamp == old_stamp:
+                return new[kind]
+        return None
+    if getattr(component, "stamp", None) is not None:
+        component.stamp = rebound(component.stamp)
+    if getattr(component, "caches", None):
+        component.caches = {group: (rebound(stamp), force)
+                            for group, (stamp, force) in component.caches.items()}
+
 
 def hamiltonian_gradients(system, objects, coupling, darwin_coupling=None,
-                          dummy_q=False, dummy_p=False):
-    system.zero_grad()
+                          dummy_q=False, dummy_p=False, analytic=True):
+    if analytic and not system.periodic:
+        xy = system.xy if not dummy_q else system.xy_dummy
+        pxy = system.pxy if not dummy_p else system.pxy_dummy
+        return closed_form_gradients(system, objects, coupling, darwin_coupling, xy, pxy)
+    profiler = system.profiler
+    with profiling.phase(profiler, "zero_grad"):
+        system.zero_grad()
     hamiltonian = system.hamiltonian(objects, coupling, darwin_coupling,
                                      dummy_q, dummy_p)
-    hamiltonian.backward()
+    with profiling.phase(profiler, "backward"):
+        hamiltonian.sum().backward() #Replicas are independent
+    profiling.count(profiler, "force_evaluations")
     dhdxy = system.xy.grad if not dummy_q else system.xy_dummy.grad
     dhdpxy = system.pxy.grad if not dummy_p else system.pxy_dummy.grad
     return dhdxy, dhdpxy
 
 
-def force_rhs(system, objects, coupling):
-    system.zero_grad()
+def closed_form_gradients(system, objects, coupling, darwin_coupling, xy, pxy):
+    """Gradients of the hamiltonian on positions and momenta, at given (xy, pxy), without autograd"""
+    with torch.no_grad():
+        xy, pxy = xy.detach(), pxy.detach()
+        if isinstance(darwin_coupling, float):
+            _, dhdxy, dhdpxy = system.darwin_gradients(xy, pxy, objects, coupling,
+                                                       darwin_coupling)
+        else:
+            dhdxy = -system.potential_force(xy, objects, coupling)
+            dhdpxy = pxy/system.mass
+    return dhdxy, dhdpxy
+
+
+def force_rhs(system, objects, coupling, analytic=True):
+    if analytic:
+        with torch.no_grad():
+            xy_rhs = system.pxy.detach()/system.mass
+            pxy_rhs = system.potential_force(system.xy.detach(), objects, coupling)
+        return xy_rhs, pxy_rhs
+    profiler = system.profiler
+    with profiling.phase(profiler, "zero_grad"):
+        system.zero_grad()
     potential_energy = system.potential_energy(objects, coupling)
-    potential_energy.backward()
+    with profiling.phase(profiler, "backward"):
+        potential_energy.sum().backward() #Replicas are independent
+    profiling.count(profiler, "force_evaluations")
     xy_rhs = system.pxy.detach()/system.mass
     pxy_rhs = -system.xy.grad
     return xy_rhs, pxy_rhs
@@ -185,7 +739,7 @@ def force_rhs(system, objects, coupling):
 def operator_ha(system, objects, coupling, darwin_coupling, delta):
     dhdq, dhdy = hamiltonian_gradients(system, objects, coupling, darwin_coupling,
                                        False, True)
-    with torch.no_grad():
+    with profiling.phase(system.profiler, "kick"), torch.no_grad():
         system.pxy -= delta*dhdq
         system.xy_dummy += delta*dhdy
     #return q, p - delta*dhdq, x + delta*dhdy, y
@@ -194,21 +748,33 @@ def operator_ha(system, objects, coupling, darwin_coupling, delta):
 def operator_hb(system, objects, coupling, darwin_coupling, delta):
     dhdx, dhdp = hamiltonian_gradients(system, objects, coupling, darwin_coupling,
                                        True, False)
-    with torch.no_grad():
+    with profiling.phase(system.profiler, "drift"), torch.no_grad():
         system.xy += delta*dhdp
         system.pxy_dummy -= delta*dhdx
 
 
-def operator_whc(system, omega, delta):
-    #Don't mind the notation in the next code
-    with torch.no_grad():
+def operator_whc(system, omega, delta, workspace=None):
+    cos, sin = math.cos(2*omega*delta), math.sin(2*omega*delta)
+    return rotate_extended(system, cos, sin, workspace)
+
+
+def rotate_extended(system, cos, sin, workspace=None):
+    """
+    Rotation of operator_whc, for precomputed cos and sin of 2*omega*delta, 
+    done in place with three state sized temporaries (from workspace if given).
+    With u = (q - x)*cos + (p - y)*sin and v = (p - y)*cos - (q - x)*sin,
+    the new states are (q + x ± u)/2 and (p + y ± v)/2.
+    """
+    with profiling.phase(system.profiler, "rotate"), torch.no_grad():
         q, p, x, y = system.xy, system.pxy, system.xy_dummy, system.pxy_dummy
-        qnew = 0.5*(q + x + (q - x)*math.cos(2*omega*delta) + (p - y)*math.sin(2*omega*delta))
-        pnew = 0.5*(p + y + (p - y)*math.cos(2*omega*delta) - (q - x)*math.sin(2*omega*delta))
-        xnew = 0.5*(q + x - (q - x)*math.cos(2*omega*delta) - (p - y)*math.sin(2*omega*delta))
-        ynew = 0.5*(p + y - (p - y)*math.cos(2*omega*delta) + (q - x)*math.sin(2*omega*delta))
-        system.xy.copy_(qnew)
-        system.pxy.copy_(pnew)
-        system.xy_dummy.copy_(xnew)
-        system.pxy_dummy.copy_(ynew)
-    return qnew, pnew, xnew, ynew
+        dq, dp, u = [utils.scratch(workspace, name, q.shape, q.dtype)
+                     for name in ("rotation_dq", "rotation_dp", "rotation_u")]
+        torch.sub(q, x, out=dq)
+        torch.sub(p, y, out=dp)
+        torch.mul(dq, cos, out=u).add_(dp, alpha=sin)
+        v = dq.mul_(-sin).add_(dp, alpha=cos)
+        q.add_(x).add_(u).mul_(0.5)
+        x.copy_(q).sub_(u)
+        p.add_(y).add_(v).mul_(0.5)
+        y.copy_(p).sub_(v)
+    return q, p, x, y
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+import functools
+
+import torch
+
+from . import utils
+
+
+DEFAULT_TILE_SIZE = 1024
+
+
+def pair_sum(kernel, xy, features=(), tile_size=DEFAULT_TILE_SIZE):
+    """
+    Sums of kernel values over unordered pairs i < j, evaluated in tiles of rows,
+    so that memory is O(n*tile_size) and self-pairs are never evaluated.
+
+    Parameters
+    ----------
+    kernel : Callable
+        Function of (dx, dy, features_i, features_j), with (dx, dy) = xy_i - xy_j,
+        returning a tuple of per-pair values.
+    xy : torch.Tensor
+        Positions, of shape (..., n, 2).
+    features : tuple, optional
+        Per-particle tensors of shape (..., n), gathered for each side of the pair.
+        The default is ().
+    tile_size : int, optional
+        Number of rows per tile. The default is DEFAULT_TILE_SIZE.
+
+    Returns
+    -------
+    List[torch.Tensor]
+        Sums of each kernel value, of shape (...,).
+
+    """
+    sums = None
+    for dx, dy, features_i, features_j, pair_dims, _ in _pair_blocks(xy, features, tile_size):
+        values = kernel(dx, dy, features_i, features_j)
+        block_sums = [torch.sum(value, dim=pair_dims) for value in values]
+        sums = block_sums if sums is None else [a + b for a, b in zip(sums, block_sums)]
+    return sums
+
+
+def pair_accumulate(kernel, xy, features=(), nvectors=1, tile_size=DEFAULT_TILE_SIZE):
+    """
+    Sums of per-pair values, and accumulations of per-pair vectors on each side
+    of the pair, over unordered pairs i < j, evaluated in tiles of rows.
+    Vector components are reduced as soon as the kernel yields them, so that
+    kernels may build them in a single reused buffer.
+
+    Parameters
+    ----------
+    kernel : Callable
+        Function of (dx, dy, features_i, features_j), with (dx, dy) = xy_i - xy_j,
+        returning (values, vectors), with values a tuple of per-pair values, and
+        vectors an iterable of (slot, component, vector, (sign_i, sign_j)), with
+        vector a per-pair component added to the given slot, times sign_i on i and
+        times sign_j on j. A zero sign skips that side.
+    xy : torch.Tensor
+        Positions, of shape (..., n, 2).
+    features : tuple, optional
+        Per-particle tensors of shape (..., n), gathered for each side of the pair.
+        The default is ().
+    nvectors : int, optional
+        Number of vector slots. The default is 1.
+    tile_size : int, optional
+        Number of rows per tile. The default is DEFAULT_TILE_SIZE.
+
+    Returns
+    -------
+    sums : List[torch.Tensor]
+        Sums of each value, of shape (...,).
+    accumulations : List[torch.Tensor]
+        Accumulations on each slot, of shape (..., n, 2).
+
+    """
+    n = xy.shape[-2]
+    sums = None
+    accumulations = [torch.zeros_like(xy) for _ in range(nvectors)]
+    for dx, dy, features_i, features_j, pair_dims, (start, stop, rows, cols) in \
+            _pair_blocks(xy, features, tile_size):
+        values, vectors = kernel(dx, dy, features_i, features_j)
+        block_sums = [torch.sum(value, dim=pair_dims) for value in values]
+        sums = block_sums if sums is None else [a + b for a, b in zip(sums, block_sums)]
+        #Triangles are scattered to a dense upper triangle, so that all blocks reduce
+        #by row sums on start:stop and column sums on column_start:column_stop
+        column_start, column_stop = (start, stop) if rows is not None else (stop, n)
+        for slot, k, vector, (sign_i, sign_j) in vectors:
+            if rows is not None:
+                vector = _dense_triangle(vector, start, stop, rows, cols)
+            if sign_i:
+                accumulations[slot][..., start:stop, k] += sign_i*torch.sum(vector, dim=-1)
+            if sign_j:
+                accumulations[slot][..., column_start:column_stop, k] += sign_j*torch.sum(vector, dim=-2)
+    return sums, accumulations
+
+
+def pair_min(kernel, xy, features=(), tile_size=DEFAULT_TILE_SIZE):
+    """
+    Minimums of kernel values over unordered pairs i < j, evaluated in tiles of rows.
+
+    Parameters
+    ----------
+    kernel : Callable
+        Function of (dx, dy, features_i, features_j), with (dx, dy) = xy_i - xy_j,
+        returning a tuple of per-pair values.
+    xy : torch.Tensor
+        Positions, of shape (..., n, 2).
+    features : tuple, optional
+        Per-particle tensors of shape (..., n), gathered for each side of the pair.
+        The default is ().
+    tile_size : int, optional
+        Number of rows per tile. The default is DEFAULT_TILE_SIZE.
+
+    Returns
+    -------
+    List[torch.Tensor]
+        Minimums of each kernel value, of shape (...,). Infinite if there are no pairs.
+
+    """
+    mins = None
+    for dx, dy, features_i, features_j, pair_dims, _ in _pair_blocks(xy, features, tile_size):
+        if dx.shape[-1] == 0: #Single particle tile
+            continue
+        values = kernel(dx, dy, features_i, features_j)
+        block_mins = [torch.amin(value, dim=pair_dims) for value in values]
+        mins = block_mins if mins is None else [torch.minimum(a, b) for a, b in zip(mins, block_mins)]
+    if mins is None:
+        return [torch.full(xy.shape[:-2], float("inf"), dtype=xy.dtype)]
+    return mins
+
+
+def pair_forces(kernel, xy, features=(), tile_size=DEFAULT_TILE_SIZE,
+                out=None, workspace=None):
+    """
+    Accumulates pair forces over unordered pairs i < j, evaluated in tiles of rows.
+    The kernel force acts on i, and its opposite acts on j.
+
+    Parameters
+    ----------
+    kernel : Callable
+        Function of (dx, dy, features_i, features_j), with (dx, dy) = xy_i - xy_j,
+        returning per-pair force (fx, fy) on i.
+    xy : torch.Tensor
+        Positions, of shape (..., n, 2).
+    features : tuple, optional
+        Per-particle tensors of shape (..., n), gathered for each side of the pair.
+        The default is ().
+    tile_size : int, optional
+        Number of rows per tile. The default is DEFAULT_TILE_SIZE.
+    out : Optional[torch.Tensor], optional
+        Tensor of shape (..., n, 2) where forces are written. The default is None.
+    workspace : Optional[utils.Workspace], optional
+        Workspace holding the tile differences and reductions, which are then
+        reused across calls. The default is None.
+
+    Returns
+    -------
+    torch.Tensor
+        Forces, of shape (..., n, 2).
+
+    """
+    forces = torch.zeros_like(xy) if out is None else out.zero_()
+    for dx, dy, features_i, features_j, _, (start, stop, rows, cols) in \
+            _pair_blocks(xy, features, tile_size, workspace):
+        for k, pair_force in enumerate(kernel(dx, dy, features_i, features_j)):
+            if rows is not None: #Triangle within the tile
+                forces[..., k].index_add_(-1, rows, pair_force)
+                forces[..., k].index_add_(-1, cols, pair_force, alpha=-1)
+            else: #Rectangle to the right of the tile
+                row_sums = utils.scratch(workspace, "row_sums", pair_force.shape[:-1],
+                                         pair_force.dtype)
+                column_sums = utils.scratch(workspace, "column_sums",
+                                            pair_force.shape[:-2] + pair_force.shape[-1:],
+                                            pair_force.dtype)
+                forces[..., start:stop, k] += torch.sum(pair_force, dim=-1, out=row_sums)
+                forces[..., stop:, k] -= torch.sum(pair_force, dim=-2, out=column_sums)
+    return forces
+
+
+def target_forces(kernel, xy, index, features=(), tile_size=DEFAULT_TILE_SIZE):
+    """
+    Accumulates pair forces on the targets xy[..., index, :] from all other
+    particles, evaluated in tiles of targets. Used when only some particles
+    need their forces, so that Newton's third law does not apply.
+
+    Parameters
+    ----------
+    kernel : Callable
+        Function of (dx, dy, features_i, features_j), with (dx, dy) = xy_i - xy_j,
+        returning per-pair force (fx, fy) on i.
+    xy : torch.Tensor
+        Positions, of shape (..., n, 2).
+    index : torch.Tensor
+        Target indexes, of shape (m,).
+    features : tuple, optional
+        Per-particle tensors of shape (..., n), gathered for each side of the pair.
+        The default is ().
+    tile_size : int, optional
+        Number of targets per tile. The default is DEFAULT_TILE_SIZE.
+
+    Returns
+    -------
+    torch.Tensor
+        Forces on targets, of shape (..., m, 2).
+
+    """
+    forces = [torch.zeros(*xy.shape[:-2], 0, 2, dtype=xy.dtype)]
+    for dx, dy, features_i, features_j, self_pairs in _target_blocks(xy, index, features, tile_size):
+        fx, fy = kernel(dx, dy, features_i, features_j)
+        zero = torch.zeros((), dtype=xy.dtype)
+        fx, fy = torch.where(self_pairs, zero, fx), torch.where(self_pairs, zero, fy)
+        forces.append(torch.stack([torch.sum(fx, dim=-1), torch.sum(fy, dim=-1)], dim=-1))
+    return torch.cat(forces, dim=-2)
+
+
+def target_min(kernel, xy, index, features=(), tile_size=DEFAULT_TILE_SIZE):
+    """
+    Minimums of kernel values over pairs of the targets xy[..., index, :] with
+    all other particles, evaluated in tiles of targets.
+
+    Parameters
+    ----------
+    kernel : Callable
+        Function of (dx, dy, features_i, features_j), with (dx, dy) = xy_i - xy_j,
+        returning per-pair values.
+    xy : torch.Tensor
+        Positions, of shape (..., n, 2).
+    index : torch.Tensor
+        Target indexes, of shape (m,).
+    features : tuple, optional
+        Per-particle tensors of shape (..., n), gathered for each side of the pair.
+        The default is ().
+    tile_size : int, optional
+        Number of targets per tile. The default is DEFAULT_TILE_SIZE.
+
+    Returns
+    -------
+    torch.Tensor
+        Minimums on targets, of shape (..., m). Infinite if there are no other particles.
+
+    """
+    mins = [torch.zeros(*xy.shape[:-2], 0, dtype=xy.dtype)]
+    for dx, dy, features_i, features_j, self_pairs in _target_blocks(xy, index, features, tile_size):
+        value = kernel(dx, dy, features_i, features_j)
+        value = torch.where(self_pairs, torch.full((), float("inf"), dtype=xy.dtype), value)
+        mins.append(torch.amin(value, dim=-1))
+    return torch.cat(mins, dim=-1)
+
+
+def _triangle_indexes(start, stop):
+    """Pairs i < j within start:stop, cached so that tiles do not rebuild them"""
+    if utils.is_compiling(): #Compiled graphs hold them as constants instead
+        return torch.triu_indices(stop - start, stop - start, 1) + start
+    return _cached_triangle_indexes(start, stop)
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_triangle_indexes(start, stop):
+    return torch.triu_indices(stop - start, stop - start, 1) + start
+
+
+def _dense_triangle(values, start, stop, rows, cols):
+    dense = torch.zeros(*values.shape[:-1], stop - start, stop - start, dtype=values.dtype)
+    dense[..., rows - start, cols - start] = values
+    return dense
+
+
+def _pair_blocks(xy, features, tile_size, workspace=None):
+    #Coordinates are kept as separate planes, which is faster than (..., 2) differences
+    n = xy.shape[-2]
+    x, y = xy[..., 0], xy[..., 1]
+    for start in range(0, n, tile_size):
+        stop = min(start + tile_size, n)
+        rows, cols = _triangle_indexes(start, stop)
+        yield (_gathered_differences(x, rows, cols, workspace, "dx"), #(..., p)
+               _gathered_differences(y, rows, cols, workspace, "dy"),
+               [f[..., rows] for f in features],
+               [f[..., cols] for f in features],
+               (-1,), (start, stop, rows, cols))
+        if stop < n:
+            yield (_rectangle_differences(x, start, stop, workspace, "dx"), #(..., t, n - stop)
+                   _rectangle_differences(y, start, stop, workspace, "dy"),
+                   [f[..., start:stop, None] for f in features],
+                   [f[..., None, stop:] for f in features],
+                   (-2, -1), (start, stop, None, None))
+
+
+def _gathered_differences(x, rows, cols, workspace, name):
+    #Without workspace, out= variants are avoided, as they do not support autograd
+    if workspace is None:
+        return x[..., rows] - x[..., cols]
+    shape = x.shape[:-1] + rows.shape
+    differences = torch.index_select(x, -1, rows, out=workspace.block(name, shape, x.dtype))
+    gathered = torch.index_select(x, -1, cols, out=workspace.block(name + "_gathered", shape,
+                                                                    x.dtype))
+    return differences.sub_(gathered)
+
+
+def _rectangle_differences(x, start, stop, workspace, name):
+    if workspace is None:
+        return x[..., start:stop, None] - x[..., None, stop:]
+    shape = x.shape[:-1] + (stop - start, x.shape[-1] - stop)
+    return torch.sub(x[..., start:stop, None], x[..., None, stop:],
+                     out=workspace.block(name, shape, x.dtype))
+
+
+def _target_blocks(xy, index, features, tile_size):
+    n = xy.shape[-2]
+    x, y = xy[..., 0], xy[..., 1]
+    sources = torch.arange(n)
+    for start in range(0, index.shape[0], tile_size):
+        rows = index[start:start + tile_size]
+        yield (x[..., rows, None] - x[..., None, :], #(..., t, n)
+               y[..., rows, None] - y[..., None, :],
+               [f[..., rows, None] for f in features],
+               [f[..., None, :] for f in features],
+               rows[:, None] == sources) #(t, n)
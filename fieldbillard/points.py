@@ -8,6 +8,14 @@ import torch
 
 from . import utils
 from . import fields
+from . import treecode
+from . import ewald
+from . import pairwise
+from . import profiling
+
+
+#Darwin gradients keep several (tile, n) blocks alive, so smaller tiles stay in cache
+DARWIN_TILE_SIZE = 128
 
 
 class MovingPoints(torch.nn.Module):
@@ -15,14 +23,15 @@ class MovingPoints(torch.nn.Module):
                  px: Optional[torch.Tensor] = None, py: Optional[torch.Tensor]=None,
                  mass: float = 1.0, charge: float = 1.0, 
                  lx: Optional[float] = None, ly: Optional[float] = None,
-                 cx: Optional[float] = 0.0, cy: Optional[float] = 0.0):
+                 cx: Optional[float] = 0.0, cy: Optional[float] = 0.0,
+                 backend: str = "direct", theta: float = 0.5):
         """
         Parameters
         ----------
         x : torch.Tensor
-            position x-coordinate.
+            position x-coordinate, of shape (n,), or (b, n) for a batch of b replicas.
         y : torch.Tensor
-            position y-coordinate.
+            position y-coordinate, of shape (n,), or (b, n) for a batch of b replicas.
         px : Optional[torch.Tensor], optional
             Generalized momenta x-coordinate. Defaults to zero if None. The default is None.
         py : Optional[torch.Tensor], optional
@@ -39,6 +48,11 @@ class MovingPoints(torch.nn.Module):
             Blablabla    
         cy : Optional[float], optional
             Blablabla    
+        backend : str, optional
+            Particle interactions backend, either "direct" (dense pairwise sum)
+            or "tree" (Barnes-Hut quadtree). The default is "direct".
+        theta : float, optional
+            Opening angle for the "tree" backend. The default is 0.5.
         """
         super().__init__()
         x = x #(n, )
@@ -55,6 +69,10 @@ class MovingPoints(torch.nn.Module):
         self.cx = cx
         self.cy = cy
         self.nper = 1
+        self.tile_size = pairwise.DEFAULT_TILE_SIZE
+        self.profiler = None #profiling.Profiler, set by NBodySystem.set_profiling
+        self.set_backend(backend, theta)
+        self.set_periodic_method("images")
         
     def hamiltonian(self, objects: Optional[List[fields.FieldObject]] = None,
                     coupling: float = 1.0, darwin_coupling: Optional[float] = None,
@@ -80,7 +98,7 @@ class MovingPoints(torch.nn.Module):
         Returns
         -------
         torch.Tensor
-            Resulting hamiltonian.
+            Resulting hamiltonian, of shape (b,) for a batch of b replicas.
 
         """
         xy = self.xy if not dummy_q else self.xy_dummy
@@ -111,7 +129,7 @@ class MovingPoints(torch.nn.Module):
         Returns
         -------
         torch.Tensor
-            Resulting hamiltonian.
+            Resulting potential energy, of shape (b,) for a batch of b replicas.
 
         """
         xy = self.xy if not dummy_q else self.xy_dummy
@@ -119,41 +137,70 @@ class MovingPoints(torch.nn.Module):
 
     def kinetic_energy(self, pxy):
         """Calculates kinetic energy term (for separable hamiltonian)"""
-        energy = 1/(2*self.mass)*torch.sum(pxy**2)
+        energy = 1/(2*self.mass)*torch.sum(pxy**2, dim=(-2, -1))
         return energy
     
+    def set_backend(self, backend, theta=None):
+        if backend not in ["direct", "tree"]:
+            raise ValueError("Backend not available")
+        self.backend = backend
+        if theta is not None:
+            self.theta = theta
+
+    def set_periodic_method(self, method, **options):
+        if method not in ["images", "ewald", "mesh"]:
+            raise ValueError("Periodic method not available")
+        self.periodic_method = method
+        self.periodic_options = options
+
     def internal_energy(self, xy, coupling=1.0):
         """Calculates particle interactions term (for separate hamiltonian)"""
-        if self.periodic:
-            return self.periodic_internal_energy(xy, coupling)
-        else:
-            dists = torch.cdist(xy, xy) + utils.diagonal_mask(self.dim)
-            energies = coupling*self.charge**2/dists
-            energy = torch.sum(energies)        
-            return energy
+        with profiling.phase(self.profiler, "internal_energy"):
+            if self.backend == "tree":
+                self._assert_tree_backend()
+                return treecode.tree_internal_energy(xy, self.charge, coupling, self.theta)
+            if self.periodic:
+                return self.periodic_internal_energy(xy, coupling)
+            else:
+                return self.images_internal_energy(xy, [(0, 0)], coupling)
 
     def periodic_internal_energy(self, xy, coupling=1.0):
-        xiterator = list(range(-self.nper, self.nper + 1)) if self.lx is not None else [0]
-        yiterator = list(range(-self.nper, self.nper + 1)) if self.ly is not None else [0]
-        iterator = itertools.product(xiterator, yiterator)
-        energies = [self.dislocated_internal_energy(xy, n, m, coupling) 
-                    for n, m in iterator]
-        energy = sum(energies)
-        return energy
+        if self.periodic_method != "images":
+            potential, _ = self.periodic_sum(xy)
+            return coupling*self.charge**2*torch.sum(potential, dim=-1)
+        return self.images_internal_energy(xy, self.images(), coupling)
 
     def dislocated_internal_energy(self, xy, n=0, m=0, coupling=1.0):
-        xy_dis = self.dislocate_xy(xy, n, m)
-        dists = torch.cdist(xy, xy_dis) + utils.diagonal_mask(self.dim)
-        energies = coupling*self.charge**2/dists
-        energy = torch.sum(energies)        
-        return energy
+        #Sum over i != j of image (n, m) equals sum over i < j of images (n, m) and (-n, -m)
+        if (n, m) == (0, 0):
+            return self.images_internal_energy(xy, [(0, 0)], coupling)
+        return 0.5*self.images_internal_energy(xy, [(n, m), (-n, -m)], coupling)
+
+    def images_internal_energy(self, xy, images, coupling=1.0):
+        """
+        Calculates sum of interactions over ordered pairs i != j and images,
+        evaluating each unordered pair once. Images must be symmetric.
+        """
+        shifts = self.image_shifts(images)
+        def kernel(dx, dy, *_):
+            return (sum(torch.rsqrt((dx - sx)**2 + (dy - sy)**2) for sx, sy in shifts),)
+        energy, = pairwise.pair_sum(kernel, xy, tile_size=self.tile_size)
+        return 2*coupling*self.charge**2*energy
+
+    def images(self):
+        xiterator = list(range(-self.nper, self.nper + 1)) if self.lx is not None else [0]
+        yiterator = list(range(-self.nper, self.nper + 1)) if self.ly is not None else [0]
+        return list(itertools.product(xiterator, yiterator))
 
     def external_energy(self, xy, objects=None, coupling=1.0):
         """Calculates external field term"""
         if objects is None:
             return 0.0
         x, y = xy[..., 0], xy[..., 1]
-        energy = sum([obj.potential(x, y, self.charge, coupling).sum() for obj in objects])
+        energy = 0
+        for obj in objects:
+            with profiling.phase(self.profiler, "potential:" + type(obj).__name__):
+                energy = energy + obj.potential(x, y, self.charge, coupling).sum(dim=-1)
         # energies = torch.stack([obj.potential(x, y, self.charge, coupling) for obj in objects])
         # energy = torch.sum(energies)
         return energy
@@ -161,44 +208,288 @@ class MovingPoints(torch.nn.Module):
     def potential_energy_(self, xy, objects=1.0, coupling=1.0):
         """Calculates potential energy term (for separable hamiltonian)"""
         return self.internal_energy(xy, coupling) + self.external_energy(xy, objects, coupling)
+
+    def internal_force(self, xy, coupling=1.0, out=None, workspace=None):
+        """
+        Calculates minus gradient of particle interactions term, in closed form.
+        Written to out if given, with direct images sums then taking their
+        temporaries from workspace.
+        """
+        with profiling.phase(self.profiler, "internal_force"):
+            if self.backend == "tree":
+                self._assert_tree_backend()
+                force = treecode.tree_internal_force(xy, self.charge, coupling, self.theta)
+            elif self.periodic and self.periodic_method != "images":
+                _, field = self.periodic_sum(xy)
+                force = 2*coupling*self.charge**2*field
+            else:
+                return self.images_internal_force(xy, self.images(), coupling, out, workspace)
+            return force if out is None else out.copy_(force)
+
+    def periodic_sum(self, xy):
+        """Ewald or mesh sum of unit charges potential and field, without self interaction"""
+        charges = torch.ones(xy.shape[:-1], dtype=xy.dtype)
+        return ewald.periodic_potential(xy, xy, charges, self.lx, self.ly,
+                                        self.periodic_method, exclude_self=True,
+                                        **self.periodic_options)
+
+    def images_internal_force(self, xy, images, coupling=1.0, out=None, workspace=None):
+        """Calculates minus gradient of images_internal_energy, using Newton's third law"""
+        kernel = self.images_force_kernel(images, coupling, workspace)
+        return pairwise.pair_forces(kernel, xy, tile_size=self.tile_size,
+                                    out=out, workspace=workspace)
+
+    def images_force_kernel(self, images, coupling=1.0, workspace=None):
+        shifts = self.image_shifts(images)
+        scale = 2*coupling*self.charge**2
+        def inplace_kernel(dx, dy, *_):
+            #Same sums as kernel, in workspace blocks
+            fx, fy, shifted_dx, shifted_dy, weights = \
+                [workspace.block(name, dx.shape, dx.dtype)
+                 for name in ("fx", "fy", "shifted_dx", "shifted_dy", "weights")]
+            fx.zero_()
+            fy.zero_()
+            for sx, sy in shifts:
+                torch.sub(dx, sx, out=shifted_dx)
+                torch.sub(dy, sy, out=shifted_dy)
+                torch.mul(shifted_dx, shifted_dx, out=weights).addcmul_(shifted_dy, shifted_dy)
+                weights.rsqrt_().pow_(3)
+                fx.addcmul_(weights, shifted_dx)
+                fy.addcmul_(weights, shifted_dy)
+            return fx.mul_(scale), fy.mul_(scale)
+        if workspace is not None:
+            return inplace_kernel
+        def kernel(dx, dy, *_):
+            fx, fy = 0.0, 0.0
+            for sx, sy in shifts:
+                shifted_dx, shifted_dy = dx - sx, dy - sy
+                weights = torch.rsqrt(shifted_dx**2 + shifted_dy**2)**3
+                fx, fy = fx + weights*shifted_dx, fy + weights*shifted_dy
+            return 2*coupling*self.charge**2*fx, 2*coupling*self.charge**2*fy
+        return kernel
+
+    def switched_internal_force(self, xy, inner, outer, near=True, coupling=1.0):
+        """
+        Calculates minus gradient of the near (or far) part of particle interactions,
+        splitting each pair energy 1/d into S(d)/d and (1 - S(d))/d, with S a smooth 
+        switch from one below inner distance to zero above outer distance.
+        """
+        if self.backend == "tree" or (self.periodic and self.periodic_method != "images"):
+            raise NotImplementedError("Switched forces only available for direct images sums")
+        if near:
+            return self._near_internal_force(xy, inner, outer, coupling)
+        shifts = self.image_shifts(self.images())
+        def kernel(dx, dy, *_):
+            fx, fy = 0.0, 0.0
+            for sx, sy in shifts:
+                shifted_dx, shifted_dy = dx - sx, dy - sy
+                inverse_dists = torch.rsqrt(shifted_dx**2 + shifted_dy**2)
+                #-d/dd((1 - S)/d) = (1 - S)/d**2 + S'/d, projected by (dx, dy)/d
+                switch, dswitch = _switch(1/inverse_dists, inner, outer)
+                weights = ((1 - switch)*inverse_dists + dswitch)*inverse_dists**2
+                fx, fy = fx + weights*shifted_dx, fy + weights*shifted_dy
+            return 2*coupling*self.charge**2*fx, 2*coupling*self.charge**2*fy
+        return pairwise.pair_forces(kernel, xy, tile_size=self.tile_size)
+
+    def _near_internal_force(self, xy, inner, outer, coupling):
+        #Pairs beyond outer do not contribute, so only cell list neighbors are visited
+        shape = xy.shape
+        xy = xy.reshape(-1, *shape[-2:]) #(b, n, 2)
+        lengths, shifted = [], []
+        for i, length in enumerate([self.lx, self.ly]):
+            if length is not None:
+                if outer >= length/2:
+                    raise ValueError("Outer distance must be less than half the period")
+                lengths.append(length)
+                shifted.append(xy[..., i])
+            else: #Padded box, so that wrapped cells are farther than outer
+                lower = torch.min(xy[..., i]).item()
+                upper = torch.max(xy[..., i]).item()
+                lengths.append(upper - lower + 2*outer)
+                shifted.append(xy[..., i] - lower)
+        target_index, source_index = ewald.neighbor_pairs(torch.stack(shifted, dim=-1),
+                                                          torch.stack(shifted, dim=-1),
+                                                          lengths[0], lengths[1], outer)
+        keep = target_index != source_index
+        target_index, source_index = target_index[keep], source_index[keep]
+        flat = xy.reshape(-1, 2)
+        diffs = ewald._minimum_image(flat[target_index] - flat[source_index], self.lx, self.ly)
+        dists = torch.sqrt(torch.sum(diffs**2, dim=-1))
+        switch, dswitch = _switch(dists, inner, outer)
+        #-d/dd(S/d) = S/d**2 - S'/d, projected by (dx, dy)/d
+        weights = 2*coupling*self.charge**2*(switch/dists - dswitch)/dists**2
+        force = torch.zeros_like(flat).index_add(0, target_index, weights[:, None]*diffs)
+        return force.reshape(shape)
+
+    def internal_force_on(self, xy, index, coupling=1.0):
+        """
+        Calculates internal_force on the particles of the given indexes only.
+        Only the direct backend with images sums evaluates just those particles,
+        other methods evaluate all of them.
+        """
+        if self.backend == "tree" or (self.periodic and self.periodic_method != "images"):
+            return self.internal_force(xy, coupling)[..., index, :]
+        kernel = self.images_force_kernel(self.images(), coupling)
+        return pairwise.target_forces(kernel, xy, index, tile_size=self.tile_size)
+
+    def potential_force_on(self, xy, index, objects=None, coupling=1.0):
+        """Calculates potential_force on the particles of the given indexes only"""
+        profiling.count(self.profiler, "force_evaluations")
+        return self.internal_force_on(xy, index, coupling) + \
+               self.external_force(xy[..., index, :], objects, coupling)
+
+    def external_force(self, xy, objects=None, coupling=1.0, add_to=None):
+        """
+        Calculates minus gradient of external field term,
+        in closed form when available and by autograd otherwise.
+        Added in place to add_to if given, instead of to a new zero tensor.
+        """
+        force = torch.zeros_like(xy) if add_to is None else add_to
+        if objects is None:
+            return force
+        x, y = xy[..., 0], xy[..., 1]
+        autograd_objects = []
+        for obj in objects:
+            with profiling.phase(self.profiler, "force:" + type(obj).__name__):
+                obj_force = obj.force(x, y, self.charge, coupling)
+                if obj_force is None:
+                    autograd_objects.append(obj)
+                else:
+                    force[..., 0] += obj_force[0]
+                    force[..., 1] += obj_force[1]
+        if autograd_objects:
+            with torch.enable_grad():
+                xy_ = xy.detach().requires_grad_(True)
+                energy = self.external_energy(xy_, autograd_objects, coupling)
+                force -= torch.autograd.grad(energy.sum(), xy_)[0]
+        return force
+
+    def potential_force(self, xy, objects=None, coupling=1.0, out=None, workspace=None):
+        """
+        Calculates minus gradient of potential energy term (for separable hamiltonian).
+        Written to out if given, as in internal_force.
+        """
+        profiling.count(self.profiler, "force_evaluations")
+        if out is None:
+            return self.internal_force(xy, coupling) + self.external_force(xy, objects, coupling)
+        self.internal_force(xy, coupling, out, workspace)
+        return self.external_force(xy, objects, coupling, add_to=out)
             
     def darwin_hamiltonian(self, xy, pxy, objects=None, coupling=1.0, darwin_coupling=1.0):
         """Calculates darwin hamiltonian"""
         if self.periodic:
             raise NotImplementedError
-        internal_energy = self.darwin_energies(xy, pxy, coupling, darwin_coupling)
+        with profiling.phase(self.profiler, "internal_energy"):
+            internal_energy = self.darwin_energies(xy, pxy, coupling, darwin_coupling)
         external_energy = self.external_energy(xy, objects, coupling)
         hamilt = internal_energy + external_energy
         return hamilt
     
     def darwin_energies(self, xy, pxy, coupling, darwin_coupling):
         """Calculate internal terms for darwin hamiltonian"""
-        dists = torch.cdist(xy, xy) + utils.diagonal_mask(self.dim)
-        coulomb_energy = torch.sum(coupling*self.charge**2/dists)
-        darwin_base = darwin_coupling*self.charge**2/(2*dists*self.mass**2)
-        inner_products = torch.sum(pxy[None, :, :]*pxy[:, None, :], dim=-1)
-        projections = torch.sum((xy[:, None, :] - xy[None, :, :])*pxy, axis=-1)/(dists)
-        inner_prod_term = darwin_base*torch.sum((inner_products))
-        projections_term = darwin_base*torch.sum(projections*projections.T)
-        darwin_energy = torch.sum(inner_prod_term + projections_term)
+        def kernel(dx, dy, features_i, features_j):
+            px_i, py_i = features_i
+            px_j, py_j = features_j
+            squared_dists = dx**2 + dy**2
+            #Product of projections (xy_i - xy_j).pxy_j/d_ij and (xy_j - xy_i).pxy_i/d_ij
+            projections = -(dx*px_j + dy*py_j)*(dx*px_i + dy*py_i)/squared_dists
+            return torch.rsqrt(squared_dists), projections
+        #Both sums are symmetric, so ordered pairs sums are twice the unordered ones
+        inverse_dists, projections = pairwise.pair_sum(kernel, xy, (pxy[..., 0], pxy[..., 1]),
+                                                       self.tile_size)
+        inverse_dists, projections = 2*inverse_dists, 2*projections
+        coulomb_energy = coupling*self.charge**2*inverse_dists
+        darwin_base = darwin_coupling*self.charge**2/(2*self.mass**2)*inverse_dists
+        inner_products = torch.sum(torch.sum(pxy, dim=-2)**2, dim=-1)
+        darwin_energy = darwin_base*(inner_products + projections)
         kinetic_energy = self.kinetic_energy(pxy)
         rke_base = darwin_coupling/(8*self.mass**3)*darwin_coupling
-        relativistic_kinetic_energy = rke_base*torch.sum(torch.diag(inner_products))
+        relativistic_kinetic_energy = rke_base*torch.sum(pxy**2, dim=(-2, -1))
         energy = coulomb_energy + darwin_energy + kinetic_energy + relativistic_kinetic_energy
         return energy
     
-    def wrap_around(self):
-        with torch.no_grad():
-            self.xy.copy_(
-                utils.wrap_from_center(self.xy.data,
-                                       [self.lx, self.ly],
-                                       [self.cx, self.cy]))
-
-    def dislocate_xy(self, xy, n, m):
+    def darwin_gradients(self, xy, pxy, objects=None, coupling=1.0, darwin_coupling=1.0):
+        """
+        Calculates darwin hamiltonian and its gradients on positions and momenta
+        in closed form, in a single tiled pass over pairs.
+        Writing the internal terms as C*A + D*A*(|P|**2 + B) + kinetic terms, with
+        A the sum of 1/d_ij and B the sum of projection products over ordered pairs,
+        and P the total momentum, only A, B and their gradients are pair sums.
+        """
+        if self.periodic:
+            raise NotImplementedError
+        profiling.count(self.profiler, "force_evaluations")
+        def kernel(dx, dy, features_i, features_j):
+            #In-place arithmetic, with one buffer for yielded vectors, since memory traffic
+            #over the (tile, n) blocks is the bottleneck
+            px_i, py_i = features_i
+            px_j, py_j = features_j
+            inverse_squared_dists = torch.reciprocal_(dx*dx + dy*dy)
+            inverse_dists = torch.sqrt(inverse_squared_dists)
+            #scaled = -2*projection*inverse_squared_dists, with projection = r_ij.p
+            scaled_i = (dx*px_i).addcmul_(dy, py_i).mul_(inverse_squared_dists).mul_(-2)
+            scaled_j = (dx*px_j).addcmul_(dy, py_j).mul_(inverse_squared_dists).mul_(-2)
+            #Twice the projection product, -2*(r_ij.p_i)*(r_ij.p_j)/d_ij**2
+            products = (scaled_i*scaled_j).div_(inverse_squared_dists).mul_(-0.5)
+            def vectors():
+                #Gradients of the ordered pairs terms 2/d_ij and 2*projection on xy_i,
+                #opposite on xy_j, and of 2*projection on pxy_i and pxy_j
+                buffer = torch.empty_like(inverse_dists)
+                dinverse = (inverse_dists*inverse_squared_dists).mul_(-2)
+                for k, d in enumerate((dx, dy)):
+                    yield 0, k, torch.mul(dinverse, d, out=buffer), (1, -1)
+                dprojections = dinverse.copy_(products).mul_(inverse_squared_dists).mul_(-2)
+                for k, (d, p_i, p_j) in enumerate(((dx, px_i, px_j), (dy, py_i, py_j))):
+                    vector = torch.mul(dprojections, d, out=buffer)
+                    yield 1, k, vector.addcmul_(scaled_i, p_j).addcmul_(scaled_j, p_i), (1, -1)
+                for k, d in enumerate((dx, dy)):
+                    yield 2, k, torch.mul(scaled_j, d, out=buffer), (1, 0)
+                    yield 2, k, torch.mul(scaled_i, d, out=buffer), (0, 1)
+            return (inverse_dists, products), vectors()
+        with profiling.phase(self.profiler, "darwin_pairs"):
+            (inverse_dists, projections), (dinverse, dprojections, pprojections) = \
+                pairwise.pair_accumulate(kernel, xy, (pxy[..., 0], pxy[..., 1]), 3,
+                                         min(self.tile_size, DARWIN_TILE_SIZE))
+        inverse_dists = 2*inverse_dists #Symmetric, so ordered pairs sum is twice the unordered one
+        total_momentum = torch.sum(pxy, dim=-2) #(..., 2)
+        momentum_term = torch.sum(total_momentum**2, dim=-1) + projections
+        coulomb_base = coupling*self.charge**2
+        darwin_base = darwin_coupling*self.charge**2/(2*self.mass**2)
+        rke_base = darwin_coupling/(8*self.mass**3)*darwin_coupling
+        energy = coulomb_base*inverse_dists + darwin_base*inverse_dists*momentum_term + \
+                 self.kinetic_energy(pxy) + rke_base*torch.sum(pxy**2, dim=(-2, -1)) + \
+                 self.external_energy(xy, objects, coupling)
+        inverse_dists, momentum_term = inverse_dists[..., None, None], momentum_term[..., None, None]
+        dhdxy = (coulomb_base + darwin_base*momentum_term)*dinverse + \
+                darwin_base*inverse_dists*dprojections - self.external_force(xy, objects, coupling)
+        dhdpxy = darwin_base*inverse_dists*(2*total_momentum[..., None, :] + pprojections) + \
+                 pxy/self.mass + 2*rke_base*pxy
+        return energy, dhdxy, dhdpxy
+
+    def wrap_around(self, workspace=None):
+        """Wraps positions into the periodic box, with temporaries from workspace if given"""
+        with profiling.phase(self.profiler, "wrap_around"), torch.no_grad():
+            xy = self.xy.data
+            outside = utils.scratch(workspace, "outside", xy.shape, torch.bool)
+            centered = utils.scratch(workspace, "centered", xy.shape[:-1], xy.dtype)
+            below = utils.scratch(workspace, "below", xy.shape[:-1], torch.bool)
+            outside.zero_()
+            for i, (length, center) in enumerate(zip([self.lx, self.ly], [self.cx, self.cy])):
+                if length is not None:
+                    torch.sub(xy[..., i], center, out=centered)
+                    torch.lt(centered, -length/2, out=below)
+                    torch.ge(centered, length/2, out=outside[..., i]).logical_or_(below)
+            #Positions are only touched when something left the box, keeping their version
+            if torch.any(outside, out=utils.scratch(workspace, "any_outside", (), torch.bool)):
+                wrapped = utils.wrap_from_center(xy, [self.lx, self.ly], [self.cx, self.cy],
+                                                 utils.scratch(workspace, "wrapped",
+                                                               xy.shape, xy.dtype))
+                self.xy.copy_(torch.where(outside, wrapped, xy, out=wrapped))
+
+    def image_shifts(self, images):
         lx = self.lx if self.lx is not None else 0.0
         ly = self.ly if self.ly is not None else 0.0
-        xy_dis = xy + torch.tensor([n*lx, m*ly])
-        return xy_dis
+        return [(n*lx, m*ly) for n, m in images]
 
     @property
     def x(self):
@@ -224,8 +515,23 @@ class MovingPoints(torch.nn.Module):
     def periodic(self):
         return self.lx is not None or self.ly is not None
 
+    @property
+    def batched(self):
+        return self.x.ndim == 2
+
+    def make_dummy_parameters(self):
+        """Creates the dummy copies of positions and momenta used by Tao integrators"""
+        self.xy_dummy = torch.nn.Parameter(self.xy.detach().clone())
+        self.pxy_dummy = torch.nn.Parameter(self.pxy.detach().clone())
+
+    def _assert_tree_backend(self):
+        if self.periodic:
+            raise NotImplementedError("Tree backend only available for non-periodic systems")
+
     def _assert_positions(self):
-        assert (self.x.ndim, self.y.ndim, self.px.ndim, self.py.ndim) == ((1,)*4)
+        assert self.x.ndim in [1, 2]
+        assert (self.x.ndim, self.y.ndim, self.px.ndim, self.py.ndim) == ((self.x.ndim,)*4)
+        assert (self.x.shape, self.y.shape, self.px.shape, self.py.shape) == ((self.x.shape,)*4)
         assert (self.x.shape[-1], self.y.shape[-1], self.px.shape[-1], self.py.shape[-1]) == ((self.dim,)*4)
         
     def _register_positions_as_parameters(self, x, y, px, py):
@@ -235,4 +541,10 @@ class MovingPoints(torch.nn.Module):
         self.pxy = torch.nn.Parameter(pxy)
         self.xy_dummy = None
         self.pxy_dummy = None
-        return
\ No newline at end of file
+        return
+
+
+def _switch(dists, inner, outer):
+    #Smooth step from one below inner to zero above outer, and its derivative
+    x = torch.clamp((dists - inner)/(outer - inner), 0.0, 1.0)
+    return 1 - x*x*(3 - 2*x), -6*x*(1 - x)/(outer - inner)
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+from typing import Optional, List
+import sys
+import json
+import math
+import time
+import argparse
+
+import torch
+
+from . import batch
+from . import ewald
+from . import integrators
+from . import visutils
+
+
+#Reference scenarios, as batch sweep specs without integrators, dts and seeds,
+#and optionally with a periodic summation method (as for NBodySystem.set_periodic_method)
+SCENARIOS = {
+    "circle": {"designs": ["N-Random-Circle"], "frames": ["Circle"],
+               "npoints": 8, "radius": 0.5},
+    "square": {"designs": ["3-Equilateral"], "frames": ["Square"]},
+    #Truncated image sums jump when particles wrap, so the energy is only conserved
+    #with a converged periodic sum
+    "periodic": {"designs": ["N-Random-Square"], "frames": ["Periodic"],
+                 "npoints": 8, "radius": 0.8, "periodic_method": "ewald"},
+    "circle-darwin": {"designs": ["N-Random-Circle"], "frames": ["Circle"],
+                      "npoints": 8, "radius": 0.5, "darwin_coupling": 0.01},
+}
+DTS = [1e-2, 5e-3, 2.5e-3, 1.25e-3]
+#Symplectic for any hamiltonian, so also a reference for Darwin scenarios
+REFERENCE_INTEGRATOR = "gausslegendre"
+
+
+def build_system(scenario: str, integrator: str, dt: float, seed: int = 0):
+    """Creates the system of a scenario, with the same initial state for any integrator"""
+    spec = dict(SCENARIOS[scenario], integrators=[integrator], dts=[dt], seeds=[seed])
+    periodic_method = spec.pop("periodic_method", None)
+    run, = batch.expand_sweep(spec)
+    syst = batch.build_system(run)
+    if periodic_method is not None:
+        syst.set_periodic_method(periodic_method)
+    return syst
+
+
+def energy(syst) -> float:
+    with torch.no_grad():
+        return syst.points.hamiltonian(syst.objects, syst.coupling,
+                                       syst.darwin_coupling).sum().item()
+
+
+def integrate(scenario: str, integrator: str, dt: float, duration: float,
+              seed: int = 0, samples: int = 20, reference: Optional[dict] = None) -> dict:
+    """
+    Integrates a scenario for duration, timing the steps only.
+
+    Parameters
+    ----------
+    scenario : str
+        Scenario name, one of SCENARIOS.
+    integrator : str
+        Integrator name, as for integrators.get_integrator.
+    dt : float
+        Step size, dividing duration.
+    duration : float
+        Integration time.
+    seed : int, optional
+        Seed for random designs. The default is 0.
+    samples : int, optional
+        Number of (untimed) energy evaluations along the run. The default is 20.
+    reference : Optional[dict], optional
+        Run of a reference solution, as returned by integrate, to compute the
+        phase space error against. The default is None.
+
+    Raises
+    ------
+    ValueError
+        If dt does not divide duration.
+
+    Returns
+    -------
+    dict
+        Run with "status" ("ok", "skipped" for integrators not valid for the
+        scenario, or "failed") and, if ok, "steps", "wall_time", "energy_error"
+        (maximum relative energy error over the samples and the end),
+        "phase_error" (if reference is given) and "state" (final positions
+        and momenta).
+
+    """
+    nsteps = round(duration/dt)
+    if abs(nsteps*dt - duration) > 1e-9*duration:
+        raise ValueError("Step size must divide duration")
+    result = {"scenario": scenario, "integrator": integrator, "dt": dt}
+    every = max(1, nsteps//samples)
+    try:
+        syst = build_system(scenario, integrator, dt, seed)
+        initial_energy = energy(syst)
+        stepper = syst.make_engine(dt)
+        wall_time, energy_error = 0.0, 0.0
+        for done in range(0, nsteps, every):
+            start = time.perf_counter()
+            for _ in range(min(every, nsteps - done)):
+                stepper.step()
+            wall_time += time.perf_counter() - start
+            error = abs(energy(syst) - initial_energy)/abs(initial_energy)
+            if not math.isfinite(error):
+                raise FloatingPointError("Non finite energy")
+            energy_error = max(energy_error, error)
+    except (integrators.NonValidIntegratorError, NotImplementedError) as error:
+        return dict(result, status="skipped", error="%s: %s" % (type(error).__name__, error))
+    except Exception as error: #Runs fail independently of each other
+        return dict(result, status="failed", error="%s: %s" % (type(error).__name__, error))
+    state = (syst.points.xy.detach().clone(), syst.points.pxy.detach().clone())
+    result = dict(result, status="ok", steps=nsteps, wall_time=wall_time,
+                  energy_error=energy_error, state=state)
+    if reference is not None:
+        result["phase_error"] = phase_error(state, reference["state"],
+                                            syst.points.lx, syst.points.ly)
+    return result
+
+
+def phase_error(state: tuple, reference_state: tuple,
+                lx: Optional[float] = None, ly: Optional[float] = None) -> float:
+    """
+    Phase space distance of state (xy, pxy) to reference_state, relative to the
+    reference norm, with positions differences taken as minimum images if periodic.
+    """
+    (xy, pxy), (reference_xy, reference_pxy) = state, reference_state
+    dxy = ewald._minimum_image(xy - reference_xy, lx, ly)
+    norm = torch.sqrt(torch.sum(reference_xy**2) + torch.sum(reference_pxy**2))
+    return (torch.sqrt(torch.sum(dxy**2) + torch.sum((pxy - reference_pxy)**2))/norm).item()
+
+
+def work_precision(scenarios: Optional[List[str]] = None,
+                   integrator_names: Optional[List[str]] = None,
+                   dts: Optional[List[float]] = None, duration: float = 0.5,
+                   reference: str = REFERENCE_INTEGRATOR, refine: int = 8,
+                   seed: int = 0, samples: int = 20, log=None) -> List[dict]:
+    """
+    Work-precision data of integrators over step sizes, on reference scenarios.
+
+    Parameters
+    ----------
+    scenarios : Optional[List[str]], optional
+        Scenario names. If None, all of SCENARIOS. The default is None.
+    integrator_names : Optional[List[str]], optional
+        Integrator names. If None, the ones of the GUI. The default is None.
+    dts : Optional[List[float]], optional
+        Step sizes, dividing duration. If None, DTS. The default is None.
+    duration : float, optional
+        Integration time. The default is 0.5.
+    reference : str, optional
+        Integrator of the reference solution. The default is REFERENCE_INTEGRATOR.
+    refine : int, optional
+        Reference step size is the smallest of dts over refine. The default is 8.
+    seed : int, optional
+        Seed for random designs. The default is 0.
+    samples : int, optional
+        Number of energy evaluations along each run. The default is 20.
+    log : optional
+        Stream where progress is printed, if given. The default is None.
+
+    Raises
+    ------
+    RuntimeError
+        If a reference solution fails.
+
+    Returns
+    -------
+    List[dict]
+        Runs, as from integrate without their final states.
+
+    """
+    scenarios = scenarios if scenarios is not None else list(SCENARIOS)
+    integrator_names = integrator_names if integrator_names is not None \
+        else [name.lower() for name in visutils.INTEGRATORS]
+    dts = dts if dts is not None else DTS
+    results = []
+    for scenario in scenarios:
+        reference_run = integrate(scenario, reference, min(dts)/refine, duration, seed, 1)
+        if reference_run["status"] != "ok":
+            raise RuntimeError("Reference of %s failed: %s" %
+                               (scenario, reference_run.get("error")))
+        for name in integrator_names:
+            for dt in dts:
+                result = integrate(scenario, name, dt, duration, seed, samples, reference_run)
+                result.pop("state", None)
+                results.append(result)
+                if log is not None:
+                    print(format_result(result), file=log)
+    return results
+
+
+def cheapest(results: List[dict], target: float, metric: str = "energy_error") -> dict:
+    """Cheapest run of each scenario whose metric meets target, None where none does"""
+    best = {}
+    for result in results:
+        scenario = result["scenario"]
+        best.setdefault(scenario, None)
+        if result["status"] != "ok" or result[metric] > target:
+            continue
+        if best[scenario] is None or result["wall_time"] < best[scenario]["wall_time"]:
+            best[scenario] = result
+    return best
+
+
+def format_result(result: dict) -> str:
+    head = "%-14s %-16s dt=%-9.3g" % (result["scenario"], result["integrator"], result["dt"])
+    if result["status"] != "ok":
+        return "%s %s (%s)" % (head, result["status"], result.get("error", ""))
+    return "%s wall=%-9.3g energy_error=%-9.3g phase_error=%.3g" % \
+        (head, result["wall_time"], result["energy_error"], result["phase_error"])
+
+
+def plot(results: List[dict], path: str, metric: str = "energy_error"):
+    """Saves work-precision curves (metric against wall time) to path, one panel per scenario"""
+    from matplotlib.figure import Figure
+    scenarios = list(dict.fromkeys(result["scenario"] for result in results))
+    figure = Figure(figsize=(5*len(scenarios), 4))
+    for i, scenario in enumerate(scenarios):
+        axes = figure.add_subplot(1, len(scenarios), i + 1)
+        curves = {}
+        for result in results:
+            if result["scenario"] == scenario and result["status"] == "ok":
+                curves.setdefault(result["integrator"], []).append(result)
+        for name, curve in curves.items():
+            curve = sorted(curve, key=lambda result: result["wall_time"])
+            axes.loglog([result["wall_time"] for result in curve],
+                        [max(result[metric], 1e-17) for result in curve], "o-", label=name)
+        axes.set_title(scenario)
+        axes.set_xlabel("wall time (s)")
+        axes.set_ylabel(metric.replace("_", " "))
+    if results:
+        axes.legend(fontsize="small")
+    figure.tight_layout()
+    figure.savefig(path)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m fieldbillard.precision",
+                                     description="Work-precision curves of the integrators: "
+                                                 "energy and phase space errors against "
+                                                 "wall time, over step sizes.")
+    parser.add_argument("--scenarios", nargs="+", default=None, choices=list(SCENARIOS))
+    parser.add_argument("--integrators", nargs="+", default=None,
+                        help="Integrator names. Defaults to the ones of the GUI.")
+    parser.add_argument("--dts", nargs="+", type=float, default=DTS,
+                        help="Step sizes, dividing duration.")
+    parser.add_argument("--duration", type=float, default=0.5)
+    parser.add_argument("--reference", default=REFERENCE_INTEGRATOR,
+                        help="Integrator of the reference solution.")
+    parser.add_argument("--refine", type=int, default=8,
+                        help="Reference step size is the smallest dt over refine.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dtype", default="float64", choices=["float32", "float64"])
+    parser.add_argument("--target", type=float, default=None,
+                        help="Accuracy target, for which the cheapest runs are printed.")
+    parser.add_argument("--metric", default="energy_error",
+                        choices=["energy_error", "phase_error"],
+                        help="Error plotted and compared against target.")
+    parser.add_argument("-o", "--output", default=None, help="JSON results file.")
+    parser.add_argument("--plot", default=None, help="Image file for the curves.")
+    args = parser.parse_args(argv)
+    torch.set_default_dtype(getattr(torch, args.dtype))
+    results = work_precision(args.scenarios, args.integrators, args.dts, args.duration,
+                             args.reference, args.refine, args.seed, log=sys.stdout)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=1)
+    if args.plot is not None:
+        plot(results, args.plot, args.metric)
+    if args.target is not None:
+        print("Cheapest runs with %s <= %g:" % (args.metric, args.target))
+        for scenario, result in cheapest(results, args.target, args.metric).items():
+            print(format_result(result) if result is not None else "%-14s none" % scenario)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+from typing import Optional, Callable
+import csv
+import json
+import time
+import contextlib
+
+import torch
+
+
+#Shared by all disabled phases, so that instrumentation costs a call when profiling is off
+NULL_PHASE = contextlib.nullcontext()
+CSV_COLUMNS = ["name", "kind", "calls", "calls_per_step", "seconds", "seconds_per_step",
+               "allocated_bytes"]
+
+
+def phase(profiler, name: str):
+    """Context timing name with profiler, doing nothing if profiler is None"""
+    return NULL_PHASE if profiler is None else profiler.phase(name)
+
+
+def count(profiler, name: str, n: int = 1):
+    """Adds n to the counter name of profiler, if any"""
+    if profiler is not None:
+        profiler.count(name, n)
+
+
+class Profiler(object):
+    def __init__(self, device: Optional[torch.device] = None, track_memory: bool = True,
+                 synchronize: bool = True):
+        """
+        Per-phase metrics of the step pipeline. Instrumented code opens named
+        phases (as "zero_grad", "internal_energy", "potential:<field object class>",
+        "backward", "kick", "drift", "wrap_around") and bumps counters (as
+        "force_evaluations"). Phases nest, so their times are inclusive.
+        Metrics accumulate over a step, which is closed by record (the profiler
+        is a system sink), passing its metrics to the observers, and are then
+        added to the totals.
+
+        Parameters
+        ----------
+        device : Optional[torch.device], optional
+            Device of the profiled system. The default is None (CPU).
+        track_memory : bool, optional
+            Whether to record the net change of allocated memory over each phase.
+            Only available for CUDA devices, elsewhere allocated bytes are None.
+            The default is True.
+        synchronize : bool, optional
+            Whether to synchronize CUDA devices around phases, so that their
+            times include the kernels they launch. The default is True.
+        """
+        device = torch.device(device) if device is not None else torch.device("cpu")
+        cuda = device.type == "cuda"
+        self.device = device
+        self.track_memory = track_memory and cuda
+        self.synchronize = synchronize and cuda
+        self.observers = []
+        self.reset()
+
+    def reset(self):
+        """Drops all recorded metrics"""
+        self.steps = 0
+        self.totals = {} #name -> [calls, seconds, allocated bytes]
+        self.counters = {}
+        self.current = {}
+        self.current_counters = {}
+
+    def phase(self, name: str):
+        return Phase(self, name)
+
+    def count(self, name: str, n: int = 1):
+        self.current_counters[name] = self.current_counters.get(name, 0) + n
+
+    def add(self, name: str, seconds: float, allocated: Optional[int] = None):
+        """
+        Adds a call of phase name, taking seconds and allocating allocated bytes
+        (None if not tracked)
+        """
+        entry = self.current.get(name)
+        if entry is None:
+            entry = self.current[name] = self._new_entry()
+        entry[0] += 1
+        entry[1] += seconds
+        if allocated is not None and entry[2] is not None:
+            entry[2] += allocated
+
+    def memory_allocated(self) -> Optional[int]:
+        return torch.cuda.memory_allocated(self.device) if self.track_memory else None
+
+    def _new_entry(self):
+        #Allocated bytes are None rather than a misleading 0 when not tracked
+        return [0, 0.0, 0 if self.track_memory else None]
+
+    def wait(self):
+        if self.synchronize:
+            torch.cuda.synchronize(self.device)
+
+    def add_observer(self, observer: Callable):
+        """
+
+
+        Parameters
+        ----------
+        observer : Callable
+            Called with the metrics of each step, a dict with keys "step", "time"
+            (system time after the step), "phases" (name -> dict of "calls",
+            "seconds" and "allocated_bytes", None if memory is not tracked) and
+            "counters" (name -> count).
+
+        """
+        self.observers.append(observer)
+
+    def remove_observer(self, observer: Callable):
+        self.observers.remove(observer)
+
+    def record(self, system):
+        self.end_step(system.time)
+
+    def end_step(self, system_time: Optional[float] = None):
+        """Closes the current step, passing its metrics to the observers"""
+        if self.observers:
+            metrics = {"step": self.steps, "time": system_time,
+                       "phases": {name: _phase_dict(entry) for name, entry in self.current.items()},
+                       "counters": dict(self.current_counters)}
+            for observer in self.observers:
+                observer(metrics)
+        for name, (calls, seconds, allocated) in self.current.items():
+            entry = self.totals.get(name)
+            if entry is None:
+                entry = self.totals[name] = self._new_entry()
+            entry[0] += calls
+            entry[1] += seconds
+            if allocated is not None and entry[2] is not None:
+                entry[2] += allocated
+        for name, n in self.current_counters.items():
+            self.counters[name] = self.counters.get(name, 0) + n
+        self.current = {}
+        self.current_counters = {}
+        self.steps += 1
+
+    def summary(self) -> dict:
+        """
+
+
+        Returns
+        -------
+        dict
+            Totals and per step averages over the closed steps, with keys "steps",
+            "phases" (name -> dict of "calls", "calls_per_step", "seconds",
+            "seconds_per_step" and "allocated_bytes", sorted by decreasing seconds,
+            with allocated bytes None if memory is not tracked)
+            and "counters" (name -> dict of "total" and "per_step").
+
+        """
+        steps = max(self.steps, 1)
+        phases = {}
+        for name, entry in sorted(self.totals.items(), key=lambda item: -item[1][1]):
+            phases[name] = dict(_phase_dict(entry), calls_per_step=entry[0]/steps,
+                                seconds_per_step=entry[1]/steps)
+        counters = {name: {"total": n, "per_step": n/steps} for name, n in self.counters.items()}
+        return {"steps": self.steps, "phases": phases, "counters": counters}
+
+    def to_json(self, path: str):
+        """Writes summary to path, as JSON"""
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def to_csv(self, path: str):
+        """Writes summary to path, as CSV with a row for each phase and counter"""
+        summary = self.summary()
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, CSV_COLUMNS)
+            writer.writeheader()
+            for name, values in summary["phases"].items():
+                writer.writerow(dict(values, name=name, kind="phase"))
+            for name, values in summary["counters"].items():
+                writer.writerow({"name": name, "kind": "counter", "calls": values["total"],
+                                 "calls_per_step": values["per_step"]})
+
+
+class Phase(object):
+    __slots__ = ("profiler", "name", "start", "memory")
+
+    def __init__(self, profiler: Profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        profiler = self.profiler
+        profiler.wait()
+        self.memory = profiler.memory_allocated()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        profiler = self.profiler
+        profiler.wait()
+        elapsed = time.perf_counter() - self.start
+        allocated = profiler.memory_allocated() - self.memory if self.memory is not None else None
+        profiler.add(self.name, elapsed, allocated)
+        return False
+
+
+def _phase_dict(entry):
+    calls, seconds, allocated = entry
+    return {"calls": calls, "seconds": seconds, "allocated_bytes": allocated}
@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 from typing import Optional
+import os
+import inspect
 
 import torch
 
 from . import fields
 from . import points
 from . import integrators
+from . import adaptive
+from . import engine
+from . import profiling
 
 
 class NBodySystem(object):
@@ -16,16 +21,17 @@ class NBodySystem(object):
                  integrator: str ='sympleticverlet', coupling:float = 1.0,
                  darwin_coupling: Optional[float] = None, 
                  lx: Optional[float] = None, ly: Optional[float] = None,
-                 cx: Optional[float] = 0.0, cy: Optional[float] = 0.0):
+                 cx: Optional[float] = 0.0, cy: Optional[float] = 0.0,
+                 backend: str = "direct", theta: float = 0.5):
         """
         
 
         Parameters
         ----------
         x : torch.Tensor
-            position x-coordinate.
+            position x-coordinate, of shape (n,), or (b, n) for a batch of b replicas.
         y : torch.Tensor
-            position y-coordinate.
+            position y-coordinate, of shape (n,), or (b, n) for a batch of b replicas.
         px : Optional[torch.Tensor], optional
             Generalized momenta x-coordinate. Defaults to zero if None. The default is None.
         py : Optional[torch.Tensor], optional
@@ -41,13 +47,24 @@ class NBodySystem(object):
         darwin_coupling : Optional[float], optional
             Darwin lagrangian coupling constant for system. If None, Darwin term is not considered.
             The default is None.
+        backend : str, optional
+            Particle interactions backend, either "direct" or "tree" (Barnes-Hut).
+            The default is "direct".
+        theta : float, optional
+            Opening angle for the "tree" backend. The default is 0.5.
         """
         self.points = points.MovingPoints(x, y, px, py, mass, charge,
-                                          lx, ly, cx, cy)
+                                          lx, ly, cx, cy, backend, theta)
         self.objects = []
-        self.integrator = integrators.get_integrator(integrator)
+        self.set_integrator(integrator)
         self.coupling = coupling
         self.darwin_coupling = darwin_coupling
+        self.stepper = None
+        self.block_stepper = None
+        self.time = 0.0
+        self.sinks = []
+        self.profiler = None
+        self._compiled_steps = {}
         
     def add_field_object(self, field_obj: fields.FieldObject):
         """
@@ -61,35 +78,413 @@ class NBodySystem(object):
         assert isinstance(field_obj, fields.FieldObject)
         self.objects.append(field_obj)
     
-    def step(self, dt: float):
+    def add_sink(self, sink):
         """
         
 
         Parameters
         ----------
+        sink : 
+            Object with a record(system) method, called after every step,
+            as trajectory.TrajectoryWriter.
+
+        """
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def record(self):
+        """Passes the current state to the sinks"""
+        for sink in self.sinks:
+            sink.record(self)
+
+    def step(self, dt: float, record: bool = True):
+        """
+        
+
+        Parameters
+        ----------
+        dt : float
+            Step size.
+        record : bool, optional
+            Whether to pass the new state to the sinks. Trial steps, 
+            as the ones of adaptive stepping, are not recorded. The default is True.
+
+        """
+        with profiling.phase(self.profiler, "step"):
+            if self.block_stepper is not None:
+                self.block_stepper.step(self, dt)
+            else:
+                self.integrator(dt, self.points, self.objects,
+                                self.coupling, self.darwin_coupling)
+            if self.points.periodic:
+                self.points.wrap_around()
+        self.time += dt
+        if record:
+            self.record()
+
+    def run(self, n_steps: int, dt: float, record_every: int = 1,
+            compile: bool = False):
+        """
+        Runs several steps, recording the state in a preallocated trajectory buffer.
+        For separable hamiltonians with the symplectic Euler or Verlet integrators,
+        the step is a pure function of (xy, pxy, force), compiled with torch.compile
+        if asked for (once per integrator and dt, as long as the interaction
+        setup is kept), and the state stays out of the system until the end.
+        With adaptive stepping, each step advances the system by dt with
+        adaptive steps. Otherwise, or with block time steps or when profiling
+        (whose phases a compiled step would hide), steps with a engine.StepEngine
+        (which itself falls back to step for integrators it does not support).
+
+        Parameters
+        ----------
+        n_steps : int
+            Number of steps.
         dt : float
             Step size.
+        record_every : int, optional
+            Number of steps between recordings. The default is 1.
+        compile : bool, optional
+            Whether to compile the step with torch.compile, where available
+            (torch 2.0 or later). The first run for each integrator and dt then
+            spends seconds to tens of seconds compiling, which only pays off
+            over many thousands of steps. The default is False.
 
+        Returns
+        -------
+        torch.Tensor
+            Trajectory buffer, of shape (n_steps//record_every, 2, ..., n, 2), with
+            positions in [:, 0] and momenta in [:, 1], recorded after every
+            record_every steps.
+
+        """
+        xy, pxy = self.points.xy.detach(), self.points.pxy.detach()
+        nrecords = n_steps//record_every
+        trajectory = torch.empty(nrecords, 2, *xy.shape, dtype=xy.dtype)
+        step = None
+        if self.stepper is None and self.block_stepper is None and self.profiler is None:
+            step = self.functional_step(dt, compile)
+        if step is None:
+            stepper = self.make_engine(dt) if self.stepper is None else None
+            for i in range(n_steps):
+                if stepper is not None:
+                    stepper.step()
+                else: #Adaptive steps are not recorded by themselves
+                    self.advance(dt)
+                    self.record()
+                if (i + 1)%record_every == 0:
+                    trajectory[i//record_every, 0] = self.points.xy.detach()
+                    trajectory[i//record_every, 1] = self.points.pxy.detach()
+            return trajectory
+        with torch.no_grad():
+            force = self.points.potential_force(xy, self.objects, self.coupling)
+            for i in range(n_steps):
+                xy, pxy, force, stale = step(xy, pxy, force, dt)
+                if stale is not None and stale: #Some position was wrapped after the last kick
+                    force = self.points.potential_force(xy, self.objects, self.coupling)
+                self.time += dt
+                if (i + 1)%record_every == 0:
+                    trajectory[i//record_every, 0] = xy
+                    trajectory[i//record_every, 1] = pxy
+                if self.sinks: #Sinks read the state from the system
+                    self.points.xy.copy_(xy)
+                    self.points.pxy.copy_(pxy)
+                    self.record()
+            self.points.xy.copy_(xy)
+            self.points.pxy.copy_(pxy)
+        return trajectory
+
+    def functional_step(self, dt: float, compile: bool = False):
+        """
+        Step function of integrators.functional_step for the current integrator,
+        compiled if asked for and available. Steps are cached per integrator and dt,
+        and rebuilt when the field objects, couplings or points change.
         """
-        self.integrator(dt, self.points, self.objects,
-                        self.coupling, self.darwin_coupling)
-        if self.points.periodic:
-            self.points.wrap_around()
+        setup = (self.points, tuple(self.objects), self.coupling, self.darwin_coupling)
+        key = (id(self.integrator), dt, compile)
+        #The integrator is kept with its step, so that its id is not reused
+        integrator, cached_setup, step = self._compiled_steps.get(key, (None, None, None))
+        if integrator is self.integrator and cached_setup == setup:
+            return step
+        step = integrators.functional_step(self.integrator, self.points, self.objects,
+                                           self.coupling, self.darwin_coupling)
+        if step is not None and compile and hasattr(torch, "compile"): #torch 2.0 or later
+            step = torch.compile(step, dynamic=False)
+        self._compiled_steps = {other: value for other, value in self._compiled_steps.items()
+                                if value[0] is self.integrator}
+        self._compiled_steps[key] = (self.integrator, setup, step)
+        return step
 
-    def set_integrator(self, integrator: str):
+    def make_engine(self, dt: float):
+        """
+        
+
+        Parameters
+        ----------
+        dt : float
+            Step size.
+
+        Returns
+        -------
+        engine.StepEngine
+            Engine stepping this system by dt in place, with preallocated workspace.
+
+        """
+        return engine.StepEngine(self, dt)
+
+    def set_adaptive(self, method: Optional[str] = "error", **options):
+        """
+        
+
+        Parameters
+        ----------
+        method : Optional[str], optional
+            Adaptive step size method, either "error" (step doubling error estimate)
+            or "separation" (smallest pair timescale). If None, disables adaptive
+            stepping. The default is "error".
+        **options :
+            Options of adaptive.AdaptiveStepper (rtol, atol, dt, dt_min, dt_max, 
+            safety, max_growth, eta, symmetric).
+
+        """
+        self.stepper = adaptive.AdaptiveStepper(method, **options) if method is not None else None
+
+    def set_profiling(self, enabled: bool = True, **options):
+        """
+        
+
+        Parameters
+        ----------
+        enabled : bool, optional
+            Whether steps record per-phase metrics in self.profiler (a
+            profiling.Profiler, closing each step as a sink). The default is True.
+        **options :
+            Options of profiling.Profiler (track_memory, synchronize).
+
+        """
+        if self.profiler is not None:
+            self.remove_sink(self.profiler)
+        self.profiler = profiling.Profiler(self.points.xy.device, **options) if enabled else None
+        self.points.profiler = self.profiler
+        if self.profiler is not None:
+            self.add_sink(self.profiler)
+
+    def set_block_steps(self, enabled: bool = True, **options):
+        """
+        
+
+        Parameters
+        ----------
+        enabled : bool, optional
+            Whether step uses individual block time steps (adaptive.BlockStepper),
+            instead of the integrator. The default is True.
+        **options :
+            Options of adaptive.BlockStepper (eta, max_level).
+
+        """
+        self.block_stepper = adaptive.BlockStepper(**options) if enabled else None
+
+    def advance(self, duration: float):
+        """
+        Advances the system by duration with adaptive steps, whose history
+        is kept in self.stepper.history.
+
+        Parameters
+        ----------
+        duration : float
+            Time to advance.
+
+        """
+        if self.stepper is None:
+            raise ValueError("Adaptive stepping not set")
+        self.stepper.advance(self, duration)
+
+    def set_integrator(self, integrator: str, **options):
         """
         
 
         Parameters
         ----------
         integrator : str
-            integrator.
+            integrator, one of integrators.INTEGRATORS, or "tao<omega>".
+        **options :
+            Integrator options (omega for "tao").
 
         """
-        self.integrator = integrators.get_integrator(integrator)
+        self.integrator = integrators.get_integrator(integrator, **options)
+        self.integrator_name = integrator
+        self.integrator_options = options
         if integrator[:3] == "tao":
             self.points.make_dummy_parameters()
             
+    def set_backend(self, backend: str, theta: Optional[float] = None):
+        """
+        
+
+        Parameters
+        ----------
+        backend : str
+            Particle interactions backend, either "direct" or "tree".
+        theta : Optional[float], optional
+            Opening angle for the "tree" backend. If None, keeps the current one.
+            The default is None.
+
+        """
+        self.points.set_backend(backend, theta)
+
+    def set_periodic_method(self, method: str, **options):
+        """
+        
+
+        Parameters
+        ----------
+        method : str
+            Periodic summation method, either "images" (truncated image shells),
+            "ewald" or "mesh" (particle-mesh Ewald, doubly periodic only).
+        **options :
+            Summation parameters (alpha, kmax, nquad for "ewald",
+            alpha, cutoff, mesh for "mesh").
+
+        """
+        self.points.set_periodic_method(method, **options)
+        for obj in self.objects:
+            if isinstance(obj, fields.PeriodicFixedPoints):
+                obj.method = method
+                obj.options = options
+
+    def save_checkpoint(self, path: str):
+        """
+        Saves the full simulation state (particles, with Tao dummies, periodicity
+        and interaction settings, field objects, couplings, integrator and
+        steppers with their cached states, and time) with torch.save, so that
+        a system loaded by load_checkpoint continues bitwise identically.
+        Sinks are not saved. The file is replaced atomically.
+
+        Parameters
+        ----------
+        path : str
+            Checkpoint file path.
+
+        """
+        points = self.points
+        checkpoint = {
+            "version": CHECKPOINT_VERSION,
+            "parameters": {name: parameter.detach().clone()
+                           for name, parameter in points.named_parameters()},
+            "points": {name: getattr(points, name) for name in CHECKPOINT_POINTS_ATTRIBUTES},
+            "objects": self.objects,
+            "coupling": self.coupling,
+            "darwin_coupling": self.darwin_coupling,
+            "integrator": self.integrator,
+            "integrator_name": self.integrator_name,
+            "integrator_options": self.integrator_options,
+            "stepper": self.stepper,
+            "block_stepper": self.block_stepper,
+            "time": self.time,
+            "stamps": integrators.cache_stamps(points, self.objects, self.coupling)
+        }
+        temporary_path = path + ".tmp"
+        torch.save(checkpoint, temporary_path)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load_checkpoint(cls, path: str):
+        """
+        
+
+        Parameters
+        ----------
+        path : str
+            Checkpoint file path, as written by save_checkpoint.
+
+        Raises
+        ------
+        ValueError
+            If checkpoint version is not supported.
+
+        Returns
+        -------
+        NBodySystem
+            Restored system.
+
+        """
+        #Checkpoints hold field objects and integrators, not only tensors. Torch
+        #versions before 1.13 have no weights_only, and load them in full anyway
+        if "weights_only" in inspect.signature(torch.load).parameters:
+            checkpoint = torch.load(path, weights_only=False)
+        else:
+            checkpoint = torch.load(path)
+        if checkpoint.get("version") != CHECKPOINT_VERSION:
+            raise ValueError("Checkpoint version not supported")
+        parameters = checkpoint["parameters"]
+        xy, pxy = parameters["xy"], parameters["pxy"]
+        system = cls(xy[..., 0], xy[..., 1], pxy[..., 0], pxy[..., 1],
+                     coupling=checkpoint["coupling"],
+                     darwin_coupling=checkpoint["darwin_coupling"])
+        points = system.points
+        for name, value in checkpoint["points"].items():
+            setattr(points, name, value)
+        #Parameters are set as saved, rather than stacked from coordinates
+        for name, value in parameters.items():
+            setattr(points, name, torch.nn.Parameter(value.clone()))
+        system.objects = checkpoint["objects"]
+        system.integrator = checkpoint["integrator"]
+        system.integrator_name = checkpoint["integrator_name"]
+        system.integrator_options = checkpoint["integrator_options"]
+        system.stepper = checkpoint["stepper"]
+        system.block_stepper = checkpoint["block_stepper"]
+        system.time = checkpoint["time"]
+        stamps = integrators.cache_stamps(points, system.objects, system.coupling)
+        for component in [system.integrator, system.block_stepper]:
+            if component is not None:
+                integrators.restamp(component, checkpoint["stamps"], stamps)
+        return system
+
+    def set_auto_checkpoint(self, path: Optional[str], every: int = 1000):
+        """
+        
+
+        Parameters
+        ----------
+        path : Optional[str]
+            Checkpoint file path, overwritten every time. If None, disables
+            auto checkpointing.
+        every : int, optional
+            Number of recorded steps between checkpoints. The default is 1000.
+
+        """
+        self.sinks = [sink for sink in self.sinks if not isinstance(sink, AutoCheckpoint)]
+        if path is not None:
+            self.add_sink(AutoCheckpoint(path, every))
+
     @property
     def periodic(self):
-        return self.points.periodic
\ No newline at end of file
+        return self.points.periodic
+
+
+class AutoCheckpoint(object):
+    def __init__(self, path: str, every: int = 1000):
+        """
+        Sink saving a checkpoint of the system every given number of record calls.
+
+        Parameters
+        ----------
+        path : str
+            Checkpoint file path.
+        every : int, optional
+            Number of record calls between checkpoints. The default is 1000.
+        """
+        self.path = path
+        self.every = every
+        self.calls = 0
+
+    def record(self, system):
+        self.calls += 1
+        if self.calls%self.every == 0:
+            system.save_checkpoint(self.path)
+
+
+CHECKPOINT_VERSION = 1
+CHECKPOINT_POINTS_ATTRIBUTES = ["mass", "charge", "lx", "ly", "cx", "cy", "nper", "tile_size",
+                                "backend", "theta", "periodic_method", "periodic_options"]
\ No newline at end of file
@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+from typing import Optional
+import os
+import json
+import zlib
+import bisect
+import struct
+
+import numpy as np
+import torch
+
+
+MAGIC = b"FBTRAJ01"
+COMPRESSED_MAGIC = b"FBCTRJ01"
+HEADER_ALIGNMENT = 64
+#Payload length, number of frames, and itemsizes of positions and momenta deltas
+CHUNK_HEADER = struct.Struct("<QIBB")
+
+
+class TrajectoryWriter(object):
+    def __init__(self, path: str, stride: int = 1, flush_every: int = 256,
+                 energy: bool = True, append: bool = False):
+        """
+        Trajectory sink streaming frames (time, energy, positions and momenta) to
+        a binary file, made of a header followed by fixed size records, so that
+        frames are appended without rewriting anything, and a partially written
+        last record is just ignored by readers. Frames are kept in a preallocated
+        buffer of flush_every records between writes. Added to a system with
+        NBodySystem.add_sink, it is called after every step.
+
+        Parameters
+        ----------
+        path : str
+            File path.
+        stride : int, optional
+            Number of record calls between written frames. The default is 1.
+        flush_every : int, optional
+            Number of buffered frames between writes to the file. The default is 256.
+        energy : bool, optional
+            Whether to compute the hamiltonian of recorded frames. If False,
+            energies are written as nan. The default is True.
+        append : bool, optional
+            Whether to append to an existing file with the same frame layout,
+            instead of overwriting it. The default is False.
+        """
+        self.path = path
+        self.stride = stride
+        self.flush_every = flush_every
+        self.energy = energy
+        self.append = append
+        self.file = None
+        self.closed = False
+        self.buffer = None
+        self.nbuffered = 0
+        self.calls = 0
+        self.nframes = 0 #Number of frames in file, including buffered ones
+
+    def record(self, system):
+        """Writes the state of system (a NBodySystem), every stride calls"""
+        self.calls += 1
+        if self.calls%self.stride == 0:
+            self.write_system(system)
+
+    def write_system(self, system):
+        """Writes the state of system, regardless of stride"""
+        points = system.points
+        energy = float("nan")
+        if self.energy:
+            with torch.no_grad():
+                energy = points.hamiltonian(system.objects, system.coupling,
+                                            system.darwin_coupling)
+        self.write(system.time, points.xy, points.pxy, energy)
+
+    def write(self, time, xy, pxy, energy=float("nan")):
+        """
+
+
+        Parameters
+        ----------
+        time : float
+            Simulation time.
+        xy : torch.Tensor
+            Positions, of shape (..., n, 2).
+        pxy : torch.Tensor
+            Momenta, of shape (..., n, 2).
+        energy : Union[float, torch.Tensor], optional
+            Hamiltonian, of shape (...,). The default is nan.
+
+        Raises
+        ------
+        ValueError
+            If the writer is closed.
+
+        """
+        if self.closed: #Reopening would overwrite the frames written so far
+            raise ValueError("write to closed trajectory")
+        if self.file is None:
+            self._open(xy)
+        i = self.nbuffered
+        self.buffer["time"][i] = time
+        self.buffer["energy"][i] = energy.detach().cpu().numpy() if torch.is_tensor(energy) \
+                                   else energy
+        self.buffer["xy"][i] = xy.detach().cpu().numpy()
+        self.buffer["pxy"][i] = pxy.detach().cpu().numpy()
+        self.nbuffered += 1
+        self.nframes += 1
+        if self.nbuffered == self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.file is None:
+            return
+        self.buffer[:self.nbuffered].tofile(self.file)
+        self.file.flush()
+        self.nbuffered = 0
+
+    def close(self):
+        """Flushes and closes the file, after which the writer takes no more frames"""
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _open(self, xy):
+        header = {"shape": list(xy.shape), "dtype": _numpy_dtype(xy.dtype).str,
+                  "energy_shape": list(xy.shape[:-2])}
+        dtype = frame_dtype(header)
+        if self.append and os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            existing, offset = read_header(self.path)
+            if existing != header:
+                raise ValueError("Frame layout differs from existing trajectory")
+            self.file = open(self.path, "r+b")
+            #Drops a partially written last record
+            self.nframes = (os.path.getsize(self.path) - offset)//dtype.itemsize
+            self.file.truncate(offset + self.nframes*dtype.itemsize)
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(self.path, "wb")
+            self.file.write(encode_header(header))
+        self.buffer = np.zeros(self.flush_every, dtype=dtype)
+
+
+class TrajectoryReader(object):
+    def __init__(self, path: str):
+        """
+        Memory-mapped view of a trajectory file written by TrajectoryWriter.
+        Slicing time, energy, xy and pxy does not copy the file contents.
+
+        Parameters
+        ----------
+        path : str
+            File path.
+        """
+        self.path = path
+        self.header, offset = read_header(path)
+        self.dtype = frame_dtype(self.header)
+        nframes = (os.path.getsize(path) - offset)//self.dtype.itemsize
+        if nframes > 0:
+            self.frames = np.memmap(path, dtype=self.dtype, mode="r",
+                                    offset=offset, shape=(nframes,))
+        else:
+            self.frames = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    @property
+    def time(self):
+        return self.frames["time"] #(t,)
+
+    @property
+    def energy(self):
+        return self.frames["energy"] #(t, ...)
+
+    @property
+    def xy(self):
+        return self.frames["xy"] #(t, ..., n, 2)
+
+    @property
+    def pxy(self):
+        return self.frames["pxy"] #(t, ..., n, 2)
+
+
+class CompressedTrajectoryWriter(TrajectoryWriter):
+    def __init__(self, path: str, error: float = 1e-5,
+                 momentum_error: Optional[float] = None,
+                 keyframe_every: int = 64, stride: int = 1, energy: bool = True,
+                 append: bool = False, level: int = 6):
+        """
+        Trajectory sink as TrajectoryWriter, storing frames in compressed chunks.
+        Positions and momenta are quantized to integer multiples of twice their
+        error bound, so that each value is off by at most the bound (plus rounding
+        of the stored dtype). Each chunk holds a keyframe of quantized values
+        followed by the differences between consecutive quantized frames, in the
+        narrowest integer type holding them, zlib compressed. Since differences
+        are taken between quantized frames, errors do not accumulate along the chunk.
+        Times and energies are kept exactly.
+
+        Parameters
+        ----------
+        path : str
+            File path.
+        error : float, optional
+            Absolute error bound of positions. The default is 1e-5.
+        momentum_error : Optional[float], optional
+            Absolute error bound of momenta. If None, equals error. The default is None.
+        keyframe_every : int, optional
+            Number of frames per chunk. Random access decodes at most this many
+            frames. The default is 64.
+        stride : int, optional
+            Number of record calls between written frames. The default is 1.
+        energy : bool, optional
+            Whether to compute the hamiltonian of recorded frames. If False,
+            energies are written as nan. The default is True.
+        append : bool, optional
+            Whether to append to an existing file with the same frame layout
+            and error bounds, instead of overwriting it. The default is False.
+        level : int, optional
+            zlib compression level. The default is 6.
+        """
+        super().__init__(path, stride, keyframe_every, energy, append)
+        self.error = error
+        self.momentum_error = error if momentum_error is None else momentum_error
+        self.level = level
+
+    def flush(self):
+        if self.file is None or self.nbuffered == 0:
+            return
+        self.file.write(encode_chunk(self.buffer[:self.nbuffered], 2*self.error,
+                                     2*self.momentum_error, self.level))
+        self.file.flush()
+        self.nbuffered = 0
+
+    def _open(self, xy):
+        header = {"shape": list(xy.shape), "dtype": _numpy_dtype(xy.dtype).str,
+                  "energy_shape": list(xy.shape[:-2]), "error": self.error,
+                  "momentum_error": self.momentum_error}
+        if self.append and os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            existing, offset = read_header(self.path, COMPRESSED_MAGIC)
+            if existing != header:
+                raise ValueError("Frame layout or error bounds differ from existing trajectory")
+            chunks, end = scan_chunks(self.path, offset)
+            self.nframes = sum(chunk[1] for chunk in chunks)
+            self.file = open(self.path, "r+b")
+            self.file.truncate(end) #Drops a partially written last chunk
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(self.path, "wb")
+            self.file.write(encode_header(header, COMPRESSED_MAGIC))
+        self.buffer = np.zeros(self.flush_every, dtype=frame_dtype(header))
+
+
+class CompressedTrajectoryReader(object):
+    def __init__(self, path: str):
+        """
+        Random access reader of a trajectory file written by CompressedTrajectoryWriter.
+        The chunk index is built on opening, from the chunk headers only, and
+        indexing decodes only the chunks holding the asked frames, keeping the
+        last decoded one.
+
+        Parameters
+        ----------
+        path : str
+            File path.
+        """
+        self.path = path
+        self.header, offset = read_header(path, COMPRESSED_MAGIC)
+        self.dtype = frame_dtype(self.header)
+        self.chunks, self.end = scan_chunks(path, offset) #(payload offset, nframes, widths)
+        self.starts = [0] #First frame of each chunk, and total number of frames
+        for _, nframes, _ in self.chunks:
+            self.starts.append(self.starts[-1] + nframes)
+        self._cached = (None, None)
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def __getitem__(self, index):
+        """Frames as a structured array with fields as in TrajectoryReader"""
+        if isinstance(index, slice):
+            indexes = range(*index.indices(len(self)))
+        else:
+            indexes = [index + len(self) if index < 0 else index]
+            if not 0 <= indexes[0] < len(self):
+                raise IndexError("Frame index out of range")
+        frames = np.zeros(len(indexes), dtype=self.dtype)
+        for i, frame in enumerate(indexes):
+            k = bisect.bisect_right(self.starts, frame) - 1
+            frames[i] = self.chunk(k)[frame - self.starts[k]]
+        return frames if isinstance(index, slice) else frames[0]
+
+    def chunk(self, k):
+        """Decoded frames of the k-th chunk"""
+        if self._cached[0] != k:
+            offset, nframes, widths = self.chunks[k]
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                payload = f.read(self.chunk_length(k))
+            self._cached = (k, decode_chunk(payload, nframes, widths, self.header))
+        return self._cached[1]
+
+    def chunk_length(self, k):
+        end = self.chunks[k + 1][0] - CHUNK_HEADER.size if k + 1 < len(self.chunks) \
+              else self.end
+        return end - self.chunks[k][0]
+
+
+def compress_trajectory(source: str, target: str, error: float = 1e-5,
+                        momentum_error: Optional[float] = None, keyframe_every: int = 64):
+    """
+    Writes the trajectory file source (from TrajectoryWriter) as a compressed
+    trajectory file target.
+
+    Parameters
+    ----------
+    source : str
+        Trajectory file path.
+    target : str
+        Compressed trajectory file path.
+    error : float, optional
+        Absolute error bound of positions. The default is 1e-5.
+    momentum_error : Optional[float], optional
+        Absolute error bound of momenta. If None, equals error. The default is None.
+    keyframe_every : int, optional
+        Number of frames per chunk. The default is 64.
+
+    """
+    reader = TrajectoryReader(source)
+    with CompressedTrajectoryWriter(target, error, momentum_error, keyframe_every,
+                                    energy=False) as writer:
+        for start in range(0, len(reader), keyframe_every):
+            frames = reader[start:start + keyframe_every]
+            for frame in frames:
+                writer.write(float(frame["time"]), torch.from_numpy(np.array(frame["xy"])),
+                             torch.from_numpy(np.array(frame["pxy"])),
+                             torch.from_numpy(np.array(frame["energy"])))
+
+
+def frame_dtype(header):
+    """Numpy structured dtype of a frame record"""
+    shape, energy_shape = tuple(header["shape"]), tuple(header["energy_shape"])
+    return np.dtype([("time", "<f8"), ("energy", "<f8", energy_shape),
+                     ("xy", header["dtype"], shape), ("pxy", header["dtype"], shape)])
+
+
+def encode_header(header, magic=MAGIC):
+    #Magic, length of the JSON header, and JSON header padded so records are aligned
+    encoded = json.dumps(header).encode("utf-8")
+    length = len(magic) + 8 + len(encoded)
+    encoded += b" "*(-length%HEADER_ALIGNMENT)
+    return magic + struct.pack("<Q", len(encoded)) + encoded
+
+
+def read_header(path, magic=MAGIC):
+    """Returns the header of a trajectory file, and the offset of its records"""
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError("Not a trajectory file")
+        length, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length).decode("utf-8"))
+    return header, len(magic) + 8 + length
+
+
+def encode_chunk(frames, position_step, momentum_step, level=6):
+    """Chunk header and compressed payload of frames, quantized to the given steps"""
+    arrays = [frames["time"], frames["energy"]]
+    widths = []
+    for name, quantum in (("xy", position_step), ("pxy", momentum_step)):
+        quantized = np.rint(frames[name].astype(np.float64)/quantum).astype(np.int64)
+        deltas = np.diff(quantized, axis=0)
+        dtype = _delta_dtype(deltas)
+        arrays += [quantized[0], deltas.astype(dtype)]
+        widths.append(dtype.itemsize)
+    payload = zlib.compress(b"".join(np.ascontiguousarray(a).tobytes() for a in arrays), level)
+    return CHUNK_HEADER.pack(len(payload), len(frames), *widths) + payload
+
+
+def decode_chunk(payload, nframes, widths, header):
+    data = zlib.decompress(payload)
+    dtype = frame_dtype(header)
+    frames = np.zeros(nframes, dtype=dtype)
+    offset = 0
+
+    def take(array_dtype, shape):
+        nonlocal offset
+        array_dtype = np.dtype(array_dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        array = np.frombuffer(data, array_dtype, count, offset).reshape(shape)
+        offset += count*array_dtype.itemsize
+        return array
+
+    frames["time"] = take("<f8", (nframes,))
+    frames["energy"] = take("<f8", (nframes, *header["energy_shape"]))
+    shape = tuple(header["shape"])
+    for name, width, error in (("xy", widths[0], header["error"]),
+                               ("pxy", widths[1], header["momentum_error"])):
+        key = take("<i8", shape)
+        deltas = take("<i%d" % width, (nframes - 1, *shape)).astype(np.int64)
+        quantized = np.concatenate([key[None], key[None] + np.cumsum(deltas, axis=0)])
+        frames[name] = quantized*(2*error)
+    return frames
+
+
+def scan_chunks(path, offset):
+    """
+    Index of the chunks of a compressed trajectory file, as (payload offset,
+    number of frames, deltas itemsizes), and the end of the last whole chunk.
+    """
+    chunks = []
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        while offset + CHUNK_HEADER.size <= size:
+            f.seek(offset)
+            length, nframes, *widths = CHUNK_HEADER.unpack(f.read(CHUNK_HEADER.size))
+            if offset + CHUNK_HEADER.size + length > size:
+                break
+            chunks.append((offset + CHUNK_HEADER.size, nframes, widths))
+            offset += CHUNK_HEADER.size + length
+    return chunks, offset
+
+
+def _delta_dtype(deltas):
+    largest = int(np.max(np.abs(deltas))) if deltas.size > 0 else 0
+    for dtype in (np.int8, np.int16, np.int32):
+        if largest <= np.iinfo(dtype).max:
+            return np.dtype(dtype).newbyteorder("<")
+    return np.dtype("<i8")
+
+
+def _numpy_dtype(dtype):
+    return torch.empty((), dtype=dtype).numpy().dtype
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import math
+
+import torch
+
+
+class QuadTree(object):
+    def __init__(self, xy: torch.Tensor, charges: torch.Tensor,
+                 max_depth: int = None):
+        """
+        Vectorized 2-D quadtree, built level by level from the particles
+        cell indexes, with a final level having one cell per particle.
+        For batched sources, one tree is built per replica, with the
+        replica index prefixed to the cell keys.
+
+        Parameters
+        ----------
+        xy : torch.Tensor
+            Source positions, of shape (n, 2) or (b, n, 2).
+        charges : torch.Tensor
+            Source charges, of shape (n,) or (b, n).
+        max_depth : int, optional
+            Depth of the deepest cell level. If None, is set from the number of sources.
+            The default is None.
+        """
+        xy = xy.reshape(-1, *xy.shape[-2:]) #(b, n, 2)
+        charges = charges.reshape(-1, charges.shape[-1]) #(b, n)
+        self.nreplicas, n = xy.shape[0], xy.shape[1]
+        if max_depth is None:
+            max_depth = min(int(math.ceil(math.log(max(n, 2), 4))) + 4, 20)
+        self.max_depth = max_depth
+        positions = xy.detach()
+        lower = positions.min(dim=-2, keepdim=True).values
+        upper = positions.max(dim=-2, keepdim=True).values
+        size = (upper - lower).max(dim=-1, keepdim=True).values*(1 + 1e-6) + 1e-12 #(b, 1, 1)
+        origin = (lower + upper)/2 - size/2
+        ncells = 2**max_depth
+        ij = ((positions - origin)/size*ncells).long().clamp(0, ncells - 1).reshape(-1, 2) #(b*n, 2)
+        self.size = size.flatten() #(b,)
+        self.replica = torch.arange(self.nreplicas).repeat_interleave(n) #(b*n,)
+        xy, charges = xy.reshape(-1, 2), charges.flatten()
+        self.levels = [self._make_level(xy, charges, ij, level)
+                       for level in range(max_depth + 1)]
+        self.levels.append(self._make_particle_level(xy, charges))
+        for parent, child in zip(self.levels[:-1], self.levels[1:]):
+            self._link_children(parent, child)
+
+    def _make_level(self, xy, charges, ij, level):
+        shift = self.max_depth - level
+        keys = self.replica*(4**level) + (ij[:, 0] >> shift)*(2**level) + (ij[:, 1] >> shift)
+        keys, inverse, counts = torch.unique(keys, return_inverse=True, return_counts=True)
+        width = self.size[keys//(4**level)]/2**level
+        return self._make_cells(xy, charges, inverse, counts, width)
+
+    def _make_particle_level(self, xy, charges):
+        n = xy.shape[0]
+        inverse = torch.arange(n)
+        counts = torch.ones(n, dtype=torch.long)
+        return self._make_cells(xy, charges, inverse, counts, torch.zeros(n, dtype=xy.dtype))
+
+    def _make_cells(self, xy, charges, inverse, counts, width):
+        ncells = counts.shape[0]
+        weights = torch.abs(charges) #Center of charge is taken with absolute charges
+        total_weight = torch.zeros(ncells, dtype=xy.dtype).index_add(0, inverse, weights)
+        center = torch.zeros(ncells, 2, dtype=xy.dtype).index_add(0, inverse, weights[:, None]*xy)
+        center = center/total_weight[:, None]
+        charge = torch.zeros(ncells, dtype=xy.dtype).index_add(0, inverse, charges)
+        return {"inverse": inverse, "counts": counts, "charge": charge,
+                "center": center, "width": width}
+
+    def _link_children(self, parent, child):
+        nchild_cells = child["counts"].shape[0]
+        parent_of_child = torch.zeros(nchild_cells, dtype=torch.long)
+        parent_of_child.scatter_(0, child["inverse"], parent["inverse"])
+        order = torch.argsort(parent_of_child, stable=True)
+        nchildren = torch.bincount(parent_of_child, minlength=parent["counts"].shape[0])
+        parent["children"] = order
+        parent["nchildren"] = nchildren
+        parent["child_offsets"] = torch.cumsum(nchildren, dim=0) - nchildren
+
+    def evaluate(self, targets: torch.Tensor, theta: float = 0.5,
+                 exclude_self: bool = False):
+        """
+        Potential and field generated by the sources on targets, with unit coupling.
+
+        Parameters
+        ----------
+        targets : torch.Tensor
+            Target positions, of shape (m, 2), or (b, m, 2) for batched sources.
+        theta : float, optional
+            Opening angle. A cell is taken as a point charge if its width is
+            smaller than theta times its distance to the target. The default is 0.5.
+        exclude_self : bool, optional
+            Whether targets are the sources themselves, and so their own
+            contribution should be excluded. The default is False.
+
+        Returns
+        -------
+        potential : torch.Tensor
+            Potential on targets, of shape (m,) or (b, m).
+        field : torch.Tensor
+            Field (minus potential gradient) on targets, of shape (m, 2) or (b, m, 2).
+
+        """
+        shape = targets.shape[:-1]
+        targets = targets.reshape(-1, 2)
+        m = targets.shape[0]
+        potential = torch.zeros(m, dtype=targets.dtype)
+        field = torch.zeros(m, 2, dtype=targets.dtype)
+        target_index = torch.arange(m)
+        #Root cell of each replica is indexed by the replica
+        cell_index = torch.arange(self.nreplicas).repeat_interleave(m//self.nreplicas)
+        for depth, level in enumerate(self.levels):
+            if target_index.shape[0] == 0:
+                break
+            diffs = targets[target_index] - level["center"][cell_index] #(p, 2)
+            leaf = level["counts"][cell_index] == 1
+            if exclude_self:
+                own = level["inverse"][target_index] == cell_index
+            else:
+                own = torch.zeros_like(leaf)
+            #Own cells are never accepted, so their distances are dummies
+            squared_dists = torch.sum(diffs**2, dim=-1)
+            dists = torch.sqrt(torch.where(own, torch.ones_like(squared_dists), squared_dists)) #(p,)
+            accept = ~own & (leaf | (level["width"][cell_index] < theta*dists))
+            accepted_target = target_index[accept]
+            charge = level["charge"][cell_index[accept]]
+            accepted_dists = dists[accept]
+            potential = potential.index_add(0, accepted_target, charge/accepted_dists)
+            field = field.index_add(0, accepted_target,
+                                    (charge/accepted_dists**3)[:, None]*diffs[accept])
+            expand = ~accept & ~leaf
+            if depth == len(self.levels) - 1:
+                break
+            target_index, cell_index = self._expand(level, target_index[expand],
+                                                    cell_index[expand])
+        return potential.reshape(shape), field.reshape(*shape, 2)
+
+    def _expand(self, level, target_index, cell_index):
+        nchildren = level["nchildren"][cell_index]
+        offsets = level["child_offsets"][cell_index]
+        total = int(nchildren.sum().item())
+        starts = torch.cumsum(nchildren, dim=0) - nchildren
+        local = torch.arange(total) - torch.repeat_interleave(starts, nchildren)
+        positions = torch.repeat_interleave(offsets, nchildren) + local
+        return (torch.repeat_interleave(target_index, nchildren),
+                level["children"][positions])
+
+
+def tree_internal_energy(xy, charge=1.0, coupling=1.0, theta=0.5):
+    """Barnes-Hut approximation of the sum of charge**2/d_ij over ordered pairs i != j"""
+    charges = torch.full(xy.shape[:-1], float(charge), dtype=xy.dtype)
+    tree = QuadTree(xy, charges)
+    potential, _ = tree.evaluate(xy, theta, exclude_self=True)
+    return coupling*torch.sum(charges*potential, dim=-1)
+
+
+def tree_internal_force(xy, charge=1.0, coupling=1.0, theta=0.5):
+    """Barnes-Hut approximation of minus the gradient of tree_internal_energy"""
+    with torch.no_grad():
+        charges = torch.full(xy.shape[:-1], float(charge), dtype=xy.dtype)
+        tree = QuadTree(xy, charges)
+        _, field = tree.evaluate(xy, theta, exclude_self=True)
+        #Factor 2 because each pair appears twice in the energy
+        return 2*coupling*charges[..., None]*field
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import math
+from typing import Optional
 
 import torch
 
@@ -18,14 +19,145 @@ def trapquad(f, a, b, N, *args):
     return value
 
 
-def circle_phi(r, N=100):
-    def integrand(theta, r):
-        if not isinstance(r, float):
-            theta = theta.view(*(theta.shape + (1,)*theta.ndim))
-        return 1/torch.sqrt(1 + r**2 - 2*r*torch.cos(theta))
-    integral = trapquad(integrand, 0, 2*math.pi, N, r)
-    integral = torch.nan_to_num(integral, 0.0)
-    return integral
+def is_compiling():
+    """Whether torch.compile is tracing, False for torch versions without it"""
+    compiler = getattr(torch, "compiler", None)
+    if compiler is not None and hasattr(compiler, "is_compiling"):
+        return compiler.is_compiling()
+    dynamo = getattr(torch, "_dynamo", None)
+    return dynamo is not None and hasattr(dynamo, "is_compiling") and dynamo.is_compiling()
+
+
+#Enough arithmetic-geometric mean iterations for |1 - r| down to ~1e-15
+AGM_ITERATIONS = 10
+
+
+def circle_phi(r):
+    """
+    Integral of 1/sqrt(1 + r**2 - 2*r*cos(theta)) over [0, 2*pi].
+    It equals 4*K(k)/(1 + r), with k**2 = 4*r/(1 + r)**2, that is, 
+    2*pi/agm(1 + r, |1 - r|).
+    """
+    m, _ = _circle_agm(r, derivative=False)
+    return torch.nan_to_num(2*math.pi/m, 0.0)
+
+
+def circle_dphi(r):
+    """Derivative of circle_phi, from the forward derivative of the AGM iteration"""
+    m, dm = _circle_agm(r)
+    return torch.nan_to_num(-2*math.pi*dm/m**2, 0.0)
+
+
+def _circle_agm(r, derivative=True):
+    r = torch.as_tensor(r)
+    a, b = 1 + r, torch.abs(1 - r)
+    if not derivative:
+        for _ in range(AGM_ITERATIONS):
+            a, b = (a + b)/2, torch.sqrt(a*b)
+        return a, None
+    da, db = torch.ones_like(a), torch.sign(r - 1)
+    for _ in range(AGM_ITERATIONS):
+        g = torch.sqrt(a*b)
+        a, b, da, db = (a + b)/2, g, (da + db)/2, (da*b + a*db)/(2*g)
+    return a, da
+
+
+class CircleTable(object):
+    def __init__(self, rmax: float = 0.999, size: int = 1024):
+        """
+        Cubic Hermite table of circle_phi on [0, rmax], built from exact
+        values and derivatives on a grid uniform in s = -log(1 - r), which
+        spreads the logarithmic singularity at r = 1. Values outside the table
+        are computed exactly.
+
+        Parameters
+        ----------
+        rmax : float, optional
+            Upper end of the table. The default is 0.999.
+        size : int, optional
+            Number of intervals. The default is 1024.
+        """
+        self.rmax = rmax
+        self.size = size
+        self.h = -math.log1p(-rmax)/size
+        nodes = torch.arange(size + 1, dtype=torch.float64)*self.h
+        r = -torch.expm1(-nodes)
+        y = circle_phi(r)
+        m = circle_dphi(r)*(1 - r)*self.h #Derivatives in t = s/h
+        y0, y1, m0, m1 = y[:-1], y[1:], m[:-1], m[1:]
+        #Interval polynomials c0 + c1*t + c2*t**2 + c3*t**3, of shape (size, 4)
+        self.coefficients = torch.stack([y0, m0, 3*(y1 - y0) - 2*m0 - m1,
+                                         2*(y0 - y1) + m0 + m1], dim=-1)
+        self._cast_coefficients = {}
+
+    def phi(self, r):
+        """Interpolated circle_phi"""
+        if is_compiling():
+            #Compiled graphs fuse the exact AGM iteration, without data-dependent branches
+            return circle_phi(r)
+        t, c, inside = self._locate(r)
+        value = c[..., 0] + t*(c[..., 1] + t*(c[..., 2] + t*c[..., 3]))
+        if not torch.all(inside):
+            value = torch.where(inside, value, circle_phi(r))
+        return value
+
+    def dphi(self, r):
+        """Derivative of the interpolant of circle_phi"""
+        if is_compiling():
+            return circle_dphi(r)
+        t, c, inside = self._locate(r)
+        dvalue = (c[..., 1] + t*(2*c[..., 2] + 3*t*c[..., 3]))/(self.h*(1 - r))
+        if not torch.all(inside):
+            dvalue = torch.where(inside, dvalue, circle_dphi(r))
+        return dvalue
+
+    def _locate(self, r):
+        r = torch.as_tensor(r)
+        if r.dtype not in self._cast_coefficients:
+            self._cast_coefficients[r.dtype] = self.coefficients.to(r.dtype)
+        inside = r <= self.rmax
+        s = -torch.log1p(-torch.clamp(r, 0.0, self.rmax))/self.h
+        index = torch.clamp(s.detach().long(), 0, self.size - 1)
+        return s - index, self._cast_coefficients[r.dtype][index], inside
+
+
+class Workspace(object):
+    def __init__(self, dtype: torch.dtype = torch.float32,
+                 device: Optional[torch.device] = None):
+        """
+        Named scratch storage, reused across calls. Each name owns a flat buffer,
+        grown only when a larger block is asked for, and viewed with the asked shape,
+        so that blocks of varying shapes (as pair tiles) share a single allocation.
+
+        Parameters
+        ----------
+        dtype : torch.dtype, optional
+            Default dtype of blocks. The default is torch.float32.
+        device : Optional[torch.device], optional
+            Device of blocks. The default is None.
+        """
+        self.dtype = dtype
+        self.device = device
+        self.buffers = {}
+        self.allocations = 0 #Number of buffer (re)allocations, constant once warmed up
+
+    def block(self, name, shape, dtype=None):
+        """Uninitialized contiguous block of given shape, owned by name"""
+        dtype = self.dtype if dtype is None else dtype
+        numel = math.prod(shape)
+        buffer = self.buffers.get((name, dtype))
+        if buffer is None or buffer.numel() < numel:
+            buffer = torch.empty(numel, dtype=dtype, device=self.device)
+            self.buffers[(name, dtype)] = buffer
+            self.allocations += 1
+        return buffer[:numel].view(shape)
+
+
+def scratch(workspace, name, shape, dtype):
+    """Block from workspace, or a fresh tensor if workspace is None"""
+    if workspace is None:
+        return torch.empty(shape, dtype=dtype)
+    return workspace.block(name, shape, dtype)
 
 
 def upper_mask(N):
@@ -36,19 +168,19 @@ def diagonal_mask(N):
     return torch.diag(torch.ones(N) * float('inf'))
 
 
-def wrap_from_center(tensor, lengths, centers):
+def wrap_from_center(tensor, lengths, centers, out=None):
     #x -> (x - center) + l;2 -> 
     #     (x - center + l/2)%l
     #  -> (x - center + l/2)%l - l/2
-    tensor = tensor.clone()
+    #Written to out if given (which may be tensor itself), instead of a clone
+    if out is None:
+        out = tensor.clone()
+    elif out is not tensor:
+        out.copy_(tensor)
     for i, length in enumerate(lengths):
         if length is None:
             continue
         center = centers[i]
         dislocation = length/2 - center
-        tensor[..., i] = (tensor[..., i] + dislocation)%length - \
-                          dislocation
-    return tensor
-    
-    
-    
\ No newline at end of file
+        out[..., i].add_(dislocation).remainder_(length).sub_(dislocation)
+    return out
@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
+import os
 import sys
+import time
+import shutil
+import tempfile
 import matplotlib
 matplotlib.use('Qt5Agg')
 
@@ -8,7 +12,7 @@ from PyQt5.QtWidgets import (QApplication, QWidget, QMainWindow,
                              QComboBox, QLabel, QPushButton,
                              QLineEdit, QCheckBox, QFileDialog,
                              QMessageBox)
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import QTimer, QThread, pyqtSignal
 
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 from matplotlib.figure import Figure
@@ -16,20 +20,11 @@ from matplotlib.figure import Figure
 import numpy as np
 import torch
 
+from . import trajectory
 from . import visutils
+from .visutils import POINTS_DESIGNS, FRAMES_DESIGNS, FIXED_POINTS_DESIGNS, INTEGRATORS
 
 
-POINTS_DESIGNS = \
-    ["N-Random-Circle", "N-Random-Square", "N-Equilateral", 
-     "3-Isosceles", "3-Equilateral", "3-Isosceles-B",
-     "4-Cross", "4-Diamond","4-Square"]
-FRAMES_DESIGNS = \
-    ["Circle", "Hash", "Square", "Periodic", "XPeriodic", "YPeriodic"]
-FIXED_POINTS_DESIGNS = ["None", "RandomCircle", "RandomSquare"]
-INTEGRATORS = \
-    ["SympleticEuler", "SympleticVerlet",
-     "Tao20", "Tao80", "Tao320"] 
-
 LICENSE_MESSAGE = \
 """\
 BSD 3-Clause License
@@ -73,6 +68,12 @@ class Visualizer(QMainWindow):
         self.setWindowTitle("Field Billard")
         self.setCentralWidget(CentralWidget(self))
         self.show()
+
+    def closeEvent(self, event):
+        form = self.centralWidget().form
+        form.stop() #Simulation thread must end before the window
+        form.close_memory()
+        super().closeEvent(event)
         
 
 class CentralWidget(QWidget):
@@ -89,6 +90,60 @@ class CentralWidget(QWidget):
         self.setLayout(self.main_layout)
 
 
+class SimulationWorker(QThread):
+    failed = pyqtSignal(str, str) #Title and message
+
+    def __init__(self, system, dt, pacing, snapshots, parent=None):
+        """
+        Thread integrating the system continuously, publishing positions to
+        the snapshots triple buffer every pacing.steps_per_frame steps (or every
+        advance by as many dt, for adaptive steps), with (time, steps) as info,
+        and waiting when ahead of the pacing target speed. The system must not
+        be touched by other threads while it runs.
+        """
+        super().__init__(parent)
+        self.system = system
+        self.dt = dt
+        self.pacing = pacing
+        self.snapshots = snapshots
+        self.steps = 0
+
+    def run(self):
+        system = self.system
+        last = time.perf_counter()
+        while not self.isInterruptionRequested():
+            nsteps = self.pacing.steps_per_frame(self.dt)
+            start = time.perf_counter()
+            try:
+                if system.stepper is None:
+                    for _ in range(nsteps):
+                        system.step(self.dt)
+                else: #Same simulated time per snapshot as fixed steps
+                    system.advance(self.dt*nsteps)
+            except visutils.integrators.NonValidIntegratorError:
+                self.failed.emit("Could not run system", "Non-compatible integrator")
+                return
+            except Exception as error: #An uncaught error would end the thread silently
+                self.failed.emit("Simulation failed", "%s: %s" % (type(error).__name__, error))
+                return
+            elapsed = time.perf_counter() - start
+            wait = self.pacing.wait(self.dt*nsteps, elapsed)
+            while wait > 0 and not self.isInterruptionRequested(): #Short sleeps, to stop quickly
+                self.msleep(int(1000*min(wait, 0.05)))
+                wait -= 0.05
+            now = time.perf_counter()
+            self.pacing.record_steps(nsteps, elapsed, now - last)
+            last = now
+            self.steps += nsteps
+            xy = system.points.xy.detach()
+            self.snapshots.publish(xy.numpy(), (system.time, self.steps))
+            if torch.max(torch.abs(xy)).item() > 2.0:
+                self.failed.emit("Stopping simulation",
+                                 "There are particles out of bounds. "\
+                                 "Try a lower time step or a sympletic integrator.")
+                return
+
+
 class FormWidget(QWidget):
     def __init__(self, parent):
         super().__init__(parent)
@@ -179,12 +234,14 @@ class FormWidget(QWidget):
         self.integrator_combobox = QComboBox()
         self.integrator_combobox.addItems(integrator_designs)
         self.integrator_combobox.setCurrentIndex(1)
+        self.integrator_combobox.setEditable(True) #For "Tao<omega>" with other omegas
         timestep_title = QLabel("Step")
         self.timestep = QLineEdit()
         self.timestep.setText("0.001")
         render_interval_text = QLabel("Render")
         self.render_ledit = QLineEdit()
         self.render_ledit.setText("10")
+        self.render_ledit.setToolTip("Steps per frame, or initial guess with auto pacing")
         integrator_hbox.addWidget(integrator_title)
         integrator_hbox.addWidget(self.integrator_combobox)
         integrator_hbox.addWidget(timestep_title)
@@ -204,14 +261,48 @@ class FormWidget(QWidget):
         # timestep_hbox.addWidget(render_interval_text)
         # timestep_hbox.addWidget(self.render_ledit)
         
+        adaptive_hbox = QHBoxLayout()
+        self.adaptive_checkbox = QCheckBox("Adaptive")
+        tolerance_title = QLabel("Tolerance")
+        self.tolerance_ledit = QLineEdit()
+        self.tolerance_ledit.setText("1e-6")
+        adaptive_hbox.addWidget(self.adaptive_checkbox)
+        adaptive_hbox.addWidget(tolerance_title)
+        adaptive_hbox.addWidget(self.tolerance_ledit)
+
+        pacing_hbox = QHBoxLayout()
+        self.pacing_checkbox = QCheckBox("Auto pacing")
+        self.pacing_checkbox.setChecked(True)
+        fps_title = QLabel("FPS")
+        self.fps_ledit = QLineEdit()
+        self.fps_ledit.setText("30")
+        speed_title = QLabel("Speed")
+        self.speed_ledit = QLineEdit()
+        self.speed_ledit.setText("")
+        self.speed_ledit.setToolTip("Simulated time per second. Empty for as fast as possible")
+        pacing_hbox.addWidget(self.pacing_checkbox)
+        pacing_hbox.addWidget(fps_title)
+        pacing_hbox.addWidget(self.fps_ledit)
+        pacing_hbox.addWidget(speed_title)
+        pacing_hbox.addWidget(self.speed_ledit)
+
         memory_hbox = QHBoxLayout()
         self.memory_checkbox = QCheckBox("Memory")
-        memory_title = QLabel("Size")
+        memory_title = QLabel("Stride")
         self.memory_ledit = QLineEdit()
-        self.memory_ledit.setText("50")
+        self.memory_ledit.setText("10")
         memory_hbox.addWidget(self.memory_checkbox)
         memory_hbox.addWidget(memory_title)
         memory_hbox.addWidget(self.memory_ledit)
+
+        trail_hbox = QHBoxLayout()
+        self.trail_checkbox = QCheckBox("Trail")
+        trail_title = QLabel("Length")
+        self.trail_ledit = QLineEdit()
+        self.trail_ledit.setText("50")
+        trail_hbox.addWidget(self.trail_checkbox)
+        trail_hbox.addWidget(trail_title)
+        trail_hbox.addWidget(self.trail_ledit)
         
         create_button = QPushButton("Create")
         create_button.clicked.connect(self.create)
@@ -228,25 +319,33 @@ class FormWidget(QWidget):
         self.layout.addLayout(mass_hbox)
         self.layout.addLayout(darwin_hbox)
         self.layout.addLayout(integrator_hbox)
+        self.layout.addLayout(adaptive_hbox)
+        self.layout.addLayout(pacing_hbox)
         self.layout.addLayout(memory_hbox)
+        self.layout.addLayout(trail_hbox)
         self.layout.addWidget(create_button)
         self.layout.addWidget(run_button)
         self.layout.addWidget(snap_button)
         self.layout.addWidget(license_button)
+        self.status_label = QLabel("")
+        self.layout.addWidget(self.status_label)
         self.layout.addStretch(1)
         self.setLayout(self.layout)
         
-        frame_rate = 30 #TODO: put something better        
+        self.pacing = visutils.PacingController()
         self.timer = QTimer()
-        self.timer.setInterval(int(1/frame_rate)*1000)
+        self.timer.setInterval(int(1000*self.pacing.interval()))
         self.timer.timeout.connect(self.update)
+        self.worker = None
+        self.last_status = 0.0
     
     def show_license(self):
         QMessageBox.information(self, "License", 
                                 LICENSE_MESSAGE, QMessageBox.Ok)
         
     def create(self):
-        self.timer.stop()
+        self.stop()
+        self.close_memory()
         self.parent.plot.reset_plot()
         point_design = self.point_combobox.currentText()
         frame_design = self.frame_combobox.currentText()
@@ -263,17 +362,27 @@ class FormWidget(QWidget):
                                 else float(self.darwin_ledit.text())
             fixed_point_number = int(self.fixed_points_number_ledit.text())
             fixed_point_charge = float(self.fixed_points_charge_ledit.text())
-            self.memory_size = int(self.memory_ledit.text())
+            self.memory_stride = int(self.memory_ledit.text())
+            trail_length = int(self.trail_ledit.text()) if self.trail_checkbox.isChecked() \
+                           else None
             self.dt = float(self.timestep.text())
             self.nrender = int(self.render_ledit.text())
+            tolerance = float(self.tolerance_ledit.text())
+            target_fps = float(self.fps_ledit.text())
+            target_speed = float(self.speed_ledit.text()) if self.speed_ledit.text().strip() \
+                           else None
             assert charge >= 0
             assert frame_charge > 0
             assert mass > 0
             assert noise >= 0
             assert (True if darwin_coupling is None else darwin_coupling >= 0)
-            assert self.memory_size >= 0
+            assert self.memory_stride >= 1
+            assert (True if trail_length is None else trail_length >= 1)
             assert self.dt > 0.0
             assert self.nrender >= 1
+            assert tolerance > 0
+            assert target_fps > 0
+            assert (True if target_speed is None else target_speed > 0)
         except ValueError:
             QMessageBox.critical(self, 
                                  "Could not start system",
@@ -281,6 +390,8 @@ class FormWidget(QWidget):
                                  QMessageBox.Close,
                                  QMessageBox.Close)
         self.has_memory = self.memory_checkbox.isChecked()
+        self.pacing = visutils.PacingController(target_fps, target_speed, self.nrender,
+                                                self.pacing_checkbox.isChecked())
         self.system = visutils.create_system_from_design(point_design,
                                                          noise,
                                                          mass,
@@ -291,51 +402,88 @@ class FormWidget(QWidget):
         visutils.set_system_frame(self.system, frame_design, frame_charge)
         fixedx, fixedy = visutils.set_fixed_points(self.system, fixed_points_design,
                                                    fixed_point_number, fixed_point_charge)
-        visutils.set_integrator(self.system, integrator)
-        if self.has_memory:
-            self.memory = visutils.collections.deque([], maxlen=self.memory_size)
-            self.memory.append(self.system.points.xy.detach().numpy())
-        self.parent.plot.init_scatter(self.system)
+        try:
+            visutils.set_integrator(self.system, integrator)
+        except ValueError:
+            QMessageBox.critical(self, 
+                                 "Could not start system",
+                                 "Integrator not available",
+                                 QMessageBox.Close,
+                                 QMessageBox.Close)
+            return
+        if self.adaptive_checkbox.isChecked():
+            #Absolute tolerance set from positions scale of one
+            self.system.set_adaptive("error", dt=self.dt, rtol=tolerance, atol=tolerance)
+        xy = self.system.points.xy.detach().numpy()
+        self.snapshots = visutils.TripleBuffer(xy.shape, xy.dtype)
+        if self.has_memory: #Streamed to a temporary file, copied on snap
+            fd, path = tempfile.mkstemp(suffix=".fbt")
+            os.close(fd) #The writer opens the file by path
+            self.memory = trajectory.TrajectoryWriter(path, stride=self.memory_stride)
+            self.system.add_sink(self.memory)
+        self.parent.plot.init_scatter(self.system, trail_length)
         self.draw_objects(frame_design)
         self.parent.plot.draw_points(fixedx, fixedy)
         
     def run(self):
         assert hasattr(self, "system")
+        if self.worker is None:
+            self.worker = SimulationWorker(self.system, self.dt, self.pacing, self.snapshots)
+            self.worker.failed.connect(self.worker_failed)
+            self.worker.start()
         self.timer.start()
 
+    def stop(self):
+        """Stops the simulation worker, after which the system can be touched again"""
+        self.timer.stop()
+        if self.worker is not None:
+            self.worker.requestInterruption()
+            self.worker.wait()
+            self.worker = None
+
+    def close_memory(self):
+        """Closes the trajectory sink of the current system, deleting its temporary file"""
+        memory = getattr(self, "memory", None)
+        if memory is None:
+            return
+        if memory in self.system.sinks:
+            self.system.remove_sink(memory)
+        memory.close()
+        try:
+            os.remove(memory.path)
+        except OSError:
+            pass
+        self.memory = None
+
+    def worker_failed(self, title, message):
+        self.stop()
+        self.update()
+        QMessageBox.critical(self, title, message, QMessageBox.Close, QMessageBox.Close)
+
     def update(self):
-        for i in range(self.nrender):
-            try:
-                self.system.step(self.dt)
-            except visutils.integrators.NonValidIntegratorError:
-                QMessageBox.critical(self, 
-                                     "Could not run system",
-                                     "Non-compatible integrator",
-                                     QMessageBox.Close,
-                                     QMessageBox.Close)
-                self.timer.stop()
-                break
-        if self.has_memory:
-            self.memory.append(self.system.points.xy.detach().clone().numpy())
-        self.parent.plot.update_scatter(self.system, None)
-        fartest = torch.max(torch.abs(self.system.points.xy.detach())).item()
-        if fartest > 2.0:
-            QMessageBox.critical(self, "Stopping simulation",
-                                 "There are particles out of bounds. "\
-                                 "Try a lower time step or a sympletic integrator.",
-                                 QMessageBox.Close, QMessageBox.Close)
-            self.timer.stop()
+        xy, info = self.snapshots.latest()
+        if xy is None:
+            return
+        start = time.perf_counter()
+        self.parent.plot.update_scatter(xy)
+        now = time.perf_counter()
+        self.pacing.record_draw(now - start, now)
+        self.timer.setInterval(int(1000*self.pacing.interval()))
+        if now - self.last_status > 0.5: #Label redraws are throttled too
+            self.status_label.setText("t = %.3f    steps/s: %.0f    fps: %.1f"
+                                      % (info[0], self.pacing.steps_rate, self.pacing.fps))
+            self.last_status = now
 
     def snap(self):
-        self.timer.stop()
-        if not self.has_memory:
+        self.stop()
+        if getattr(self, "memory", None) is None: #Memory unchecked, or closed
             return
         else:
-            memory_array = np.stack(self.memory, axis=-1)
+            self.memory.flush()
             file_name, _ = QFileDialog.getSaveFileName(self, 'Save File',
-                "","NPY file (*.npy)")
+                "","Trajectory file (*.fbt)")
             try:
-                np.save(file_name, memory_array)
+                shutil.copyfile(self.memory.path, file_name)
             except:
                 QMessageBox.information(self, "Error", 
                     "Unable to save file.", QMessageBox.Ok)
@@ -359,11 +507,18 @@ class PlotWidget(FigureCanvasQTAgg):
         self.axes = fig.add_subplot(111)
         self.reset_plot()
         super().__init__(fig)
+        #Static artists are drawn once into a cached background, and moving
+        #(animated) artists are blitted on top of it
+        self.mpl_connect("draw_event", self.cache_background)
         
     def reset_plot(self):
         self.axes.cla()
         self.axes.set_xlim(-1.0, 1.0)
         self.axes.set_ylim(-1.0, 1.0)
+        self.scatter = None
+        self.trail = None
+        self.trail_buffer = None
+        self.background = None
     
     def draw_circle(self):
         theta = np.linspace(0, 2*np.pi, 101)
@@ -392,28 +547,38 @@ class PlotWidget(FigureCanvasQTAgg):
         self.axes.scatter(x, y, color='darkblue')
         self.draw()
         
-    def init_scatter(self, system):
-        self.scatter = self.axes.scatter(system.points.x.detach().numpy(),
-                                         system.points.y.detach().numpy(),
-                                         color='black')
+    def init_scatter(self, system, trail_length=None):
+        xy = system.points.xy.detach().numpy()
+        if trail_length is not None:
+            self.trail_buffer = visutils.TrailBuffer(trail_length, xy.shape, dtype=xy.dtype)
+            self.trail = self.axes.scatter(*self.trail_buffer.offsets.T,
+                                           facecolors=self.trail_buffer.facecolors,
+                                           edgecolors='none', animated=True)
+        self.scatter = self.axes.scatter(xy[:, 0], xy[:, 1], color='black', animated=True)
         #self.title = self.axes.set_title("t = %f"%t)
         self.draw()
-    
-    def init_scatter_with_memory(self, memory):
-        self.axes.cla()
-        self.axes.set_xlim(-1.0, 1.0)
-        self.axes.set_ylim(-1.0, 1.0)
-        for xy, alpha in memory.iterate_with_alpha():
-            self.axes.scatter(xy[:, 0], xy[:, 1], color='black', alpha=alpha)
-        self.draw()
+
+    def cache_background(self, event):
+        self.background = self.copy_from_bbox(self.axes.bbox)
+        self.draw_moving()
+
+    def draw_moving(self):
+        for artist in [self.trail, self.scatter]:
+            if artist is not None:
+                self.axes.draw_artist(artist)
         
-    def update_scatter(self, system, memory=None):
-        #self.init_scatter(system, t)
-        if memory is None:
-            self.scatter.set_offsets(system.points.xy.detach().numpy())
+    def update_scatter(self, xy):
+        self.scatter.set_offsets(xy)
+        if self.trail is not None:
+            self.trail_buffer.append(xy)
+            self.trail.set_offsets(self.trail_buffer.offsets)
+            self.trail.set_facecolor(self.trail_buffer.facecolors)
+        if self.background is None: #Not drawn yet
             self.draw()
-        else: #Dumb way for doing this
-            self.init_scatter_with_memory(memory)
+            return
+        self.restore_region(self.background)
+        self.draw_moving()
+        self.blit(self.axes.bbox)
             
             
 def run():
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
+from typing import Optional
 import math
-import collections
+import threading
 
 import torch
 import numpy as np
@@ -10,22 +11,200 @@ from . import fields
 from . import integrators
 
 
-class Memory(object):
-    def __init__(self, alpha, alpha_lim=0.05):
-        self.alpha = alpha
-        self.alpha_lim = alpha_lim
-        self.maxlen = int(math.log(alpha_lim)/math.log(alpha))
-        self.deque = collections.deque([], maxlen=self.maxlen)
-        
-    def append(self, x):
-        self.deque.append(x)
-        
-    def iterate_with_alpha(self):
-        for i, item in enumerate(reversed(self.deque)):
-            yield item, self.alpha**i
+#Designs of the GUI form, also used by headless tools
+POINTS_DESIGNS = \
+    ["N-Random-Circle", "N-Random-Square", "N-Equilateral", 
+     "3-Isosceles", "3-Equilateral", "3-Isosceles-B",
+     "4-Cross", "4-Diamond","4-Square"]
+FRAMES_DESIGNS = \
+    ["Circle", "Hash", "Square", "Periodic", "XPeriodic", "YPeriodic"]
+FIXED_POINTS_DESIGNS = ["None", "RandomCircle", "RandomSquare"]
+INTEGRATORS = \
+    ["SympleticEuler", "SympleticVerlet",
+     "Yoshida4", "Yoshida6", "ForestRuth", "BlanesMoan", "RESPA",
+     "ImplicitMidpoint", "GaussLegendre",
+     "Tao20", "Tao80", "Tao320"] 
+
+
+class TrailBuffer(object):
+    def __init__(self, length, shape, alpha_lim=0.05, dtype=np.float32):
+        """
+        Ring buffer of the last length positions, with RGBA colors (black) whose
+        alphas fade geometrically with age, down to alpha_lim for the oldest one.
+        Positions and colors are preallocated and updated in place, so that a
+        single scatter collection can show the whole trail.
+
+        Parameters
+        ----------
+        length : int
+            Number of remembered frames.
+        shape : tuple
+            Shape of positions, (n, 2).
+        alpha_lim : float, optional
+            Alpha of the oldest frame. The default is 0.05.
+        dtype : optional
+            Dtype of positions. The default is np.float32.
+        """
+        self.length = length
+        self.fades = alpha_lim**(np.arange(length)/max(length - 1, 1))
+        self.positions = np.zeros((length, *shape), dtype=dtype)
+        self.colors = np.zeros((length, shape[0], 4)) #Black, unfilled slots transparent
+        self.head = -1
+        self.count = 0
+
+    def append(self, xy):
+        self.head = (self.head + 1)%self.length
+        self.count = min(self.count + 1, self.length)
+        np.copyto(self.positions[self.head], xy)
+        ages = (self.head - np.arange(self.length))%self.length
+        self.colors[..., 3] = np.where(ages < self.count, self.fades[ages], 0.0)[:, None]
+
+    @property
+    def offsets(self):
+        return self.positions.reshape(-1, 2)
+
+    @property
+    def facecolors(self):
+        return self.colors.reshape(-1, 4)
+
+
+class TripleBuffer(object):
+    def __init__(self, shape, dtype=np.float32):
+        """
+        Latest value handoff between a producer and a consumer thread, without
+        either waiting for the other beyond a pointer swap. The producer writes
+        into a back buffer and swaps it with the middle one, the consumer swaps
+        the middle one with its front buffer if a new value was published.
+
+        Parameters
+        ----------
+        shape : tuple
+            Shape of values.
+        dtype : optional
+            Dtype of values. The default is np.float32.
+        """
+        self.buffers = [np.zeros(shape, dtype=dtype) for _ in range(3)]
+        self.info = [None]*3 #Metadata published along each value
+        self.back, self.middle, self.front = 0, 1, 2
+        self.fresh = False
+        self.published = False
+        self.lock = threading.Lock()
+
+    def publish(self, value, info=None):
+        """Copies value (and its info) as the latest one. Producer side only."""
+        np.copyto(self.buffers[self.back], value)
+        self.info[self.back] = info
+        with self.lock:
+            self.back, self.middle = self.middle, self.back
+            self.fresh = True
+            self.published = True
+
+    def latest(self):
+        """
+        Latest published value and its info, or (None, None) if nothing was
+        published yet. Consumer side only, and valid until its next call.
+        """
+        with self.lock:
+            if self.fresh:
+                self.front, self.middle = self.middle, self.front
+                self.fresh = False
+            elif not self.published:
+                return None, None
+        return self.buffers[self.front], self.info[self.front]
+
+
+
+class PacingController(object):
+    def __init__(self, target_fps: float = 30.0, target_speed: Optional[float] = None,
+                 nsteps: int = 10, auto: bool = True, smoothing: float = 0.2,
+                 headroom: float = 1.5, max_nsteps: int = 100000):
+        """
+        Frame pacing from measured costs. Step and draw costs are exponential
+        moving averages of their measured durations. The render interval is the
+        one of target_fps, lengthened when drawing takes more than 1/headroom of
+        it. Steps per frame cover target_speed (simulated time per wall time
+        second) over the interval if given, and otherwise fill the interval
+        with steps, as fast as the hardware allows. Step measurements are taken
+        in the simulation thread and draw ones in the GUI thread. If not auto,
+        costs are only measured, for the achieved rates.
+
+        Parameters
+        ----------
+        target_fps : float, optional
+            Target frames per second. The default is 30.0.
+        target_speed : Optional[float], optional
+            Target simulated time per second. If None, runs as fast as possible.
+            The default is None.
+        nsteps : int, optional
+            Initial steps per frame. The default is 10.
+        auto : bool, optional
+            Whether to tune the render interval and steps per frame. If False,
+            they are 1/target_fps and nsteps, without waits. The default is True.
+        smoothing : float, optional
+            Weight of new measurements on averages. The default is 0.2.
+        headroom : float, optional
+            Ratio of render interval to draw cost. The default is 1.5.
+        max_nsteps : int, optional
+            Maximum steps per frame. The default is 100000.
+        """
+        self.target_fps = target_fps
+        self.target_speed = target_speed
+        self.nsteps = nsteps
+        self.auto = auto
+        self.smoothing = smoothing
+        self.headroom = headroom
+        self.max_nsteps = max_nsteps
+        self.step_cost = None #Seconds per step
+        self.draw_cost = None #Seconds per draw
+        self.steps_rate = 0.0 #Achieved steps per second, including waits
+        self.fps = 0.0 #Achieved frames per second
+        self.last_frame = None
+
+    def record_steps(self, nsteps, elapsed, period):
+        """Steps taken, time spent on them, and time since previous record (with waits)"""
+        self.step_cost = self._average(self.step_cost, elapsed/nsteps)
+        if period > 0:
+            self.steps_rate = self._average(self.steps_rate, nsteps/period)
+
+    def record_draw(self, elapsed, now):
+        self.draw_cost = self._average(self.draw_cost, elapsed)
+        if self.last_frame is not None and now > self.last_frame:
+            self.fps = self._average(self.fps, 1/(now - self.last_frame))
+        self.last_frame = now
+
+    def interval(self):
+        """Render interval in seconds"""
+        interval = 1/self.target_fps
+        if self.auto and self.draw_cost is not None:
+            interval = max(interval, self.headroom*self.draw_cost)
+        return interval
+
+    def steps_per_frame(self, dt):
+        if not self.auto:
+            return self.nsteps
+        if self.target_speed is not None:
+            nsteps = math.ceil(self.target_speed*self.interval()/dt)
+        elif self.step_cost is not None and self.step_cost > 0:
+            nsteps = int(self.interval()/self.step_cost)
+        else:
+            nsteps = self.nsteps
+        self.nsteps = min(self.max_nsteps, max(1, nsteps))
+        return self.nsteps
+
+    def wait(self, simulated, elapsed):
+        """Seconds to wait after elapsed seconds simulating simulated time, not to run ahead"""
+        if not self.auto or self.target_speed is None:
+            return 0.0
+        return max(0.0, simulated/self.target_speed - elapsed)
+
+    def _average(self, average, value):
+        if average is None or average == 0.0:
+            return value
+        return (1 - self.smoothing)*average + self.smoothing*value
 
         
-def create_system_from_design(design, noise, mass, charge, pradius, npoints, darwin_coupling):
+def create_system_from_design(design, noise, mass, charge, pradius, npoints, darwin_coupling,
+                              nreplicas=None):
     if design == "4-Diamond":
         x = torch.tensor([0.8, 0.0, -0.8, 0.0])
         y = torch.tensor([0.0, 0.8, 0.0, -0.8])
@@ -50,6 +229,9 @@ def create_system_from_design(design, noise, mass, charge, pradius, npoints, dar
         x, y = _sample_uniform_unit_square(npoints, pradius)
     elif design == "N-Equilateral":
         x, y = _make_equilateral_designs(pradius, npoints)
+    if nreplicas is not None: #Batch of independently perturbed copies
+        x = x.expand(nreplicas, -1).clone()
+        y = y.expand(nreplicas, -1).clone()
     x += noise*torch.randn_like(x)
     y += noise*torch.randn_like(y)
     syst = system.NBodySystem(x, y, mass=mass, charge=charge,
@@ -59,7 +241,7 @@ def create_system_from_design(design, noise, mass, charge, pradius, npoints, dar
 
 def set_system_frame(syst, design, charge_density):
     if design == "Circle":
-        obj = fields.Ring(1.0, charge_density=charge_density)
+        obj = fields.Ring(1.0, charge_density=charge_density, tabulated=True)
         syst.add_field_object(obj)
     elif design == "Square":
         obj = fields.Square(2.0, charge_density=charge_density)
@@ -101,7 +283,9 @@ def set_fixed_points(syst, design, N, charge):
                                              syst.points.lx,
                                              syst.points.ly,
                                              syst.points.cx,
-                                             syst.points.cy)
+                                             syst.points.cy,
+                                             syst.points.periodic_method,
+                                             syst.points.periodic_options)
         else:
             obj = fields.FixedPoints(x, y, charge)
         syst.add_field_object(obj)
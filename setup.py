@@ -12,8 +12,11 @@ setup(
     name="fieldbillard",
     version="0.0.1",
     description="Field Billard",
-    packages=find_packages(where='fieldbillard'),
+    packages=find_packages(),
     author="Danilo de Freitas Naiff",
     author_email="dfnaiff@gmail.com",
-    url="https://github.com/DFNaiff/FieldBillard/"
+    url="https://github.com/DFNaiff/FieldBillard/",
+    entry_points={
+        "console_scripts": ["fieldbillard-batch=fieldbillard.batch:main"]
+    }
 )
\ No newline at end of file
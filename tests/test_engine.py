@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import collections
+
+import pytest
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+from fieldbillard import batch
+from fieldbillard import fields
+
+
+class AllocationCounter(TorchDispatchMode):
+    """Counts the operators creating new tensors (neither in-place, out= nor views)"""
+    def __init__(self):
+        super().__init__()
+        self.operators = collections.Counter()
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        result = func(*args, **(kwargs or {}))
+        schema = func._schema
+        aliasing = schema.is_mutable or any(r.alias_info is not None for r in schema.returns)
+        if not aliasing and any(isinstance(value, torch.Tensor)
+                                for value in tree_flatten(result)[0]):
+            self.operators[str(func)] += 1
+        return result
+
+    @property
+    def count(self):
+        return sum(self.operators.values())
+
+
+def make_system(frame, integrator, npoints=16):
+    run, = batch.expand_sweep({"designs": ["N-Random-Circle"], "frames": [frame],
+                               "integrators": [integrator], "npoints": npoints,
+                               "radius": 0.5})
+    return batch.build_system(run)
+
+
+def step_allocations(engine, nsteps):
+    counts = []
+    for _ in range(nsteps):
+        with AllocationCounter() as counter:
+            engine.step()
+        counts.append(counter.count)
+    return counts
+
+
+@pytest.mark.parametrize("integrator", ["sympleticeuler", "sympleticverlet", "yoshida4", "tao20"])
+def test_engine_steps_without_allocations(integrator):
+    #Periodic box without field objects, so every temporary is in the workspace
+    system = make_system("Periodic", integrator)
+    engine = system.make_engine(1e-3)
+    for _ in range(3):
+        engine.step()
+    workspace_allocations = engine.workspace.allocations
+    assert step_allocations(engine, 10) == [0]*10
+    assert engine.workspace.allocations == workspace_allocations
+
+
+@pytest.mark.parametrize("integrator, force_evaluations",
+                         [("sympleticverlet", 1), ("yoshida4", 3), ("tao20", 4)])
+def test_engine_allocations_bounded_by_field_objects(integrator, force_evaluations):
+    #Field objects evaluate their closed forms with fresh temporaries, which are
+    #then the only allocations of a step
+    system = make_system("Circle", integrator)
+    ring, = system.objects
+    x, y = system.points.x.detach(), system.points.y.detach()
+    ring.force(x, y, system.points.charge, system.coupling) #Warms up cached tables
+    with AllocationCounter() as counter:
+        ring.force(x, y, system.points.charge, system.coupling)
+    engine = system.make_engine(1e-3)
+    for _ in range(3):
+        engine.step()
+    assert step_allocations(engine, 10) == [force_evaluations*counter.count]*10
+
+
+@pytest.fixture
+def float64():
+    torch.set_default_dtype(torch.float64)
+    yield
+    torch.set_default_dtype(torch.float32)
+
+
+@pytest.mark.parametrize("integrator", ["sympleticverlet", "yoshida4", "tao20"])
+def test_engine_matches_step(integrator, float64):
+    system, reference = make_system("Circle", integrator), make_system("Circle", integrator)
+    for syst in [system, reference]:
+        syst.add_field_object(fields.FixedPoints(torch.tensor([0.1]), torch.tensor([0.2]), 1.0))
+    engine = system.make_engine(1e-3)
+    for _ in range(20):
+        engine.step()
+        reference.step(1e-3)
+    torch.testing.assert_close(system.points.xy, reference.points.xy)
+    torch.testing.assert_close(system.points.pxy, reference.points.pxy)
+    assert system.time == pytest.approx(reference.time)
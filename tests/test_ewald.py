@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import pytest
+import torch
+
+from fieldbillard import ewald
+
+
+@pytest.fixture
+def float64():
+    torch.set_default_dtype(torch.float64)
+    yield
+    torch.set_default_dtype(torch.float32)
+
+
+def neutral_sources(n, seed=0):
+    #Neutral and with zero dipole moment (sources mirrored through the origin),
+    #so that image sums of the field converge fast and regardless of their order
+    generator = torch.Generator().manual_seed(seed)
+    half = torch.rand(n//2, 2, generator=generator)*1.8 - 0.9
+    charges = torch.randn(n//2, generator=generator)
+    charges = charges - charges.mean()
+    return torch.cat([half, -half]), torch.cat([charges, charges])
+
+
+def image_sum_field(targets, sources, charges, lx, ly, nimages):
+    shifts = torch.arange(-nimages, nimages + 1, dtype=targets.dtype)
+    sx = shifts*lx if lx is not None else torch.zeros(1)
+    sy = shifts*ly if ly is not None else torch.zeros(1)
+    images = torch.stack(torch.meshgrid(sx, sy, indexing="ij"), dim=-1).reshape(-1, 2)
+    diffs = targets[:, None, None, :] - (sources[None, :, None, :] + images) #(n, m, k, 2)
+    dists = torch.sqrt(torch.sum(diffs**2, dim=-1))
+    return torch.sum(charges[None, :, None, None]*diffs/dists[..., None]**3, dim=(1, 2))
+
+
+@pytest.mark.parametrize("lx, ly, nimages", [(2.0, 2.0, 60), (2.0, None, 2000),
+                                             (None, 2.0, 2000), (2.0, 3.0, 60)])
+def test_ewald_field_matches_image_sum(lx, ly, nimages, float64):
+    sources, charges = neutral_sources(8)
+    generator = torch.Generator().manual_seed(1)
+    targets = torch.rand(5, 2, generator=generator)*1.8 - 0.9
+    _, field = ewald.periodic_potential(targets, sources, charges, lx, ly)
+    reference = image_sum_field(targets, sources, charges, lx, ly, nimages)
+    torch.testing.assert_close(field, reference, rtol=0.0, atol=1e-5*reference.abs().max())
+
+
+#With default parameters, mesh fields are within 1e-2 of Ewald ones for a few
+#particles, and within 1e-3 from a few tens on (relative to the field norm)
+@pytest.mark.parametrize("n, tolerance", [(8, 1e-2), (64, 1e-3), (256, 1e-3)])
+def test_mesh_matches_ewald(n, tolerance, float64):
+    generator = torch.Generator().manual_seed(n)
+    sources = torch.rand(n, 2, generator=generator)*2 - 1
+    charges = torch.randn(n, generator=generator)
+    potential, field = ewald.periodic_potential(sources, sources, charges, 2.0, 2.0,
+                                                exclude_self=True)
+    mesh_potential, mesh_field = ewald.periodic_potential(sources, sources, charges, 2.0, 2.0,
+                                                          "mesh", exclude_self=True)
+    assert ((mesh_field - field).norm()/field.norm()).item() < tolerance
+    assert ((mesh_potential - potential).norm()/potential.norm()).item() < tolerance
+
+
+@pytest.mark.parametrize("lx, ly, method", [(2.0, 2.0, "ewald"), (2.0, None, "ewald"),
+                                            (None, 2.0, "ewald"), (2.0, 2.0, "mesh")])
+def test_field_is_minus_potential_gradient(lx, ly, method, float64):
+    generator = torch.Generator().manual_seed(0)
+    sources = torch.rand(3, 10, 2, generator=generator)*2 - 1
+    charges = torch.randn(3, 10, generator=generator)
+    targets = (torch.rand(3, 7, 2, generator=generator)*2 - 1).requires_grad_()
+    potential, field = ewald.periodic_potential(targets, sources, charges, lx, ly, method)
+    gradient, = torch.autograd.grad(potential.sum(), targets)
+    torch.testing.assert_close(-gradient, field, rtol=1e-10, atol=1e-10)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import pytest
+import torch
+
+from fieldbillard import fields
+
+
+@pytest.fixture
+def float64():
+    torch.set_default_dtype(torch.float64)
+    yield
+    torch.set_default_dtype(torch.float32)
+
+
+FIELD_OBJECTS = {
+    "Ring": lambda: fields.Ring(1.0, 2.0, 0.1, -0.1),
+    "TabulatedRing": lambda: fields.Ring(1.0, 2.0, tabulated=True),
+    "HorizontalLine": lambda: fields.HorizontalLine(1.0, 2.0),
+    "VerticalLine": lambda: fields.VerticalLine(-1.0, 2.0),
+    "Hash": lambda: fields.Hash(2.0, 2.0),
+    "HorizontalFiniteLine": lambda: fields.HorizontalFiniteLine(1.0, 1.5, 0.2, 2.0),
+    "VerticalFiniteLine": lambda: fields.VerticalFiniteLine(-1.0, 1.5, 0.2, 2.0),
+    "Square": lambda: fields.Square(2.0, 2.0),
+    "FixedPoints": lambda: fields.FixedPoints(torch.tensor([0.9, -0.9]),
+                                              torch.tensor([-0.9, 0.3]), 0.5),
+    "PeriodicFixedPoints": lambda: fields.PeriodicFixedPoints(
+        torch.tensor([0.9, -0.9]), torch.tensor([-0.9, 0.3]), 0.5, 2.0, 2.0),
+    "EwaldFixedPoints": lambda: fields.PeriodicFixedPoints(
+        torch.tensor([0.9, -0.9]), torch.tensor([-0.9, 0.3]), 0.5, 2.0, 2.0, method="ewald"),
+    "XPeriodicFixedPoints": lambda: fields.PeriodicFixedPoints(
+        torch.tensor([0.9, -0.9]), torch.tensor([-0.9, 0.3]), 0.5, 2.0, None, method="ewald"),
+}
+
+
+def autograd_force(obj, x, y, charge, coupling):
+    x, y = x.clone().requires_grad_(), y.clone().requires_grad_()
+    potential = obj.potential(x, y, charge, coupling)
+    #Infinite lines do not depend on the coordinate along them
+    dx, dy = torch.autograd.grad(potential.sum(), [x, y], allow_unused=True)
+    return tuple(-d if d is not None else torch.zeros_like(x) for d in (dx, dy))
+
+
+@pytest.mark.parametrize("name", list(FIELD_OBJECTS))
+def test_force_is_minus_potential_gradient(name, float64):
+    obj = FIELD_OBJECTS[name]()
+    generator = torch.Generator().manual_seed(0)
+    x, y = torch.rand(2, 3, 7, generator=generator)*1.6 - 0.8
+    fx, fy = obj.force(x, y, 1.5, 0.7)
+    reference_fx, reference_fy = autograd_force(obj, x, y, 1.5, 0.7)
+    torch.testing.assert_close(fx, reference_fx)
+    torch.testing.assert_close(fy, reference_fy)
+
+
+@pytest.mark.parametrize("name", ["HorizontalFiniteLine", "VerticalFiniteLine"])
+def test_finite_line_force_on_its_extension(name, float64):
+    #On the line extension the transverse force is the limit of the nearby ones
+    obj = FIELD_OBJECTS[name]()
+    along = torch.tensor([-1.3, -0.7, 1.1, 1.6])
+    across = torch.full_like(along, 1.0 if name == "HorizontalFiniteLine" else -1.0)
+    x, y = (along, across) if name == "HorizontalFiniteLine" else (across, along)
+    force = torch.stack(obj.force(x, y, 1.5, 0.7))
+    assert torch.all(torch.isfinite(force))
+    if name == "HorizontalFiniteLine":
+        nearby = torch.stack(autograd_force(obj, x, y + 1e-7, 1.5, 0.7))
+    else:
+        nearby = torch.stack(autograd_force(obj, x + 1e-7, y, 1.5, 0.7))
+    torch.testing.assert_close(force, nearby, rtol=0.0, atol=1e-5)
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+import pytest
+import torch
+
+from fieldbillard import integrators
+from fieldbillard import system
+
+
+def test_gauss_legendre_needs_an_iteration():
+    with pytest.raises(ValueError):
+        integrators.get_integrator("gausslegendre", max_iterations=0)
+    syst = system.NBodySystem(torch.tensor([0.1, -0.2]), torch.tensor([0.3, 0.0]),
+                              integrator="gausslegendre")
+    syst.set_integrator("gausslegendre", max_iterations=1)
+    with pytest.warns(UserWarning, match="did not converge"):
+        syst.step(1e-2)
+    assert syst.integrator.iterations == 1
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import pytest
+import torch
+
+from fieldbillard import pairwise
+
+
+@pytest.fixture
+def float64():
+    torch.set_default_dtype(torch.float64)
+    yield
+    torch.set_default_dtype(torch.float32)
+
+
+def kernel(dx, dy, features_i, features_j):
+    #Asymmetric in i and j, so that pair orientation is checked too
+    (charge_i,), (charge_j,) = features_i, features_j
+    inverse_dists = torch.rsqrt(dx**2 + dy**2)
+    return charge_i*charge_j*inverse_dists, dx*charge_i - dy*charge_j
+
+
+def dense_sum(xy, charges):
+    #Same sums over the upper triangle of the full n x n matrices
+    dx = xy[..., :, None, 0] - xy[..., None, :, 0]
+    dy = xy[..., :, None, 1] - xy[..., None, :, 1]
+    n = xy.shape[-2]
+    upper = torch.triu(torch.ones(n, n, dtype=torch.bool), 1)
+    dx, dy = torch.where(upper, dx, 1.0), torch.where(upper, dy, 1.0)
+    values = kernel(dx, dy, (charges[..., :, None],), (charges[..., None, :],))
+    return [torch.sum(torch.where(upper, value, 0.0), dim=(-2, -1)) for value in values]
+
+
+@pytest.mark.parametrize("shape, tile_size", [((1,), 4), ((2,), 4), ((7,), 1024), ((7,), 3),
+                                              ((13,), 4), ((13,), 13), ((13,), 1),
+                                              ((3, 11), 4)])
+def test_pair_sum_matches_dense_sum(shape, tile_size, float64):
+    generator = torch.Generator().manual_seed(shape[-1])
+    xy = torch.rand(*shape, 2, generator=generator)*2 - 1
+    charges = torch.randn(*shape, generator=generator)
+    sums = pairwise.pair_sum(kernel, xy, (charges,), tile_size)
+    for value, reference in zip(sums, dense_sum(xy, charges)):
+        torch.testing.assert_close(value, reference)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import pytest
+import torch
+
+from fieldbillard import fields
+from fieldbillard import points
+
+
+@pytest.fixture
+def float64():
+    torch.set_default_dtype(torch.float64)
+    yield
+    torch.set_default_dtype(torch.float32)
+
+
+@pytest.mark.parametrize("shape, tile_size", [((10,), 1024), ((10,), 3), ((3, 9), 4)])
+def test_darwin_gradients_match_autograd(shape, tile_size, float64):
+    generator = torch.Generator().manual_seed(0)
+    x, y, px, py = torch.rand(4, *shape, generator=generator)*1.6 - 0.8
+    moving = points.MovingPoints(x, y, px, py, mass=1.5, charge=0.7)
+    moving.tile_size = tile_size
+    objects = [fields.Ring(1.0, 2.0), fields.FixedPoints(torch.tensor([0.9]),
+                                                         torch.tensor([-0.9]), 0.5)]
+    xy = moving.xy.detach().clone().requires_grad_()
+    pxy = moving.pxy.detach().clone().requires_grad_()
+    energy = moving.darwin_hamiltonian(xy, pxy, objects, 1.3, 0.05)
+    dhdxy, dhdpxy = torch.autograd.grad(energy.sum(), [xy, pxy])
+    closed_energy, closed_dhdxy, closed_dhdpxy = \
+        moving.darwin_gradients(xy.detach(), pxy.detach(), objects, 1.3, 0.05)
+    torch.testing.assert_close(closed_energy, energy.detach())
+    torch.testing.assert_close(closed_dhdxy, dhdxy)
+    torch.testing.assert_close(closed_dhdpxy, dhdpxy)
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import csv
+
+import torch
+
+from fieldbillard import system
+
+
+def test_cpu_profiler_reports_untracked_allocations(tmp_path):
+    syst = system.NBodySystem(torch.rand(8), torch.rand(8))
+    syst.set_profiling()
+    steps = []
+    syst.profiler.add_observer(steps.append)
+    for _ in range(3):
+        syst.step(1e-3)
+    assert all(phase["allocated_bytes"] is None
+               for metrics in steps for phase in metrics["phases"].values())
+    summary = syst.profiler.summary()
+    assert summary["steps"] == 3
+    assert summary["phases"]["step"]["calls"] == 3
+    assert all(phase["allocated_bytes"] is None for phase in summary["phases"].values())
+    path = tmp_path / "profile.csv"
+    syst.profiler.to_csv(str(path))
+    with open(path) as f:
+        rows = list(csv.DictReader(f))
+    assert all(row["allocated_bytes"] == "" for row in rows)
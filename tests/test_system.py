@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import pytest
+import torch
+
+from fieldbillard import batch
+from fieldbillard import fields
+from fieldbillard import integrators
+
+
+@pytest.fixture
+def float64():
+    torch.set_default_dtype(torch.float64)
+    yield
+    torch.set_default_dtype(torch.float32)
+
+
+def make_system(frame, integrator, npoints=16):
+    run, = batch.expand_sweep({"designs": ["N-Random-Circle"], "frames": [frame],
+                               "integrators": [integrator], "npoints": npoints,
+                               "radius": 0.5})
+    return batch.build_system(run)
+
+
+def count_force_evaluations(system):
+    counts = []
+    potential_force = system.points.potential_force
+
+    def counted(*args, **kwargs):
+        counts.append(1)
+        return potential_force(*args, **kwargs)
+    system.points.potential_force = counted
+    return counts
+
+
+@pytest.mark.parametrize("frame", ["Circle", "Periodic"])
+@pytest.mark.parametrize("integrator", ["sympleticeuler", "sympleticverlet", "yoshida4"])
+def test_run_matches_step(frame, integrator, float64):
+    system, reference = make_system(frame, integrator), make_system(frame, integrator)
+    trajectory = system.run(50, 1e-2, record_every=10, compile=False)
+    for i in range(50):
+        reference.step(1e-2)
+        if (i + 1)%10 == 0:
+            torch.testing.assert_close(trajectory[i//10, 0], reference.points.xy.detach())
+            torch.testing.assert_close(trajectory[i//10, 1], reference.points.pxy.detach())
+    assert system.time == pytest.approx(reference.time)
+
+
+@pytest.mark.parametrize("integrator, force_evaluations",
+                         [("sympleticeuler", 1), ("sympleticverlet", 1), ("yoshida4", 3)])
+def test_run_reuses_last_force(integrator, force_evaluations):
+    #Without wraps, every step evaluates forces as many times as its distinct kicks
+    system = make_system("Circle", integrator)
+    counts = count_force_evaluations(system)
+    system.run(20, 1e-3, compile=False)
+    assert len(counts) == 1 + 20*force_evaluations
+
+
+def test_run_caches_compiled_step(monkeypatch):
+    system = make_system("Circle", "sympleticverlet")
+    compiled = []
+    monkeypatch.setattr(torch, "compile", lambda step, **options: compiled.append(step) or step)
+    for _ in range(3):
+        system.run(5, 1e-3, compile=True)
+    system.run(5, 2e-3, compile=True)
+    assert len(compiled) == 2
+    system.coupling = 2.0
+    system.run(5, 2e-3, compile=True)
+    assert len(compiled) == 3
+
+
+@pytest.mark.parametrize("configure", [lambda system: system.set_block_steps(),
+                                       lambda system: system.set_adaptive("separation")])
+def test_run_with_steppers_matches_step(configure, float64):
+    system = make_system("Circle", "sympleticverlet")
+    reference = make_system("Circle", "sympleticverlet")
+    configure(system)
+    configure(reference)
+    trajectory = system.run(10, 1e-2)
+    for _ in range(10):
+        if reference.stepper is None:
+            reference.step(1e-2)
+        else:
+            reference.advance(1e-2)
+    torch.testing.assert_close(trajectory[-1, 0], reference.points.xy.detach())
+    assert system.time == pytest.approx(reference.time)
+    assert system.time == pytest.approx(0.1)
+
+
+def test_force_stamp_tracks_interaction_setup():
+    system = make_system("Circle", "sympleticverlet")
+    points, (ring,) = system.points, system.objects
+    fixed = fields.FixedPoints(torch.tensor([0.1]), torch.tensor([0.2]))
+    system.add_field_object(fixed)
+    changes = [lambda: setattr(points, "charge", 2.0),
+               lambda: setattr(points, "charge", torch.ones(16)),
+               lambda: points.charge.mul_(3.0),
+               lambda: setattr(points, "nper", 2),
+               lambda: setattr(points, "tile_size", 8),
+               lambda: setattr(ring, "radius", 2.0),
+               lambda: fixed.x0.add_(0.1),
+               fixed.invalidate]
+    for change in changes:
+        stamp = integrators.force_stamp(points, system.objects, system.coupling)
+        assert integrators.force_stamp(points, system.objects, system.coupling) == stamp
+        change()
+        assert integrators.force_stamp(points, system.objects, system.coupling) != stamp
+
+
+def test_engine_force_follows_object_changes():
+    system = make_system("Circle", "sympleticverlet")
+    ring, = system.objects
+    engine = system.make_engine(1e-3)
+    engine.step()
+    ring.charge_density *= 2
+    system.points.charge = 0.5
+    xy = system.points.xy.detach()
+    torch.testing.assert_close(engine.cached_force(),
+                               system.points.potential_force(xy, system.objects,
+                                                             system.coupling))
+
+
+def test_block_steps_keep_positions_dtype():
+    #Positions in double precision, with the default dtype left in single precision
+    system = make_system("Circle", "sympleticverlet")
+    points = system.points
+    for name in ["xy", "pxy"]:
+        setattr(points, name, torch.nn.Parameter(getattr(points, name).detach().double()))
+    reference = points.xy.detach().clone(), points.pxy.detach().clone()
+    system.set_block_steps(max_level=0) #A single level, which is the Verlet step
+    system.step(1e-3)
+    assert points.pxy.dtype == torch.float64
+    force = points.potential_force(reference[0], system.objects, system.coupling)
+    pxy = reference[1] + 0.5e-3*force
+    #Step sizes rounded to single precision would be off by about 1e-8
+    torch.testing.assert_close(points.xy.detach(), reference[0] + 1e-3*pxy/points.mass,
+                               rtol=1e-12, atol=1e-15)
+
+
+def advance(system, nsteps, dt):
+    for _ in range(nsteps):
+        if system.stepper is not None:
+            system.advance(dt)
+        else:
+            system.step(dt)
+
+
+@pytest.mark.parametrize("frame, integrator, configure",
+                         [("Circle", "sympleticverlet", None),
+                          ("Circle", "tao20", None),
+                          ("Circle", "gausslegendre", None),
+                          ("Periodic", "sympleticverlet", None),
+                          ("Periodic", "yoshida4",
+                           lambda system: system.set_periodic_method("ewald")),
+                          ("Circle", "sympleticverlet",
+                           lambda system: system.set_adaptive("error", rtol=1e-4, atol=1e-4)),
+                          ("Circle", "sympleticverlet", lambda system: system.set_block_steps())],
+                         ids=["verlet", "tao20", "gausslegendre", "periodic", "ewald", "adaptive",
+                              "blocks"])
+def test_checkpoint_continues_bitwise(frame, integrator, configure, tmp_path):
+    system = make_system(frame, integrator)
+    if configure is not None:
+        configure(system)
+    advance(system, 20, 1e-3)
+    path = str(tmp_path / "system.ckpt")
+    system.save_checkpoint(path)
+    loaded = type(system).load_checkpoint(path)
+    advance(system, 30, 1e-3)
+    advance(loaded, 30, 1e-3)
+    assert torch.equal(loaded.points.xy, system.points.xy)
+    assert torch.equal(loaded.points.pxy, system.points.pxy)
+    assert loaded.time == system.time
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+import torch
+
+from fieldbillard import system
+from fieldbillard import trajectory
+
+
+def make_system():
+    generator = torch.Generator().manual_seed(0)
+    x, y = torch.rand(2, 6, generator=generator)*2 - 1
+    return system.NBodySystem(x, y)
+
+
+@pytest.mark.parametrize("writer_class, reader_class",
+                         [(trajectory.TrajectoryWriter, trajectory.TrajectoryReader),
+                          (trajectory.CompressedTrajectoryWriter,
+                           trajectory.CompressedTrajectoryReader)])
+def test_closed_writer_keeps_its_frames(writer_class, reader_class, tmp_path):
+    path = str(tmp_path / "run.fbt")
+    syst = make_system()
+    writer = writer_class(path)
+    syst.add_sink(writer)
+    for _ in range(100):
+        syst.step(1e-3)
+    writer.close()
+    with pytest.raises(ValueError, match="closed"):
+        syst.step(1e-3)
+    assert len(reader_class(path)) == 100
+
+
+@pytest.fixture
+def float64():
+    torch.set_default_dtype(torch.float64)
+    yield
+    torch.set_default_dtype(torch.float32)
+
+
+def record_run(path, nsteps=150):
+    syst = make_system()
+    syst.set_integrator("yoshida4")
+    with trajectory.TrajectoryWriter(path, flush_every=32) as writer:
+        syst.add_sink(writer)
+        for _ in range(nsteps):
+            syst.step(1e-2)
+    return syst
+
+
+@pytest.mark.parametrize("error, momentum_error", [(1e-5, None), (1e-3, 1e-2)])
+def test_compressed_trajectory_within_error_bounds(error, momentum_error, tmp_path, float64):
+    source, target = str(tmp_path / "run.fbt"), str(tmp_path / "run.fbc")
+    record_run(source)
+    trajectory.compress_trajectory(source, target, error, momentum_error, keyframe_every=16)
+    frames = trajectory.TrajectoryReader(source)[:]
+    compressed = trajectory.CompressedTrajectoryReader(target)[:]
+    momentum_error = error if momentum_error is None else momentum_error
+    assert len(compressed) == len(frames) == 150
+    assert abs(compressed["xy"] - frames["xy"]).max() <= error
+    assert abs(compressed["pxy"] - frames["pxy"]).max() <= momentum_error
+    assert (compressed["time"] == frames["time"]).all()
+    assert (compressed["energy"] == frames["energy"]).all()
+
+
+def test_compressed_append_after_truncated_chunk(tmp_path, float64):
+    path = str(tmp_path / "run.fbc")
+    syst = make_system()
+    frames = []
+    writer = trajectory.CompressedTrajectoryWriter(path, keyframe_every=16)
+    syst.add_sink(writer)
+    for _ in range(50): #Chunks of 16, 16, 16 and 2 frames
+        syst.step(1e-2)
+        frames.append((syst.time, syst.points.xy.detach().clone()))
+    writer.close()
+    syst.remove_sink(writer)
+    with open(path, "r+b") as f: #As if interrupted while writing the last chunk
+        f.truncate(os.path.getsize(path) - 5)
+    assert len(trajectory.CompressedTrajectoryReader(path)) == 48
+    writer = trajectory.CompressedTrajectoryWriter(path, keyframe_every=16, append=True)
+    syst.add_sink(writer)
+    for _ in range(10):
+        syst.step(1e-2)
+        frames.append((syst.time, syst.points.xy.detach().clone()))
+    writer.close()
+    expected = frames[:48] + frames[50:]
+    compressed = trajectory.CompressedTrajectoryReader(path)[:]
+    assert len(compressed) == len(expected) == 58
+    assert list(compressed["time"]) == [time for time, _ in expected]
+    xy = torch.stack([xy for _, xy in expected]).numpy()
+    assert abs(compressed["xy"] - xy).max() <= 1e-5
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import pytest
+import torch
+
+from fieldbillard import points
+from fieldbillard import treecode
+from fieldbillard import system
+
+
+#Bounds of the relative force and energy errors against the direct sum, for each theta
+ACCURACY = [(0.2, 1e-3, 2e-3), (0.5, 5e-3, 1e-2), (0.8, 1e-2, 3e-2)]
+
+
+@pytest.fixture
+def float64():
+    torch.set_default_dtype(torch.float64)
+    yield
+    torch.set_default_dtype(torch.float32)
+
+
+def random_points(n, seed=0, nreplicas=None):
+    generator = torch.Generator().manual_seed(seed)
+    shape = (n,) if nreplicas is None else (nreplicas, n)
+    x = torch.rand(shape, generator=generator)*2 - 1
+    y = torch.rand(shape, generator=generator)*2 - 1
+    return points.MovingPoints(x, y, charge=1.5)
+
+
+def direct(moving, coupling=2.0):
+    xy = moving.xy.detach()
+    return (moving.images_internal_force(xy, [(0, 0)], coupling),
+            moving.images_internal_energy(xy, [(0, 0)], coupling))
+
+
+def relative_errors(moving, theta, coupling=2.0):
+    xy = moving.xy.detach()
+    force, energy = direct(moving, coupling)
+    tree_force = treecode.tree_internal_force(xy, moving.charge, coupling, theta)
+    tree_energy = treecode.tree_internal_energy(xy, moving.charge, coupling, theta)
+    return ((tree_force - force).norm()/force.norm()).item(), \
+           (torch.abs(tree_energy - energy)/torch.abs(energy)).max().item()
+
+
+@pytest.mark.parametrize("n", [50, 300])
+def test_tree_without_opening_matches_direct_sum(n, float64):
+    moving = random_points(n)
+    xy = moving.xy.detach()
+    force, energy = direct(moving)
+    torch.testing.assert_close(treecode.tree_internal_force(xy, moving.charge, 2.0, 0.0), force,
+                               rtol=1e-12, atol=1e-9)
+    torch.testing.assert_close(treecode.tree_internal_energy(xy, moving.charge, 2.0, 0.0), energy,
+                               rtol=1e-12, atol=0.0)
+
+
+@pytest.mark.parametrize("n", [200, 500])
+def test_tree_accuracy_against_theta(n, float64):
+    moving = random_points(n)
+    errors = [relative_errors(moving, theta) for theta, _, _ in ACCURACY]
+    for (theta, force_bound, energy_bound), (force_error, energy_error) in zip(ACCURACY, errors):
+        assert force_error < force_bound, theta
+        assert energy_error < energy_bound, theta
+    #Accuracy degrades as cells are opened less
+    assert errors == sorted(errors, key=lambda error: error[0])
+
+
+def test_tree_accuracy_batched(float64):
+    moving = random_points(200, nreplicas=3)
+    force_error, energy_error = relative_errors(moving, 0.5)
+    assert force_error < 5e-3 and energy_error < 1e-2
+    force, energy = direct(moving)
+    xy = moving.xy.detach()
+    torch.testing.assert_close(treecode.tree_internal_force(xy, moving.charge, 2.0, 0.0), force,
+                               rtol=1e-12, atol=1e-9)
+
+
+def test_tree_backend_steps_as_direct_without_opening(float64):
+    moving = random_points(100)
+    x, y = moving.x.detach(), moving.y.detach()
+    tree = system.NBodySystem(x.clone(), y.clone(), backend="tree", theta=0.0)
+    reference = system.NBodySystem(x.clone(), y.clone())
+    for _ in range(5):
+        tree.step(1e-4)
+        reference.step(1e-4)
+    torch.testing.assert_close(tree.points.xy, reference.points.xy)
+    torch.testing.assert_close(tree.points.pxy, reference.points.pxy)